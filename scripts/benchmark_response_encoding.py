@@ -0,0 +1,156 @@
+"""Compares the payload size and encode time of the json endpoints with
+each response encoding: Flask's default json provider (the standard
+library), `encode_json` (orjson, if installed) and MessagePack (if
+installed), each uncompressed and compressed with gzip and brotli (if
+installed).
+
+The endpoints are requested with the app's test client, and the objects
+they return are captured before encoding, so that each encoding is timed on
+the same objects."""
+import json
+import time
+from typing import Any, Callable, Dict, List
+
+import argschema
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+from cell_labeling_app.main import App
+from cell_labeling_app.util import response_encoding
+from cell_labeling_app.util.response_encoding import FastJSONProvider, \
+    compress, encode_json, encode_msgpack
+
+
+class BenchmarkSchema(argschema.ArgSchema):
+    app_input_json = argschema.fields.InputFile(
+        required=True,
+        description='Input json of the app'
+    )
+    email = argschema.fields.String(
+        required=True,
+        description='User to log in as'
+    )
+    job_id = argschema.fields.Int(
+        required=True,
+        description='Labeling job to request the job endpoints for'
+    )
+    region_id = argschema.fields.Int(
+        required=True,
+        description='Region to request the region endpoints for'
+    )
+    n_repeats = argschema.fields.Int(
+        default=20,
+        description='Number of times each payload is encoded. The median '
+                    'time is reported'
+    )
+
+
+class _RecordingJSONProvider(FastJSONProvider):
+    """Records the last object encoded as a response"""
+    last_obj = None
+
+    def response(self, *args, **kwargs):
+        _RecordingJSONProvider.last_obj = \
+            self._prepare_response_obj(args, kwargs)
+        return super().response(*args, **kwargs)
+
+
+def _stdlib_default(obj: Any) -> Any:
+    """What the endpoints did before the provider handled numpy"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return DefaultJSONProvider.default(obj)
+
+
+class Benchmark(argschema.ArgSchemaParser):
+    """Benchmarks response encodings per endpoint"""
+    default_schema = BenchmarkSchema
+
+    def run(self):
+        payloads = self._get_payloads()
+
+        encoders: Dict[str, Callable[[Any], bytes]] = {
+            'stdlib json': lambda obj: json.dumps(
+                obj, default=_stdlib_default, sort_keys=True,
+                separators=(',', ':')).encode('utf-8'),
+            'orjson' if response_encoding.orjson is not None
+            else 'stdlib json (no orjson)': encode_json
+        }
+        if response_encoding.msgpack is not None:
+            encoders['msgpack'] = encode_msgpack
+        content_encodings = ['gzip']
+        if response_encoding.brotli is not None:
+            content_encodings.append('br')
+
+        header = f'{"endpoint":<36}{"encoding":<26}{"bytes":>12}' + \
+            ''.join([f'{x + " bytes":>12}' for x in content_encodings]) + \
+            f'{"encode ms":>12}'
+        print(header)
+        print('-' * len(header))
+        for endpoint, obj in payloads.items():
+            for name, encode in encoders.items():
+                times = []
+                for _ in range(self.args['n_repeats']):
+                    start = time.perf_counter()
+                    data = encode(obj)
+                    times.append(time.perf_counter() - start)
+                sizes = [len(compress(data=data, encoding=x))
+                         for x in content_encodings]
+                print(f'{endpoint:<36}{name:<26}{len(data):>12}' +
+                      ''.join([f'{x:>12}' for x in sizes]) +
+                      f'{np.median(times) * 1000:>12.2f}')
+
+    def _get_payloads(self) -> Dict[str, Any]:
+        """Requests each endpoint and returns the object it returned"""
+        with open(self.args['app_input_json']) as f:
+            app = App(input_data=json.load(f), args=[])
+        flask_app = app.create_flask_app(session_secret_key='benchmark')
+        flask_app.json = _RecordingJSONProvider(flask_app)
+        client = flask_app.test_client()
+
+        res = client.post('/users/login',
+                          data=json.dumps({'email': self.args['email']}))
+        if res.status_code != 200:
+            raise ValueError(f'Unable to login {self.args["email"]}')
+
+        region = client.get(
+            f'/get_region?region_id={self.args["region_id"]}').get_json()
+        experiment_id = region['experiment_id']
+        contours_url = (f'/get_roi_contours?experiment_id={experiment_id}'
+                        f'&current_region_id={self.args["region_id"]}')
+        roi = client.get(contours_url).get_json()['contours'][0]
+
+        requests: List[Dict] = [
+            {'endpoint': 'get_roi_contours', 'url': contours_url},
+            {'endpoint': 'get_roi_contours (delta)',
+             'url': f'{contours_url}&encoding=delta'},
+            {'endpoint': 'get_trace', 'url': '/get_trace',
+             'json': {'experiment_id': experiment_id,
+                      'roi': {'id': roi['id'], 'contours': None,
+                              'isUserAdded': False}}},
+            {'endpoint': 'get_projection_stats',
+             'url': f'/get_projection_stats?type=max'
+                    f'&experiment_id={experiment_id}'},
+            {'endpoint': 'get_all_labels', 'url': '/get_all_labels'},
+            {'endpoint': 'get_user_submitted_labels',
+             'url': '/get_user_submitted_labels'
+                    f'?job_id={self.args["job_id"]}'}
+        ]
+        payloads = {}
+        for r in requests:
+            _RecordingJSONProvider.last_obj = None
+            if 'json' in r:
+                res = client.post(r['url'], data=json.dumps(r['json']))
+            else:
+                res = client.get(r['url'])
+            if res.status_code != 200:
+                raise RuntimeError(f'{r["url"]} returned {res.status_code}')
+            payloads[r['endpoint']] = _RecordingJSONProvider.last_obj
+        return payloads
+
+
+if __name__ == '__main__':
+    benchmark = Benchmark()
+    benchmark.run()
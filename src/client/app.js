@@ -1,8 +1,12 @@
 import {
-    clipImageToQuantiles,
-    bytesToMatrix,
-    scaleToUint8,
-    toRGB,
+    responseToTypedArray,
+    responseToRoiFrames,
+    drawRoiFrame,
+    getQuantile,
+    makeContrastLut,
+    applyLutToRGB,
+    decodeContours,
+    fetchWithRetry,
     displayTemporaryAlert
 } from './util.js';
 
@@ -10,6 +14,9 @@ import {
     ROI
 } from './roi.js';
 
+// Frame rate of the ROI frames drawn in the browser, same as rendered videos
+const ROI_FRAMES_FPS = 31;
+
 
 class CellLabelingApp {
     /* Main App class */
@@ -39,6 +46,11 @@ class CellLabelingApp {
             this.displayVideo();
         });
 
+        $('#video_draw_frames').on('click', () => {
+            this.draw_video_frames = !this.draw_video_frames;
+            this.displayVideo();
+        });
+
         $('button#trim_video_to_timeframe').on('click', () => {
             this.videoGoToTimesteps();
         });
@@ -149,25 +161,30 @@ class CellLabelingApp {
     }
 
     displayTrace() {
-        return fetch(`http://${SERVER_ADDRESS}/get_trace`,
+        return fetchWithRetry(`http://${SERVER_ADDRESS}/get_trace?dtype=float32&compress=true`,
         {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'Accept': 'application/x-ndarray'
             },
             body: JSON.stringify({
                 experiment_id: this.experiment_id,
                 roi: this.selected_roi
             })
-        }).then(async response => await response.json())
-        .then(data => {
+        }).then(async response => {
+            const firstNonZeroIndex = parseInt(response.headers.get('X-Trace-First-Nonzero'));
+            const {data} = await responseToTypedArray(response);
+            return {data, firstNonZeroIndex};
+        })
+        .then(({data, firstNonZeroIndex}) => {
 
             // Truncating trace since the first n timesteps in the movie might be blank frames
-            const firstNonZeroIndex = _.findIndex(data['trace'].map(x => x !== 0));
-            let trace = data['trace'].slice(firstNonZeroIndex);
+            // (index of first nonzero timestep is computed by the server)
+            let trace = Array.from(data.subarray(firstNonZeroIndex));
 
             trace = {
-                x: _.range(firstNonZeroIndex, data['trace'].length),
+                x: _.range(firstNonZeroIndex, data.length),
                 y: trace
             }
 
@@ -211,9 +228,9 @@ class CellLabelingApp {
 
         if (rois === null) {
             $("#projection_include_mask_outline").attr("disabled", true);
-            const url = `http://${SERVER_ADDRESS}/get_roi_contours?experiment_id=${this.experiment_id}&current_region_id=${this.region['id']}`;
-            await $.get(url, data => {
-                rois = data['contours'].map(x => new ROI({
+            const url = `http://${SERVER_ADDRESS}/get_roi_contours?experiment_id=${this.experiment_id}&current_region_id=${this.region['id']}&encoding=delta`;
+            await fetchWithRetry(url).then(res => res.json()).then(data => {
+                rois = decodeContours(data).map(x => new ROI({
                     id: x['id'],
                     experiment_id: x['experiment_id'],
                     color: x['color'],
@@ -298,26 +315,16 @@ class CellLabelingApp {
         $('#projection_contrast_label').text(`Contrast: 100%`);
 
         const projection_type = $('#projection_type').children("option:selected").val();
-        const url = `http://${SERVER_ADDRESS}/get_projection?type=${projection_type}&experiment_id=${this.experiment_id}`;
-        return fetch(url).then(async data => {
-            const blob = await data.blob();
-            data = await bytesToMatrix(blob);
-
-            data = data._data;
-            this.projection_raw = data;
+        const url = `http://${SERVER_ADDRESS}/get_projection?type=${projection_type}&experiment_id=${this.experiment_id}&compress=true`;
+        const statsUrl = `http://${SERVER_ADDRESS}/get_projection_stats?type=${projection_type}&experiment_id=${this.experiment_id}`;
+        return Promise.all([
+            fetch(url).then(data => responseToTypedArray(data)),
+            fetch(statsUrl).then(data => data.json())
+        ]).then(async ([projection, stats]) => {
+            this.projection_raw = projection;
+            this.projection_stats = stats;
 
-            if (projection_type !== 'correlation') {
-                data = scaleToUint8(data);
-            }
-
-            data = toRGB(data);
-
-            const trace1 = {
-                z: data,
-                type: 'image',
-                // disable hover tooltip
-                hoverinfo: 'none'
-            };
+            const trace1 = this.#getProjectionTrace(this.#getContrastValues());
 
             if (this.projection_is_shown) {
                 const layout = document.getElementById('projection').layout;
@@ -387,6 +394,7 @@ class CellLabelingApp {
         // Disable contour toggle checkboxes until movie has loaded
         $('#video_include_mask_outline').attr("disabled", true);
         $('#video_include_surrounding_rois').attr('disabled', true);
+        $('#video_draw_frames').attr('disabled', true);
 
         // Reset timestep display text
         $('#timestep_display').text('');
@@ -397,7 +405,7 @@ class CellLabelingApp {
         this.is_video_shown = false;
 
         if (videoTimeframe === null) {
-            videoTimeframe = await fetch(`http://${SERVER_ADDRESS}/get_default_video_timeframe`,
+            videoTimeframe = await fetchWithRetry(`http://${SERVER_ADDRESS}/get_default_video_timeframe`,
                 {
                     method: 'POST',
                     headers: {
@@ -413,7 +421,6 @@ class CellLabelingApp {
 
         videoTimeframe = [parseInt(videoTimeframe[0]), parseInt(videoTimeframe[1])]
 
-        const url = `http://${SERVER_ADDRESS}/get_video`;
         const postData = {
             experiment_id: this.experiment_id,
             roi_id: this.selected_roi.id,
@@ -426,33 +433,244 @@ class CellLabelingApp {
             is_user_added: this.selected_roi.isUserAdded,
             contours: this.selected_roi.contours
         };
-        return $.ajax({
-            xhrFields: {
-                responseType: 'blob'
-            },
-            type: 'POST',
-            url: url,
-            data: JSON.stringify(postData)
-        }).then(response => {
-            const blob = new Blob([response], {type: "video\/mp4"});
-            const blobUrl = URL.createObjectURL(blob);
-            const video = `
-                <video controls id="movie" width="512" height="512" src=${blobUrl}></video>
-            `;
-            $('#video_container').html($(video));
 
-            $('#video_include_mask_outline').attr("disabled", false);
-            $('#video_include_surrounding_rois').attr('disabled', false);
+        // The labeler moved on from the previous video
+        this.cancelVideoJob();
+        this.#stopRoiFrames();
 
-            if (this.is_trace_shown) {
-                $('button#trim_video_to_timeframe').attr('disabled', false);
+        let isShown;
+        if (this.draw_video_frames) {
+            isShown = await this.#displayRoiFrames(postData);
+        } else {
+            isShown = await this.#displayRenderedVideo(postData);
+        }
+        if (!isShown) {
+            return;
+        }
+
+        $('#video_include_mask_outline').attr("disabled", false);
+        // The surrounding ROIs are only drawn on rendered videos
+        $('#video_include_surrounding_rois').attr('disabled', this.draw_video_frames);
+        $('#video_draw_frames').attr('disabled', false);
+
+        if (this.is_trace_shown) {
+            $('button#trim_video_to_timeframe').attr('disabled', false);
+        }
+
+        $('#timestep_display').text(`Timesteps: ${videoTimeframe[0]} - ${videoTimeframe[1]}`);
+
+        this.is_video_shown = true;
+        $('#video-spinner').hide();
+    }
+
+    async #displayRenderedVideo(postData) {
+        /* Renders the video on the server and shows it
+
+        Returns
+        --------
+        Whether the video is shown. False if rendering failed or the video
+        was superseded by a newer video request
+        */
+        const jobId = await this.#renderVideo(postData);
+        if (jobId === null || jobId !== this.videoJobId) {
+            // Failed, or superseded by a newer video request
+            if (jobId === null) {
+                $('#video-spinner').hide();
             }
+            return false;
+        }
+        this.videoJobId = null;
+
+        const videoUrl = `http://${SERVER_ADDRESS}/get_rendered_video?job_id=${jobId}`;
+        const video = `
+            <video controls id="movie" width="512" height="512" src=${videoUrl}></video>
+        `;
+        $('#video_container').html($(video));
+        return true;
+    }
 
-            $('#timestep_display').text(`Timesteps: ${videoTimeframe[0]} - ${videoTimeframe[1]}`);
+    async #displayRoiFrames(postData) {
+        /* Fetches the raw movie frames around the ROI and plays them on a
+        canvas. Much cheaper for the server than rendering a video
 
-            this.is_video_shown = true;
+        Returns
+        --------
+        Whether the frames are shown. False if fetching them failed or they
+        were superseded by a newer video request
+        */
+        const request = {};
+        this.roiFramesRequest = request;
+        const res = await fetch(`http://${SERVER_ADDRESS}/get_roi_frames?compress=true`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(postData)
+        });
+        if (this.roiFramesRequest !== request) {
+            return false;
+        }
+        if (!res.ok) {
+            this.roiFramesRequest = null;
             $('#video-spinner').hide();
-        })
+            displayTemporaryAlert({msg: 'Error loading video', type: 'danger'});
+            return false;
+        }
+        const roiFrames = await responseToRoiFrames(res);
+        if (this.roiFramesRequest !== request) {
+            return false;
+        }
+        this.roiFramesRequest = null;
+
+        const color = this.selected_roi.color;
+        const outlineColor = this.show_current_roi_outline_on_movie ?
+            `rgb(${color[0]}, ${color[1]}, ${color[2]})` : null;
+        const start = postData.timeframe[0];
+
+        // Same id as the rendered video, so that it is removed the same way
+        const player = $(`
+            <div id="movie">
+                <canvas style="width: 512px; height: 472px; object-fit: contain; image-rendering: pixelated"></canvas>
+                <div class="d-flex align-items-center">
+                    <button type="button" class="btn btn-light btn-sm"></button>
+                    <input type="range" class="form-range mx-2" min="0" max="${roiFrames.nFrames - 1}" value="0">
+                    <span></span>
+                </div>
+            </div>
+        `);
+        const canvas = player.find('canvas')[0];
+        const button = player.find('button');
+        const slider = player.find('input');
+        const frameDisplay = player.find('span');
+
+        let t = 0;
+        const draw = () => {
+            drawRoiFrame(canvas, roiFrames, t, outlineColor);
+            slider.val(t);
+            frameDisplay.text(start + t);
+        };
+        const play = () => {
+            this.roiFramesTimer = setInterval(() => {
+                t = (t + 1) % roiFrames.nFrames;
+                draw();
+            }, 1000 / ROI_FRAMES_FPS);
+            button.text('Pause');
+        };
+        const pause = () => {
+            clearInterval(this.roiFramesTimer);
+            this.roiFramesTimer = null;
+            button.text('Play');
+        };
+        button.on('click', () => {
+            if (this.roiFramesTimer === null) {
+                play();
+            } else {
+                pause();
+            }
+        });
+        slider.on('input', () => {
+            pause();
+            t = parseInt(slider.val());
+            draw();
+        });
+
+        $('#video_container').html(player);
+        draw();
+        play();
+        return true;
+    }
+
+    #stopRoiFrames() {
+        /* Stops playing the ROI frames and drops the request for them in
+        progress, if any */
+        this.roiFramesRequest = null;
+        if (this.roiFramesTimer !== null && this.roiFramesTimer !== undefined) {
+            clearInterval(this.roiFramesTimer);
+        }
+        this.roiFramesTimer = null;
+    }
+
+    async #renderVideo(postData) {
+        /* Submits a background video render job and polls until it
+        finishes.
+
+        Returns
+        --------
+        The job id, or null if rendering failed
+        */
+        let job = await fetch(`http://${SERVER_ADDRESS}/render_video`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(postData)
+        });
+        while (job.status === 503) {
+            // Render queue is full
+            const retryAfter = parseInt(job.headers.get('Retry-After') || '5');
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            job = await fetch(`http://${SERVER_ADDRESS}/render_video`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(postData)
+            });
+        }
+        if (!job.ok) {
+            displayTemporaryAlert({msg: 'Error loading video', type: 'danger'});
+            return null;
+        }
+        job = await job.json();
+        const jobId = job['job_id'];
+        this.videoJobId = jobId;
+
+        let status = job['status'];
+        // The server doesn't wait for the job, so that polling doesn't hold
+        // a worker. Backs off instead
+        let delay = 250;
+        while (status === 'pending' && this.videoJobId === jobId) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 1.5, 2000);
+            const res = await fetch(`http://${SERVER_ADDRESS}/get_video_job_status?job_id=${jobId}&wait=0`);
+            if (res.status === 503) {
+                // Too many concurrent status requests
+                const retryAfter = parseInt(res.headers.get('Retry-After') || '1');
+                delay = Math.max(delay, retryAfter * 1000);
+                continue;
+            }
+            if (!res.ok) {
+                status = 'failed';
+                break;
+            }
+            status = (await res.json())['status'];
+        }
+        if (this.videoJobId !== jobId) {
+            // Cancelled
+            return jobId;
+        }
+        if (status !== 'done') {
+            this.videoJobId = null;
+            displayTemporaryAlert({msg: 'Error loading video', type: 'danger'});
+            return null;
+        }
+        return jobId;
+    }
+
+    cancelVideoJob() {
+        /* Cancels the video render job in progress, if any */
+        if (this.videoJobId === null || this.videoJobId === undefined) {
+            return;
+        }
+        const jobId = this.videoJobId;
+        this.videoJobId = null;
+        fetch(`http://${SERVER_ADDRESS}/cancel_video_job`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({job_id: jobId})
+        });
     }
 
     videoGoToTimesteps() {
@@ -489,9 +707,12 @@ class CellLabelingApp {
     }
 
     async initialize() {
+        this.cancelVideoJob();
+        this.#stopRoiFrames();
         this.show_current_region_roi_contours_on_projection = $('#projection_include_mask_outline').is(':checked');
         this.show_current_roi_outline_on_movie = $('#video_include_mask_outline').is(':checked');
         this.show_all_roi_outlines_on_movie = $('#video_include_surrounding_rois').is(':checked');
+        this.draw_video_frames = $('#video_draw_frames').is(':checked');
         this.is_trace_shown = false;
         this.is_video_shown = false;
         this.rois = null;
@@ -501,6 +722,7 @@ class CellLabelingApp {
         this.experiment_id = null;
         this.projection_is_shown = false;
         this.projection_raw = null;
+        this.projection_stats = null;
         this.region = null;
         this.is_loading_new_region = false;
         this.selected_roi = null;
@@ -514,6 +736,7 @@ class CellLabelingApp {
         // Disable all the video settings (video not loaded yet)
         $('#video_include_mask_outline').attr("disabled", true);
         $('#video_include_surrounding_rois').attr("disabled", true);
+        $('#video_draw_frames').attr("disabled", true);
         $('#trim_video_to_timeframe').attr("disabled", true);
 
         $('#timestep_display').text('');
@@ -573,8 +796,9 @@ class CellLabelingApp {
         this.experiment_id = region['experiment_id'];
 
         const promises = [
-            $.post(`http://${SERVER_ADDRESS}/get_fov_bounds`, JSON.stringify(region['region'])),
-            fetch(`http://${SERVER_ADDRESS}/get_motion_border?experiment_id=${this.experiment_id}`
+            fetchWithRetry(`http://${SERVER_ADDRESS}/get_fov_bounds?experiment_id=${this.experiment_id}&region_id=${this.region['id']}`
+                ).then(data => data.json()),
+            fetch(`http://${SERVER_ADDRESS}/get_motion_border?experiment_id=${this.experiment_id}&region_id=${this.region['id']}`
                 ).then(data => data.json())
         ]
 
@@ -676,20 +900,30 @@ class CellLabelingApp {
 
         this.#updateContrastControls(contrast);
 
-        let x = clipImageToQuantiles(this.projection_raw, contrast.low, contrast.high);
-        x = scaleToUint8(x);
-        x = toRGB(x);
+        const trace1 = this.#getProjectionTrace(contrast);
+
+        const layout = document.getElementById('projection').layout;
+
+        Plotly.react('projection', [trace1], layout);
+    }
+
+    #getProjectionTrace(contrast) {
+        /* Gets the image trace of the projection, contrast-stretched between
+        the `low` and `high` quantiles of `contrast`. The quantiles are looked
+        up in the projection's percentile table, and pixels are mapped through
+        a lookup table, so the projection is not rescanned. */
+        const stats = this.projection_stats;
+        const low = getQuantile(stats, contrast.low);
+        const high = getQuantile(stats, contrast.high);
+        const maxValue = Math.ceil(stats.values[stats.values.length - 1]);
+        const lut = makeContrastLut(low, high, maxValue);
 
-        const trace1 = {
-            z: x,
+        return {
+            z: applyLutToRGB(this.projection_raw.data, this.projection_raw.shape, lut),
             type: 'image',
             // disable hover tooltip
             hoverinfo: 'none'
         };
-
-        const layout = document.getElementById('projection').layout;
-
-        Plotly.react('projection', [trace1], layout);
     }
 
     #updateContrastControls(contrast) {
@@ -858,7 +1092,7 @@ class CellLabelingApp {
         postData = JSON.stringify(postData);
 
 
-        const res = await fetch(`http://${SERVER_ADDRESS}/find_roi_at_coordinates`,
+        const res = await fetchWithRetry(`http://${SERVER_ADDRESS}/find_roi_at_coordinates`,
             {
                 method: 'POST',
                 headers: {
@@ -1,74 +1,249 @@
-function clipImageToQuantiles(img, low_quantile, high_quantile) {
-    /* Clip image to quantiles 
+const TYPED_ARRAYS = {
+    uint8: Uint8Array,
+    uint16: Uint16Array,
+    int16: Int16Array,
+    int32: Int32Array,
+    float32: Float32Array,
+    float64: Float64Array
+};
+
+async function responseToTypedArray(response) {
+    /* Converts a binary array response (application/x-ndarray) to a typed
+    array. The body is the raw little-endian buffer and the dtype and shape are
+    given by the X-Array-Dtype and X-Array-Shape headers.
         Args:
-            - img: Array
-                The img to clip
-            - low_quantile: float
-                low quantile to clip
-            - high_quantile: float
-                high quantile to clip
+            - response: Response
+        Returns:
+            {data: TypedArray, shape: Array}
+    */
+    const dtype = response.headers.get('X-Array-Dtype');
+    const shape = response.headers.get('X-Array-Shape')
+        .split(',')
+        .map(x => parseInt(x));
+    const buffer = await response.arrayBuffer();
+    if (dtype === 'float16') {
+        // There is no Float16Array, so half floats are widened to float32
+        const halves = new Uint16Array(buffer);
+        const data = new Float32Array(halves.length);
+        for (let i = 0; i < halves.length; i++) {
+            data[i] = halfToFloat(halves[i]);
+        }
+        return {data, shape};
+    }
+    if (!TYPED_ARRAYS.hasOwnProperty(dtype)) {
+        throw Error(`Unsupported dtype ${dtype}`);
+    }
+    const data = new TYPED_ARRAYS[dtype](buffer);
+    return {data, shape};
+}
 
+function halfToFloat(h) {
+    /* Converts the bits of an IEEE 754 half precision float to a number
+        Args:
+            - h: int
+                16 bit unsigned integer
     */
-    low_quantile = parseFloat(low_quantile);
-    high_quantile = parseFloat(high_quantile);
+    const sign = (h & 0x8000) ? -1 : 1;
+    const exponent = (h >> 10) & 0x1f;
+    const fraction = h & 0x3ff;
+    if (exponent === 0) {
+        // Subnormal
+        return sign * Math.pow(2, -14) * (fraction / 1024);
+    }
+    if (exponent === 0x1f) {
+        return fraction ? NaN : sign * Infinity;
+    }
+    return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+}
 
-    const [low, high] = math.quantileSeq(img, [low_quantile, high_quantile]);
-    img = img.map(row => {
-        return row.map(x => {
-            if (x <= low) {
-                x = low;
-            } else if (x >= high) {
-                x = high;
-            }
-            return x;
-        });
-    });
-    return img;
+async function responseToRoiFrames(response) {
+    /* Converts a /get_roi_frames response to movie frames
+        Args:
+            - response: Response
+        Returns:
+            {frames: Uint8Array, nFrames: int, height: int, width: int,
+             box: Object, outline: Array}
+            frame t is frames.subarray(t * height * width, (t + 1) * height * width)
+    */
+    const {data, shape} = await responseToTypedArray(response);
+    const [nFrames, height, width] = shape;
+    const box = JSON.parse(response.headers.get('X-Roi-Box'));
+    const outline = JSON.parse(response.headers.get('X-Roi-Outline'));
+    return {frames: data, nFrames, height, width, box, outline};
 }
 
-async function bytesToMatrix(blob, dim = [512, 512]) {
-    /* Converts a bytes representation of a matrix to a matrix 
+function drawRoiFrame(canvas, roiFrames, t, outlineColor = null) {
+    /* Draws a frame returned by responseToRoiFrames on a canvas
         Args:
-            -blob: Blob
-            - dim: Array
-                dimension of the matrix
+            - canvas: HTMLCanvasElement
+                Is resized to the frame size. Scale it with css.
+            - roiFrames: Object
+                See responseToRoiFrames
+            - t: int
+                Frame index
+            - outlineColor: string
+                css color of the ROI outline. The outline is not drawn if
+                null
     */
-    let data = await new Response(blob).arrayBuffer();
-    data = new Uint16Array(data);
-    data = Array.from(data);
-    data = math.matrix(data);
-    data = data.reshape(dim);
-    return data;
+    const {frames, height, width, outline} = roiFrames;
+    canvas.width = width;
+    canvas.height = height;
+    const ctx = canvas.getContext('2d');
+    const frame = frames.subarray(t * height * width, (t + 1) * height * width);
+    const image = ctx.createImageData(width, height);
+    for (let i = 0; i < frame.length; i++) {
+        image.data[4 * i] = frame[i];
+        image.data[4 * i + 1] = frame[i];
+        image.data[4 * i + 2] = frame[i];
+        image.data[4 * i + 3] = 255;
+    }
+    ctx.putImageData(image, 0, 0);
+
+    if (outlineColor !== null) {
+        ctx.strokeStyle = outlineColor;
+        ctx.lineWidth = 1;
+        for (const contour of outline) {
+            ctx.beginPath();
+            contour.forEach(([x, y], i) => {
+                if (i === 0) {
+                    ctx.moveTo(x + 0.5, y + 0.5);
+                } else {
+                    ctx.lineTo(x + 0.5, y + 0.5);
+                }
+            });
+            ctx.closePath();
+            ctx.stroke();
+        }
+    }
 }
 
-function scaleToUint8(X) {
-    /* Scales an input to Uint8 
+function getQuantile(stats, quantile) {
+    /* Looks up a quantile in the percentile table of a projection,
+    interpolating between the percentiles of the table
         Args:
-            - X: Array
-                The array to scale
+            - stats: Object
+                /get_projection_stats response
+            - quantile: float
+                in [0, 1]
+        Returns:
+            The projection value at the quantile
     */
-    const max = math.max(X);
-    const min = math.min(X);
+    const percentiles = stats.percentiles;
+    const values = stats.values;
+    const p = quantile * 100;
+    if (p <= percentiles[0]) {
+        return values[0];
+    }
+    for (let i = 1; i < percentiles.length; i++) {
+        if (p <= percentiles[i]) {
+            const frac = (p - percentiles[i - 1]) / (percentiles[i] - percentiles[i - 1]);
+            return values[i - 1] + frac * (values[i] - values[i - 1]);
+        }
+    }
+    return values[values.length - 1];
+}
 
-    X = X.map(row => {
-        return row.map(x => {
-            return Math.floor((x - min) / (max - min) * 255);
-        });
-    });
-    return X;
+function makeContrastLut(low, high, maxValue) {
+    /* Makes a lookup table from integer pixel value to uint8, which clips
+    to [low, high] and rescales that range to [0, 255]
+        Args:
+            - low: float
+            - high: float
+            - maxValue: int
+                Largest pixel value
+        Returns:
+            Uint8Array of length maxValue + 1
+    */
+    const lut = new Uint8Array(maxValue + 1);
+    for (let x = 0; x <= maxValue; x++) {
+        if (x <= low) {
+            lut[x] = 0;
+        } else if (x >= high) {
+            lut[x] = 255;
+        } else {
+            lut[x] = Math.floor((x - low) / (high - low) * 255);
+        }
+    }
+    return lut;
+}
+
+function applyLutToRGB(data, shape, lut) {
+    /* Maps an integer image through a lookup table and converts it to 3
+    channels
+        Args:
+            - data: TypedArray
+                Image in row-major order
+            - shape: Array
+                [height, width]
+            - lut: Uint8Array
+                See makeContrastLut
+        Returns:
+            Nested array of shape [height, width, 3]
+    */
+    const [height, width] = shape;
+    const rows = new Array(height);
+    for (let i = 0; i < height; i++) {
+        const row = new Array(width);
+        for (let j = 0; j < width; j++) {
+            const x = lut[data[i * width + j]];
+            row[j] = [x, x, x];
+        }
+        rows[i] = row;
+    }
+    return rows;
 }
 
-function toRGB(X) {
-    /* Converts a grayscale input to 3 channels
+function decodeContours(data) {
+    /* Decodes a /get_roi_contours response with the "delta" encoding
         Args:
-            - X: Array
+            - data: Object
+                The response json
+        Returns:
+            The ROIs, each with `contours`: an array of contours, each an
+            array of [x, y] coordinates
     */
-    X = X.map(row => {
-        return row.map(x => {
-            return [x, x, x];
-        });
+    const points = data.points;
+    const contourOffsets = data.contour_offsets;
+    const roiContourOffsets = data.roi_contour_offsets;
+    return data.rois.map((roi, i) => {
+        const contours = [];
+        for (let j = roiContourOffsets[i]; j < roiContourOffsets[i + 1]; j++) {
+            const contour = [];
+            let x = 0;
+            let y = 0;
+            for (let k = contourOffsets[j]; k < contourOffsets[j + 1]; k++) {
+                x += points[2 * k];
+                y += points[2 * k + 1];
+                contour.push([x, y]);
+            }
+            contours.push(contour);
+        }
+        return {...roi, contours};
     });
-    return X;
+}
+
+async function fetchWithRetry(url, options = {}, maxAttempts = 5) {
+    /* Calls fetch, retrying when the server is saturated (503) after the
+    number of seconds given by the Retry-After header
+        Args:
+            - url: string
+            - options: Object
+                fetch options
+            - maxAttempts: int
+                Maximum number of attempts
+        Returns:
+            The last response
+    */
+    let response;
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+        response = await fetch(url, options);
+        if (response.status !== 503) {
+            break;
+        }
+        const retryAfter = parseFloat(response.headers.get('Retry-After') || '2');
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+    }
+    return response;
 }
 
 function displayTemporaryAlert({msg, type, showTime = 5000} = {}) {
@@ -94,9 +269,13 @@ function displayTemporaryAlert({msg, type, showTime = 5000} = {}) {
 }
 
 export {
-    clipImageToQuantiles,
-    bytesToMatrix,
-    scaleToUint8,
-    toRGB,
+    responseToTypedArray,
+    responseToRoiFrames,
+    drawRoiFrame,
+    getQuantile,
+    makeContrastLut,
+    applyLutToRGB,
+    decodeContours,
+    fetchWithRetry,
     displayTemporaryAlert
 }
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""Builds the histogram and percentile table of each projection and stores
+them in the artifact file under the group `projection_stats`. The client's
+contrast controls look up quantiles in the percentile table rather than
+computing them over the projection."""
+import argparse
+import logging
+from pathlib import Path
+from typing import Union
+
+import h5py
+
+from cell_labeling_app.imaging_plane_artifacts import ArtifactFile, \
+    ProjectionStats, PROJECTION_DATASETS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def build_projection_stats(
+        artifact_path: Union[str, Path],
+        overwrite: bool = False):
+    """
+    Computes the stats (see `ProjectionStats`) of every projection in the
+    artifact file and writes them to the group
+    `projection_stats/<projection type>`
+
+    :param artifact_path:
+        Path to artifact file
+    :param overwrite:
+        Whether to rebuild the stats if they already exist
+    :return:
+        None. Writes to the artifact file
+    """
+    with h5py.File(artifact_path, 'r') as f:
+        if 'projection_stats' in f and not overwrite:
+            logger.info(f'{artifact_path} already has projection stats. '
+                        f'Skipping')
+            return
+        projection_types = [
+            projection_type
+            for projection_type, dataset_name in PROJECTION_DATASETS.items()
+            if dataset_name in f]
+
+    af = ArtifactFile(path=artifact_path)
+    stats = {
+        projection_type: ProjectionStats.from_projection(
+            projection=af.get_projection(projection_type=projection_type))
+        for projection_type in projection_types}
+
+    with h5py.File(artifact_path, 'a') as f:
+        if 'projection_stats' in f:
+            del f['projection_stats']
+
+        group = f.create_group('projection_stats')
+        for projection_type, projection_stats in stats.items():
+            subgroup = group.create_group(projection_type)
+            for name, arr in projection_stats.arrays.items():
+                subgroup.create_dataset(name, data=arr)
+    logger.info(f'Built stats of projections {projection_types} in '
+                f'{artifact_path}')
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--artifact_files_dir', required=True,
+                            help='Path to labeling artifact hdf5 files')
+        parser.add_argument('--overwrite', action='store_true',
+                            default=False,
+                            help='Rebuild the stats if they already exist')
+        args = parser.parse_args()
+
+        for path in sorted(Path(args.artifact_files_dir).glob(
+                '*_artifacts.h5')):
+            build_projection_stats(artifact_path=path,
+                                   overwrite=args.overwrite)
+
+    main()
@@ -0,0 +1,88 @@
+"""Builds the per-ROI trace summary index and stores it in the artifact
+file under the group `trace_summary`. This lets the app trim traces and
+compute the default video timeframe without reading the trace data."""
+import argparse
+import logging
+from pathlib import Path
+from typing import Union, Tuple
+
+import h5py
+import numpy as np
+
+from cell_labeling_app.imaging_plane_artifacts import ArtifactFile, \
+    TraceSummary, TRACE_SUMMARY_QUANTILES
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def build_trace_summary(
+        artifact_path: Union[str, Path],
+        overwrite: bool = False,
+        quantiles: Tuple[float, ...] = TRACE_SUMMARY_QUANTILES):
+    """
+    Computes the trace summary for every ROI in the artifact file and writes
+    it to the group `trace_summary`
+
+    :param artifact_path:
+        Path to artifact file
+    :param overwrite:
+        Whether to rebuild the index if it already exists
+    :param quantiles:
+        Quantiles to store in the percentile table
+    :return:
+        None. Writes to the artifact file
+    """
+    with h5py.File(artifact_path, 'r') as f:
+        if 'trace_summary' in f and not overwrite:
+            logger.info(f'{artifact_path} already has a trace summary. '
+                        f'Skipping')
+            return
+
+    af = ArtifactFile(path=artifact_path)
+    roi_ids = af.trace_roi_ids
+    summaries = [
+        TraceSummary.from_trace(trace=trace, quantiles=quantiles)
+        for trace in af.get_traces(roi_ids=roi_ids).values()]
+
+    with h5py.File(artifact_path, 'a') as f:
+        if 'trace_summary' in f:
+            del f['trace_summary']
+
+        group = f.create_group('trace_summary')
+        group.attrs['quantiles'] = np.array(quantiles)
+        group.create_dataset('roi_id', data=np.array(roi_ids, dtype='int64'))
+        for name in ('argmax', 'first_nonzero', 'last_nonzero'):
+            group.create_dataset(
+                name,
+                data=np.array([getattr(x, name) for x in summaries],
+                              dtype='int64'))
+        for name in ('min', 'max'):
+            group.create_dataset(
+                name,
+                data=np.array([getattr(x, name) for x in summaries],
+                              dtype='float64'))
+        group.create_dataset(
+            'percentiles',
+            data=np.array([[x.percentiles[q] for q in quantiles]
+                           for x in summaries], dtype='float64').reshape(
+                len(summaries), len(quantiles)))
+    logger.info(f'Built trace summary for {len(roi_ids)} ROIs in '
+                f'{artifact_path}')
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--artifact_files_dir', required=True,
+                            help='Path to labeling artifact hdf5 files')
+        parser.add_argument('--overwrite', action='store_true',
+                            default=False,
+                            help='Rebuild the index if it already exists')
+        args = parser.parse_args()
+
+        for path in sorted(Path(args.artifact_files_dir).glob(
+                '*_artifacts.h5')):
+            build_trace_summary(artifact_path=path, overwrite=args.overwrite)
+
+    main()
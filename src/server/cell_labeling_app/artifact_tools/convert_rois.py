@@ -0,0 +1,97 @@
+"""Converts the ROIs in an artifact file from a json string (`rois`), whose
+masks are nested lists of booleans, to the `roi_table` group. This stores
+the bounding boxes as integer columns and the masks as concatenated
+bit-packed buffers with offsets (see `RoiTable`), which is much smaller and
+faster to read."""
+import argparse
+import json
+import logging
+import shutil
+from pathlib import Path
+from typing import Union, Optional
+
+import h5py
+import numpy as np
+
+from cell_labeling_app.imaging_plane_artifacts import RoiTable, \
+    ROI_TABLE_COLUMNS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def convert_rois_to_table(
+        artifact_path: Union[str, Path],
+        output_path: Optional[Union[str, Path]] = None,
+        remove_json_rois: bool = True):
+    """
+    Converts the ROIs to the roi table format
+
+    :param artifact_path:
+        Path to artifact file
+    :param output_path:
+        If given, the artifact file is copied here and the copy is converted.
+        Otherwise the artifact file is converted in place
+    :param remove_json_rois:
+        Whether to delete the `rois` dataset once the table is written.
+        Note that hdf5 does not reclaim the space in place; use `h5repack`
+        or `output_path` to shrink the file.
+    :return:
+        None
+    :raises ValueError:
+        If the table does not hold the same ROIs as the json
+    """
+    if output_path is not None:
+        shutil.copy2(artifact_path, output_path)
+        artifact_path = output_path
+
+    with h5py.File(artifact_path, 'a') as f:
+        if 'rois' not in f:
+            logger.info(f'{artifact_path} has no json rois. Skipping')
+            return
+        rois = json.loads(f['rois'][()])
+        table = RoiTable.from_rois(rois=rois)
+
+        for i, roi in enumerate(rois):
+            if not np.array_equal(table.get_mask(index=i),
+                                  np.array(roi['mask'], dtype=bool)):
+                raise ValueError(f'Mask of roi {roi["id"]} in '
+                                 f'{artifact_path} was not converted '
+                                 f'correctly')
+
+        if 'roi_table' in f:
+            del f['roi_table']
+        group = f.create_group('roi_table')
+        for name in ROI_TABLE_COLUMNS:
+            group.create_dataset(name, data=table.arrays[name])
+
+        if remove_json_rois:
+            del f['rois']
+    logger.info(f'Converted {len(rois)} rois in {artifact_path}')
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--artifact_files_dir', required=True,
+                            help='Path to labeling artifact hdf5 files')
+        parser.add_argument('--output_dir',
+                            help='If given, converted copies are written '
+                                 'here. Otherwise files are converted in '
+                                 'place')
+        parser.add_argument('--keep_json_rois', action='store_true',
+                            default=False,
+                            help='Keep the rois json dataset, e.g. for '
+                                 'tools which read it directly')
+        args = parser.parse_args()
+
+        for path in sorted(Path(args.artifact_files_dir).glob(
+                '*_artifacts.h5')):
+            output_path = Path(args.output_dir) / path.name \
+                if args.output_dir is not None else None
+            convert_rois_to_table(
+                artifact_path=path,
+                output_path=output_path,
+                remove_json_rois=not args.keep_json_rois)
+
+    main()
@@ -0,0 +1,105 @@
+"""Converts the precomputed traces in an artifact file from one dataset per
+ROI (`traces/{roi_id}`) to a single chunked `(n_rois, n_frames)` dataset
+`trace_matrix`, with the ROI id of each row stored in
+`trace_matrix_roi_ids`. Reading the traces of many ROIs is then a single
+hyperslab read."""
+import argparse
+import logging
+import shutil
+from pathlib import Path
+from typing import Union, Optional
+
+import h5py
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def convert_traces_to_matrix(
+        artifact_path: Union[str, Path],
+        output_path: Optional[Union[str, Path]] = None,
+        remove_per_roi_traces: bool = True,
+        rois_per_chunk: int = 16,
+        frames_per_chunk: int = 8192):
+    """
+    Converts traces to the trace matrix format
+
+    :param artifact_path:
+        Path to artifact file
+    :param output_path:
+        If given, the artifact file is copied here and the copy is converted.
+        Otherwise the artifact file is converted in place
+    :param remove_per_roi_traces:
+        Whether to delete the `traces` group once the matrix is written.
+        Note that hdf5 does not reclaim the space in place; use `h5repack`
+        or `output_path` to shrink the file.
+    :param rois_per_chunk:
+        Chunk size along the roi axis
+    :param frames_per_chunk:
+        Chunk size along the time axis
+    :return:
+        None
+    :raises ValueError:
+        If the traces do not all have the same length
+    """
+    if output_path is not None:
+        shutil.copy2(artifact_path, output_path)
+        artifact_path = output_path
+
+    with h5py.File(artifact_path, 'a') as f:
+        if 'traces' not in f:
+            logger.info(f'{artifact_path} has no per-roi traces. Skipping')
+            return
+        roi_ids = sorted([int(roi_id) for roi_id in f['traces']])
+        lengths = set([f['traces'][str(roi_id)].shape[0]
+                       for roi_id in roi_ids])
+        if len(lengths) > 1:
+            raise ValueError(f'Traces in {artifact_path} have different '
+                             f'lengths {sorted(lengths)}')
+        n_frames = lengths.pop() if lengths else 0
+        dtype = f['traces'][str(roi_ids[0])].dtype if roi_ids else 'float32'
+
+        if 'trace_matrix' in f:
+            del f['trace_matrix']
+            del f['trace_matrix_roi_ids']
+        chunks = (max(1, min(rois_per_chunk, len(roi_ids))),
+                  max(1, min(frames_per_chunk, n_frames)))
+        matrix = f.create_dataset('trace_matrix',
+                                  shape=(len(roi_ids), n_frames),
+                                  dtype=dtype,
+                                  chunks=chunks)
+        for row, roi_id in enumerate(roi_ids):
+            matrix[row] = f['traces'][str(roi_id)][()]
+        f.create_dataset('trace_matrix_roi_ids',
+                         data=np.array(roi_ids, dtype='int64'))
+
+        if remove_per_roi_traces:
+            del f['traces']
+    logger.info(f'Converted {len(roi_ids)} traces in {artifact_path}')
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--artifact_files_dir', required=True,
+                            help='Path to labeling artifact hdf5 files')
+        parser.add_argument('--output_dir',
+                            help='If given, converted copies are written '
+                                 'here. Otherwise files are converted in '
+                                 'place')
+        parser.add_argument('--keep_per_roi_traces', action='store_true',
+                            default=False,
+                            help='Keep the traces/{roi_id} datasets')
+        args = parser.parse_args()
+
+        for path in sorted(Path(args.artifact_files_dir).glob(
+                '*_artifacts.h5')):
+            output_path = Path(args.output_dir) / path.name \
+                if args.output_dir is not None else None
+            convert_traces_to_matrix(
+                artifact_path=path,
+                output_path=output_path,
+                remove_per_roi_traces=not args.keep_per_roi_traces)
+
+    main()
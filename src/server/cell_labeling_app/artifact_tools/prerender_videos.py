@@ -0,0 +1,225 @@
+"""Pre-renders the default thumbnail video of every ROI in every region of a
+labeling job into the video cache, so that the first time a labeler views an
+ROI video it is a cache hit.
+
+The videos are rendered with the same options the client requests by
+default, and so have the same cache keys as videos rendered by the app. The
+app and this tool must therefore be given the same artifact files,
+predictions and VIDEO_STREAMABLE_FORMAT. Videos that are already cached are
+skipped, so an interrupted run can be resumed by running it again. A
+manifest listing the videos of the job is written to the video cache
+directory."""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Dict, Optional, Union
+
+from flask import Flask
+from sqlalchemy import desc
+
+from cell_labeling_app.database.database import db
+from cell_labeling_app.database.schemas import JobRegion, LabelingJob
+from cell_labeling_app.util import util
+from cell_labeling_app.util.video_cache import VideoCache, \
+    make_video_cache_key, TMP_PREFIX
+from cell_labeling_app.util.video_rendering import render_thumbnail_video
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_job_videos(job_id: int,
+                   streamable: Optional[str]) -> List[Dict]:
+    """
+    Gets the default videos of every ROI in every region of a labeling job.
+    Must be called within an app context.
+
+    :param job_id:
+        Labeling job id
+    :param streamable:
+        VIDEO_STREAMABLE_FORMAT of the app
+    :return:
+        list of dict with keys
+            - region_id
+            - experiment_id
+            - roi_id
+            - key: video cache key
+            - video_kwargs: kwargs passed to `render_thumbnail_video`
+    """
+    regions = (db.session.query(JobRegion)
+               .filter(JobRegion.job_id == job_id)
+               .order_by(JobRegion.id)
+               .all())
+    videos = []
+    for region in regions:
+        video_kwargs = util.get_default_thumbnail_video_kwargs(region=region)
+        for roi_id, kwargs in video_kwargs.items():
+            videos.append({
+                'region_id': region.id,
+                'experiment_id': region.experiment_id,
+                'roi_id': roi_id,
+                'key': make_video_cache_key(streamable=streamable, **kwargs),
+                'video_kwargs': kwargs
+            })
+    return videos
+
+
+def prerender_videos(videos: List[Dict],
+                     video_cache: VideoCache,
+                     streamable: Optional[str],
+                     n_processes: int = 1) -> Dict[str, int]:
+    """
+    Renders the videos that are not already cached
+
+    :param videos:
+        Output of `get_job_videos`
+    :param video_cache:
+        Video cache to render into
+    :param streamable:
+        VIDEO_STREAMABLE_FORMAT of the app
+    :param n_processes:
+        Number of processes rendering videos
+    :return:
+        dict with the number of videos "rendered", "skipped" and "failed"
+    """
+    counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+    to_render = []
+    for video in videos:
+        if video_cache.get_path(key=video['key']).exists():
+            counts['skipped'] += 1
+        else:
+            to_render.append(video)
+    logger.info(f'{counts["skipped"]} of {len(videos)} videos are already '
+                f'cached. Rendering {len(to_render)}')
+
+    with ProcessPoolExecutor(
+            max_workers=n_processes,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {
+            executor.submit(
+                _render,
+                cache_dir=video_cache.cache_dir,
+                max_bytes=video_cache.max_bytes,
+                streamable=streamable,
+                video_kwargs=video['video_kwargs']): video
+            for video in to_render}
+        for i, future in enumerate(as_completed(futures)):
+            video = futures[future]
+            try:
+                future.result()
+                counts['rendered'] += 1
+            except Exception:
+                logger.exception(
+                    f'Failed to render video for roi {video["roi_id"]} in '
+                    f'region {video["region_id"]}')
+                counts['failed'] += 1
+            if (i + 1) % 100 == 0:
+                logger.info(f'Rendered {i + 1} of {len(to_render)} videos')
+    return counts
+
+
+def write_manifest(path: Union[str, Path], job_id: int,
+                   videos: List[Dict], video_cache: VideoCache):
+    """
+    Writes a json manifest of the job's videos and whether each is cached
+
+    :param path:
+        Manifest path
+    :param job_id:
+        Labeling job id
+    :param videos:
+        Output of `get_job_videos`
+    :param video_cache:
+        Video cache the videos were rendered into
+    """
+    manifest = {
+        'job_id': job_id,
+        'videos': [{
+            'region_id': video['region_id'],
+            'experiment_id': video['experiment_id'],
+            'roi_id': video['roi_id'],
+            'timeframe': [int(video['video_kwargs']['timesteps'][0]),
+                          int(video['video_kwargs']['timesteps'][-1]) + 1],
+            'key': video['key'],
+            'cached': video_cache.get_path(key=video['key']).exists()
+        } for video in videos]
+    }
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=TMP_PREFIX)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _render(cache_dir: Path, max_bytes: int, streamable: Optional[str],
+            video_kwargs: dict):
+    """Renders a video into the cache. Runs in a pool process."""
+    video_cache = VideoCache(cache_dir=cache_dir, max_bytes=max_bytes)
+    render_thumbnail_video(video_cache=video_cache, streamable=streamable,
+                           **video_kwargs)
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--sqlalchemy_database_uri', required=True,
+            help='Database URI. See '
+                 'https://docs.sqlalchemy.org/en/20/core/engines.html')
+        parser.add_argument('--job_id', type=int,
+                            help='Labeling job id. Defaults to the most '
+                                 'recent job')
+        parser.add_argument('--artifact_files_dir', required=True,
+                            help='Path to labeling artifact hdf5 files. '
+                                 'Must be the ARTIFACT_DIR of the app')
+        parser.add_argument('--predictions_dir', required=True,
+                            help='Must be the PREDICTIONS_DIR of the app')
+        parser.add_argument('--video_cache_dir', required=True,
+                            help='Must be the VIDEO_CACHE_DIR of the app')
+        parser.add_argument('--video_cache_max_bytes', type=int,
+                            default=10 * 1024 ** 3,
+                            help='Must be the VIDEO_CACHE_MAX_BYTES of the '
+                                 'app. Older videos are evicted once the '
+                                 'cache grows beyond this')
+        parser.add_argument('--streamable_format', default='faststart',
+                            choices=('faststart', 'fragmented', 'none'),
+                            help='Must be the VIDEO_STREAMABLE_FORMAT of the '
+                                 'app')
+        parser.add_argument('--n_processes', type=int,
+                            default=os.cpu_count(),
+                            help='Number of processes rendering videos')
+        args = parser.parse_args()
+
+        streamable = None if args.streamable_format == 'none' else \
+            args.streamable_format
+        video_cache = VideoCache(cache_dir=args.video_cache_dir,
+                                 max_bytes=args.video_cache_max_bytes)
+
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.sqlalchemy_database_uri
+        app.config['ARTIFACT_DIR'] = args.artifact_files_dir
+        app.config['PREDICTIONS_DIR'] = args.predictions_dir
+        db.init_app(app)
+        with app.app_context():
+            job_id = args.job_id
+            if job_id is None:
+                job_id = db.session.query(LabelingJob.job_id).order_by(desc(
+                    LabelingJob.date)).first()[0]
+            videos = get_job_videos(job_id=job_id, streamable=streamable)
+
+        counts = prerender_videos(videos=videos, video_cache=video_cache,
+                                  streamable=streamable,
+                                  n_processes=args.n_processes)
+        manifest_path = video_cache.cache_dir / f'job_{job_id}_manifest.json'
+        write_manifest(path=manifest_path, job_id=job_id, videos=videos,
+                       video_cache=video_cache)
+        logger.info(f'{counts}. Wrote manifest to {manifest_path}')
+        if counts['failed'] > 0:
+            logger.warning('Some videos failed to render. Run again to retry')
+
+    main()
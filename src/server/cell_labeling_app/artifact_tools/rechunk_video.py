@@ -0,0 +1,229 @@
+"""Rewrites `video_data` in an artifact file with spatially tiled chunks of
+shape `(frames_per_chunk, tile_size, tile_size)`.
+
+Thumbnail videos, ROI frames and the traces of user-added ROIs read small
+spatial crops over many frames. With chunks spanning whole frames, each
+crop read pulls whole frames from disk. With tiled chunks, only the tiles
+overlapping the crop are read.
+
+The rewritten file is verified to hold the same video, and the number of
+bytes read from disk for a typical crop is reported before and after."""
+import argparse
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COMPRESSION_OPTIONS = ('lzf', 'gzip')
+
+
+def rechunk_video(
+        artifact_path: Union[str, Path],
+        output_path: Optional[Union[str, Path]] = None,
+        frames_per_chunk: int = 128,
+        tile_size: int = 32,
+        compression: Optional[str] = None,
+        frames_per_read: int = 1024,
+        verify: bool = True) -> Dict[str, float]:
+    """
+    Rewrites `video_data` with tiled chunks. All other datasets and groups
+    are copied as is. The file is written to a temporary file which then
+    replaces the output, so the artifact file is never partially written,
+    and the space of the old video is reclaimed.
+
+    :param artifact_path:
+        Path to artifact file
+    :param output_path:
+        If given, the rewritten file is written here. Otherwise the artifact
+        file is replaced
+    :param frames_per_chunk:
+        Chunk size along the time axis
+    :param tile_size:
+        Chunk size along both spatial axes
+    :param compression:
+        Compression filter, one of `COMPRESSION_OPTIONS`, or None for no
+        compression. lzf is fast to decompress
+    :param frames_per_read:
+        Number of frames copied at a time. Bounds memory use. Rounded to a
+        multiple of frames_per_chunk
+    :param verify:
+        Whether to check that the rewritten video is equal to the original
+    :return:
+        Mean bytes read per crop (see `get_mean_crop_read_bytes`), with keys
+        "before" and "after"
+    :raises ValueError:
+        If the rewritten video is not equal to the original
+    """
+    if compression is not None and compression not in COMPRESSION_OPTIONS:
+        raise ValueError(f'compression must be one of {COMPRESSION_OPTIONS}')
+    artifact_path = Path(artifact_path)
+    output_path = Path(output_path) if output_path is not None \
+        else artifact_path
+    frames_per_read = frames_per_chunk * max(
+        1, frames_per_read // frames_per_chunk)
+
+    fd, tmp_path = tempfile.mkstemp(dir=output_path.parent,
+                                    prefix=f'.{output_path.name}.',
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        with h5py.File(artifact_path, 'r') as src, \
+                h5py.File(tmp_path, 'w') as dst:
+            for k, v in src.attrs.items():
+                dst.attrs[k] = v
+            for name in src:
+                if name != 'video_data':
+                    src.copy(src[name], dst, name=name)
+
+            video = src['video_data']
+            n_frames, height, width = video.shape
+            chunks = (max(1, min(frames_per_chunk, n_frames)),
+                      max(1, min(tile_size, height)),
+                      max(1, min(tile_size, width)))
+            out = dst.create_dataset('video_data',
+                                     shape=video.shape,
+                                     dtype=video.dtype,
+                                     chunks=chunks,
+                                     compression=compression)
+            for k, v in video.attrs.items():
+                out.attrs[k] = v
+            for start in range(0, n_frames, frames_per_read):
+                end = min(start + frames_per_read, n_frames)
+                out[start:end] = video[start:end]
+
+            if verify:
+                for start in range(0, n_frames, frames_per_read):
+                    end = min(start + frames_per_read, n_frames)
+                    if not np.array_equal(video[start:end],
+                                          out[start:end]):
+                        raise ValueError(
+                            f'Rewritten video differs from {artifact_path} '
+                            f'in frames {start} to {end}')
+
+            read_bytes = {
+                'before': get_mean_crop_read_bytes(dataset=video),
+                'after': get_mean_crop_read_bytes(dataset=out)
+            }
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info(f'Rechunked video_data of {artifact_path} to {chunks}. '
+                f'Mean bytes read per crop: {read_bytes["before"]:.0f} '
+                f'before, {read_bytes["after"]:.0f} after')
+    return read_bytes
+
+
+def get_crop_read_bytes(dataset: h5py.Dataset,
+                        crop: Tuple[slice, slice, slice]) -> int:
+    """
+    Number of bytes read from the file to read `crop` of `dataset`. For a
+    chunked dataset, every chunk overlapping the crop is read in full, as
+    stored (i.e. compressed). A contiguous dataset reads only the crop.
+
+    :param dataset:
+        3d dataset
+    :param crop:
+        Slices along each axis, with explicit start and stop
+    :return:
+        Number of bytes
+    """
+    if dataset.chunks is None:
+        return int(np.prod([s.stop - s.start for s in crop]) *
+                   dataset.dtype.itemsize)
+
+    chunk_ranges = [range(s.start // c * c, s.stop, c)
+                    for s, c in zip(crop, dataset.chunks)]
+    chunk_nbytes = int(np.prod(dataset.chunks)) * dataset.dtype.itemsize
+    n_bytes = 0
+    for t in chunk_ranges[0]:
+        for y in chunk_ranges[1]:
+            for x in chunk_ranges[2]:
+                try:
+                    info = dataset.id.get_chunk_info_by_coord((t, y, x))
+                    n_bytes += info.size
+                except (AttributeError, KeyError, ValueError):
+                    # Chunk not written, or the hdf5 library can't tell
+                    n_bytes += chunk_nbytes
+    return n_bytes
+
+
+def get_mean_crop_read_bytes(dataset: h5py.Dataset,
+                             crop_size: int = 96,
+                             n_frames: int = 600,
+                             n_crops: int = 20,
+                             seed: int = 0) -> float:
+    """
+    Mean of `get_crop_read_bytes` over random crops the size of a typical
+    thumbnail video (an ROI plus padding, over 600 frames)
+
+    :param dataset:
+        3d dataset
+    :param crop_size:
+        Height and width of each crop
+    :param n_frames:
+        Number of frames of each crop
+    :param n_crops:
+        Number of crops
+    :param seed:
+        Seed of the crop locations
+    :return:
+        Mean number of bytes
+    """
+    rng = np.random.default_rng(seed)
+    shape = dataset.shape
+    size = (min(n_frames, shape[0]), min(crop_size, shape[1]),
+            min(crop_size, shape[2]))
+    n_bytes = []
+    for _ in range(n_crops):
+        starts = [int(rng.integers(0, shape[i] - size[i] + 1))
+                  for i in range(3)]
+        crop = tuple([slice(start, start + size[i])
+                      for i, start in enumerate(starts)])
+        n_bytes.append(get_crop_read_bytes(dataset=dataset, crop=crop))
+    return float(np.mean(n_bytes))
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--artifact_files_dir', required=True,
+                            help='Path to labeling artifact hdf5 files')
+        parser.add_argument('--output_dir',
+                            help='If given, rewritten copies are written '
+                                 'here. Otherwise files are replaced')
+        parser.add_argument('--frames_per_chunk', type=int, default=128,
+                            help='Chunk size along the time axis')
+        parser.add_argument('--tile_size', type=int, default=32,
+                            help='Chunk size along both spatial axes')
+        parser.add_argument('--compression', choices=COMPRESSION_OPTIONS,
+                            default=None,
+                            help='Compression filter. Uncompressed if not '
+                                 'given')
+        parser.add_argument('--skip_verify', action='store_true',
+                            default=False,
+                            help="Don't check that the rewritten video is "
+                                 "equal to the original")
+        args = parser.parse_args()
+
+        for path in sorted(Path(args.artifact_files_dir).glob(
+                '*_artifacts.h5')):
+            output_path = Path(args.output_dir) / path.name \
+                if args.output_dir is not None else None
+            rechunk_video(
+                artifact_path=path,
+                output_path=output_path,
+                frames_per_chunk=args.frames_per_chunk,
+                tile_size=args.tile_size,
+                compression=args.compression,
+                verify=not args.skip_verify)
+
+    main()
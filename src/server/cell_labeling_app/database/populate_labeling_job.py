@@ -14,6 +14,7 @@ from cell_labeling_app.database.database import db
 from cell_labeling_app.database.schemas import LabelingJob, JobRegion
 
 from cell_labeling_app.imaging_plane_artifacts import MotionBorder
+from cell_labeling_app.util.region_bundles import build_region_bundles
 
 FIELD_OF_VIEW_DIMENSIONS = (512, 512)
 
@@ -307,7 +308,7 @@ class RegionSampler:
 def populate_labeling_job(
     name: str,
     regions: List[Region]
-):
+) -> int:
     """
     Creates a new labeling job
     :param name
@@ -315,7 +316,7 @@ def populate_labeling_job(
     :param regions
         List of regions to add to the labeling job
     :return:
-        None. Inserts records into the DB
+        The labeling job id. Inserts records into the DB
     """
     job = LabelingJob(name=name)
     db.session.add(job)
@@ -334,6 +335,7 @@ def populate_labeling_job(
 
     num_added = db.session.query(JobRegion).filter_by(job_id=job_id).count()
     logger.info(f'Number of regions added to labeling job: {num_added}')
+    return job_id
 
 
 if __name__ == '__main__':
@@ -403,8 +405,25 @@ if __name__ == '__main__':
                             help='Seed value for the random number generator.',
                             default=1234,
                             type=int)
+        parser.add_argument('--region_bundle_dir',
+                            help='If given, precomputed region bundles are '
+                                 'written to this directory. Set it as '
+                                 'REGION_BUNDLE_DIR of the app. Requires '
+                                 '--predictions_dir')
+        parser.add_argument('--predictions_dir',
+                            help='PREDICTIONS_DIR of the app')
+        parser.add_argument('--n_processes',
+                            help='Number of processes building region '
+                                 'bundles',
+                            default=os.cpu_count(),
+                            type=int)
         args = parser.parse_args()
 
+        if args.region_bundle_dir is not None and \
+                args.predictions_dir is None:
+            raise ValueError('--predictions_dir is required to build region '
+                             'bundles')
+
         if (args.LIMS_user is None or args.LIMS_password is None) and \
            args.external_experiment_ids is None:
             raise ValueError("No LIMS credentials set and no external "
@@ -435,8 +454,18 @@ if __name__ == '__main__':
         regions = sampler.sample(
             exclude_motion_border=args.exclude_motion_border,
         )
-        populate_labeling_job(
+        job_id = populate_labeling_job(
             name=args.labeling_job_name,
             regions=regions)
 
+        if args.region_bundle_dir is not None:
+            job_regions = (db.session.query(JobRegion)
+                           .filter(JobRegion.job_id == job_id)
+                           .all())
+            build_region_bundles(regions=job_regions,
+                                 bundle_dir=args.region_bundle_dir,
+                                 artifact_dir=artifacts_dir,
+                                 predictions_dir=args.predictions_dir,
+                                 n_processes=args.n_processes)
+
     main()
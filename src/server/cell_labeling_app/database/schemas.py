@@ -73,3 +73,13 @@ class UserRoiExtra(db.Model):
     roi_id = db.Column(db.Integer, primary_key=True)
     notes = db.Column(db.String)
     timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+class PrefetchedRegion(db.Model):
+    """A region assigned ahead of time to a user, to be labeled after the
+    region they are currently labeling"""
+    user_id = db.Column(db.String, db.ForeignKey(User.id), primary_key=True)
+    region_id = db.Column(db.Integer, db.ForeignKey(JobRegion.id),
+                          primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey(LabelingJob.job_id))
+    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
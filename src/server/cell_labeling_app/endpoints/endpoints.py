@@ -1,18 +1,31 @@
 import json
-from io import BytesIO
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, Optional
 
 import numpy as np
-from PIL import Image
 from flask import render_template, request, send_file, Blueprint, \
-    current_app
+    current_app, make_response
 from flask_login import current_user, login_required
-from ophys_etl.modules.roi_cell_classifier.video_utils import (
-    get_thumbnail_video_from_artifact_file)
 
 from cell_labeling_app.database.database import db
 from cell_labeling_app.database.schemas import JobRegion, \
     UserLabels, UserRoiExtra, LabelingJob
-from cell_labeling_app.util import util
+from cell_labeling_app.util import util, prefetch, projections, warmup
+from cell_labeling_app.util.admission import admission_controlled, admit, \
+    AdmissionRejectedError, get_admission_pools
+from cell_labeling_app.util.deadline import TaskTimeoutError, bound_timeout
+from cell_labeling_app.util.executor import run_in_process
+from cell_labeling_app.util.http_caching import http_cached
+from cell_labeling_app.util.region_bundles import get_region_bundle
+from cell_labeling_app.util.video_cache import get_video_cache
+from cell_labeling_app.util.video_rendering import \
+    render_thumbnail_video, get_video_render_queue, RenderQueueFullError, \
+    is_valid_job_id
+from cell_labeling_app.util.contour_encoding import CONTOUR_ENCODINGS, \
+    encode_contours
+from cell_labeling_app.util.array_transport import client_accepts_array, \
+    client_accepts_compression, make_array_response
 from cell_labeling_app.util.util import get_artifacts_path, \
     get_user_has_labeled, get_completed_regions, \
     get_total_regions_in_labeling_job, create_roi_from_contours
@@ -21,6 +34,13 @@ from cell_labeling_app.util.util import get_next_region
 
 api = Blueprint(name='api', import_name=__name__)
 
+# Maximum number of frames returned by `get_roi_frames`
+MAX_ROI_FRAMES = 3000
+
+# Maximum number of seconds `get_video_job_status` waits for a job, with the
+# gthread worker class
+MAX_VIDEO_JOB_STATUS_WAIT = 5
+
 
 @api.route('/')
 def index():
@@ -38,24 +58,72 @@ def index():
         )
 
 
+@api.route('/ready')
+def ready():
+    """Readiness check. Returns the cache warm-up progress, with status 503
+    while the caches are being warmed"""
+    status = warmup.get_warmup_status()
+    return status, 200 if status['state'] != 'running' else 503
+
+
 @api.route('/done.html')
 @login_required
 def done():
     return render_template('done.html')
 
 
+def _get_artifact_identity() -> Dict:
+    """What responses derived from the artifact file depend on. See
+    `http_cached`"""
+    return {
+        'artifact': util.get_artifact_identity(
+            experiment_id=request.args['experiment_id'])
+    }
+
+
+def _get_artifact_and_predictions_identity() -> Dict:
+    """What responses derived from the artifact and predictions files
+    depend on. See `http_cached`"""
+    experiment_id = request.args['experiment_id']
+    return {
+        'artifact': util.get_artifact_identity(experiment_id=experiment_id),
+        'predictions': util.get_predictions_identity(
+            experiment_id=experiment_id)
+    }
+
+
 @api.route('/get_roi_contours')
 @login_required
+@http_cached(identity=_get_artifact_and_predictions_identity)
 def get_roi_contours():
+    """Returns the contours of the ROIs in the region. Optional query args:
+        - encoding: "nested" (default), lists of x, y coordinates per
+            contour, or "delta", the compact encoding of `contour_encoding`
+        - tolerance: simplification tolerance of the "delta" encoding, in
+            pixels. At the default of 0 the outlines are unchanged
+    """
     experiment_id = request.args['experiment_id']
     current_region_id = request.args['current_region_id']
     current_region_id = int(current_region_id)
+    encoding = request.args.get('encoding', 'nested')
+    if encoding not in CONTOUR_ENCODINGS:
+        return f'bad encoding {encoding}', 400
+    tolerance = float(request.args.get('tolerance', 0))
+    if tolerance < 0:
+        return f'bad tolerance {tolerance}', 400
 
     region = (db.session.query(JobRegion)
               .filter(JobRegion.id == current_region_id)
               .first())
-    all_contours = util.get_roi_contours_in_region(experiment_id=experiment_id,
-                                                   region=region)
+    bundle = get_region_bundle(region=region)
+    if bundle is not None:
+        all_contours = bundle['contours']
+    else:
+        with admit(pool='region_artifacts'):
+            all_contours = util.get_roi_contours_in_region(
+                experiment_id=experiment_id, region=region)
+    if encoding == 'delta':
+        return encode_contours(rois=all_contours, tolerance=tolerance)
     return {
         'contours': all_contours
     }
@@ -64,8 +132,19 @@ def get_roi_contours():
 @api.route("/get_random_region")
 @login_required
 def get_random_region():
+    """Gets the next region to label, from the user's prefetch queue if
+    possible. Then refills the queue in the background (see `prefetch`)"""
     job_id = int(request.args['job_id'])
-    next_region = get_next_region(job_id=job_id)
+    user_id = current_user.get_id()
+    next_region = None
+    if current_app.config.get('PREFETCH_QUEUE_SIZE'):
+        next_region = prefetch.pop_prefetched_region(job_id=job_id,
+                                                     user_id=user_id)
+    if next_region is None:
+        next_region = get_next_region(job_id=job_id)
+    prefetch.schedule_prefetch(
+        job_id=job_id, user_id=user_id,
+        current_region_id=next_region.id if next_region else None)
     if not next_region:
         # No more to label
         return {
@@ -82,51 +161,128 @@ def get_random_region():
 
 @api.route('/get_projection')
 @login_required
+@http_cached(identity=_get_artifact_identity)
 def get_projection():
+    """Returns the projection as a binary array (see `array_transport`), or
+    as a PNG if the `format` arg is "png". Optional query args:
+        - dtype: "uint16" (default) or "uint8", which rescales to [0, 255]
+        - low_quantile, high_quantile: clip to these quantiles of the whole
+            projection and rescale to uint8, using precomputed percentiles
+        - region_id: crop to the FOV bounds of the region. The crop is given
+            as json in the X-Projection-Box header
+        - compress: see `array_transport`
+    """
     projection_type = request.args['type']
     experiment_id = request.args['experiment_id']
+    dtype = request.args.get('dtype', 'uint16')
+    if dtype not in ('uint16', 'uint8'):
+        return f'bad dtype {dtype}', 400
+    image_format = request.args.get('format', 'array')
+    if image_format not in ('array', 'png'):
+        return f'bad format {image_format}', 400
+    quantiles = None
+    if 'low_quantile' in request.args or 'high_quantile' in request.args:
+        quantiles = (float(request.args.get('low_quantile', 0)),
+                     float(request.args.get('high_quantile', 1)))
+        if not 0 <= quantiles[0] <= quantiles[1] <= 1:
+            return f'bad quantiles {quantiles}', 400
 
-    artifact_path = get_artifacts_path(experiment_id=experiment_id)
-
-    af = ArtifactFile(path=artifact_path)
     try:
-        projection = af.get_projection(projection_type=projection_type)
+        projection = util.get_projection(experiment_id=experiment_id,
+                                         projection_type=projection_type)
     except ValueError as e:
-        return e, 400
-
-    image = Image.fromarray(projection)
-    image = image.tobytes()
-    return send_file(
-        BytesIO(image),
-        mimetype='image/png')
+        return str(e), 400
+
+    box = None
+    if 'region_id' in request.args:
+        region = util.get_region(region_id=int(request.args['region_id']))
+        box = projections.get_crop_box(
+            fov_bounds=_get_fov_bounds(region=region,
+                                       experiment_id=experiment_id),
+            shape=projection.shape)
+    headers = {'X-Projection-Box': json.dumps(
+        box if box is not None else
+        {'x': 0, 'y': 0, 'width': projection.shape[1],
+         'height': projection.shape[0]})}
+
+    if image_format == 'png':
+        png = projections.get_projection_png(
+            experiment_id=experiment_id, projection_type=projection_type,
+            box=box, dtype=dtype, quantiles=quantiles)
+        response = make_response(png)
+        response.mimetype = 'image/png'
+        response.headers.update(headers)
+        response.headers['Access-Control-Expose-Headers'] = \
+            'X-Projection-Box'
+        return response
+
+    image = projections.get_projection_image(
+        experiment_id=experiment_id, projection_type=projection_type,
+        box=box, dtype=dtype, quantiles=quantiles)
+    return make_array_response(
+        image,
+        compress=client_accepts_compression(request=request),
+        headers=headers)
+
+
+@api.route('/get_projection_stats')
+@login_required
+@http_cached(identity=_get_artifact_identity)
+def get_projection_stats():
+    """Returns the histogram and percentile table of the projection of
+    `type` (see `ProjectionStats`), used by the client to look up contrast
+    quantiles"""
+    try:
+        stats = projections.get_projection_stats(
+            experiment_id=request.args['experiment_id'],
+            projection_type=request.args['type'])
+    except ValueError as e:
+        return str(e), 400
+    return stats.arrays
 
 
 @api.route('/get_trace', methods=['POST'])
 @login_required
 def get_trace():
+    """Returns the trace as json, or as a binary array (see
+    `array_transport`) if the client accepts it. The binary dtype is given by
+    the `dtype` arg ("float32" (default) or "float16")"""
     request_data = request.get_json(force=True)
-    trace = util.get_trace(
-        experiment_id=request_data['experiment_id'],
-        roi_id=request_data['roi']['id'],
-        contours=request_data['roi']['contours'],
-        is_user_added=request_data['roi']['isUserAdded'])
-
-    # Trace seems to decrease to 0 at the end which makes visualization worse
-    # Trim to last nonzero index
-    nonzero = trace.nonzero()[0]
-    if len(nonzero) > 0:
-        trace = trace[:nonzero[-1]]
+    with _admit_user_roi_trace(request_data=request_data):
+        trace, first_nonzero = util.get_trimmed_trace(
+            experiment_id=request_data['experiment_id'],
+            roi_id=request_data['roi']['id'],
+            contours=request_data['roi']['contours'],
+            is_user_added=request_data['roi']['isUserAdded'])
+
+    if client_accepts_array(request=request):
+        dtype = request.args.get('dtype', 'float32')
+        if dtype not in ('float32', 'float16'):
+            return f'bad dtype {dtype}', 400
+        return make_array_response(
+            trace,
+            dtype=dtype,
+            compress=client_accepts_compression(request=request),
+            headers={'X-Trace-First-Nonzero': str(first_nonzero)})
 
-    trace = trace.tolist()
     return {
-        'trace': trace
+        'trace': trace,
+        'first_nonzero': first_nonzero
     }
 
 
 @api.route('/get_motion_border')
 @login_required
+@http_cached(identity=_get_artifact_identity)
 def get_motion_border():
+    """Returns the motion border of the experiment. If the `region_id` arg is
+    given, the region bundle is used if there is one"""
     experiment_id = request.args['experiment_id']
+    if 'region_id' in request.args:
+        region = util.get_region(region_id=int(request.args['region_id']))
+        bundle = get_region_bundle(region=region)
+        if bundle is not None:
+            return bundle['motion_border']
     artifact_path = get_artifacts_path(experiment_id=experiment_id)
     af = ArtifactFile(path=artifact_path)
     mb = af.motion_border
@@ -140,134 +296,237 @@ def get_motion_border():
 
 @api.route('/get_video', methods=['POST'])
 @login_required
+@admission_controlled(pool='video')
 def get_video():
+    """Renders the video and returns it once rendered. See also
+    `render_video` to render in the background"""
     request_data = request.get_json(force=True)
-    experiment_id = request_data['experiment_id']
-    is_user_added = request_data['is_user_added']
-    color = request_data['color']
-    roi_id = request_data['roi_id']
-    contours = request_data['contours']
+    video_kwargs = _get_thumbnail_video_kwargs(request_data=request_data)
+    video_cache = get_video_cache()
+    video_path = render_thumbnail_video(
+        video_cache=video_cache,
+        streamable=current_app.config.get('VIDEO_STREAMABLE_FORMAT'),
+        **video_kwargs)
+    if video_cache is None:
+        response = _send_video(video_path=video_path, etag=None)
+        # Uncached videos are temporary files owned by this request
+        response.call_on_close(lambda: video_path.unlink(missing_ok=True))
+        return response
+    # Cached videos are named by their cache key
+    return _send_video(video_path=video_path, etag=video_path.stem)
+
+
+@api.route('/get_roi_frames', methods=['POST'])
+@login_required
+@admission_controlled(pool='region_artifacts')
+def get_roi_frames():
+    """Returns the movie frames around the ROI as a uint8 binary array (see
+    `array_transport`) of shape (frames, height, width), for the client to
+    draw itself. This is much cheaper than rendering a video. Takes the same
+    request body as `get_video`. The crop location and ROI outline are given
+    as json in the X-Roi-Box and X-Roi-Outline headers"""
+    request_data = request.get_json(force=True)
+    start, end = request_data['timeframe']
+    if end - start > MAX_ROI_FRAMES:
+        return f'At most {MAX_ROI_FRAMES} frames can be requested', 400
+    roi_frames = run_in_process(
+        util.get_roi_frames,
+        experiment_id=request_data['experiment_id'],
+        roi_id=request_data['roi_id'],
+        is_user_added=request_data['is_user_added'],
+        contours=request_data['contours'],
+        padding=int(request_data.get('padding', 32)),
+        timeframe=(start, end))
+    return make_array_response(
+        roi_frames['frames'],
+        compress=client_accepts_compression(request=request),
+        headers={
+            'X-Roi-Box': json.dumps(roi_frames['box']),
+            'X-Roi-Outline': json.dumps(roi_frames['outline'])
+        })
+
+
+@api.route('/render_video', methods=['POST'])
+@login_required
+@admission_controlled(pool='video')
+def render_video():
+    """Starts rendering the video in the background. Takes the same request
+    body as `get_video`. Returns a job id immediately, which can be passed to
+    `get_video_job_status`, `get_rendered_video` and `cancel_video_job`"""
+    request_data = request.get_json(force=True)
+    video_kwargs = _get_thumbnail_video_kwargs(request_data=request_data)
+    try:
+        render_queue = get_video_render_queue()
+    except RuntimeError as e:
+        return str(e), 400
+    try:
+        job_id = render_queue.submit(waiter_id=current_user.get_id(),
+                                     **video_kwargs)
+    except RenderQueueFullError as e:
+        return str(e), 503, {'Retry-After': '5'}
+    return {
+        'job_id': job_id,
+        'status': render_queue.get_status(job_id=job_id)
+    }
 
-    region_id = int(request_data['region_id'])
 
-    include_current_roi_mask = request_data['include_current_roi_mask']
-    include_all_roi_masks = request_data['include_all_roi_masks']
-    padding = int(request_data.get('padding', 32))
-    start, end = request_data['timeframe']
+@api.route('/get_video_job_status')
+@login_required
+@admission_controlled(pool='video_job_status')
+def get_video_job_status():
+    """Gets the status of a video render job. If the `wait` arg is given and
+    the workers are threaded, waits up to that many seconds (at most
+    `MAX_VIDEO_JOB_STATUS_WAIT`) for the job to finish. Otherwise returns
+    right away, since waiting would hold a whole sync worker"""
+    job_id = request.args['job_id']
+    if not is_valid_job_id(job_id=job_id):
+        return 'bad job id', 400
+    max_wait = MAX_VIDEO_JOB_STATUS_WAIT \
+        if current_app.config.get('worker_class') == 'gthread' else 0
+    wait = bound_timeout(
+        timeout=min(float(request.args.get('wait', 0)), max_wait))
+    try:
+        render_queue = get_video_render_queue()
+    except RuntimeError as e:
+        return str(e), 400
+    status = render_queue.wait(job_id=job_id, timeout=wait)
+    return {
+        'job_id': job_id,
+        'status': status
+    }
 
-    artifact_path = get_artifacts_path(experiment_id=experiment_id)
 
-    region = (db.session.query(JobRegion)
-              .filter(JobRegion.id == region_id)
-              .first())
-    rois = util.get_rois_in_region(region=region)
-    roi_color_map = {
-        roi['id']: util.get_soft_filter_roi_color(
-            classifier_score=roi['classifier_score']) for roi in rois}
-    if is_user_added:
-        roi = create_roi_from_contours(contours=contours)
-        roi['id'] = roi_id
+@api.route('/get_rendered_video')
+@login_required
+def get_rendered_video():
+    job_id = request.args['job_id']
+    if not is_valid_job_id(job_id=job_id):
+        return 'bad job id', 400
+    video_cache = get_video_cache()
+    if video_cache is None:
+        return 'Background rendering requires VIDEO_CACHE_DIR to be set', 400
+    video_path = video_cache.get(key=job_id)
+    if video_path is None:
+        return 'video not rendered', 404
+    return _send_video(video_path=video_path, etag=job_id)
+
+
+@api.route('/cancel_video_job', methods=['POST'])
+@login_required
+def cancel_video_job():
+    """Stops waiting for a video render job on behalf of the user. The job
+    is cancelled once no user is waiting for it"""
+    job_id = request.get_json(force=True)['job_id']
+    if not is_valid_job_id(job_id=job_id):
+        return 'bad job id', 400
+    try:
+        render_queue = get_video_render_queue()
+    except RuntimeError as e:
+        return str(e), 400
+    render_queue.cancel(job_id=job_id, waiter_id=current_user.get_id())
+    return 'success'
 
-        # Add the user-drawn roi to the list of rois
-        rois.append(roi)
 
-        # Add a color
-        roi_color_map[roi_id] = color
+def _send_video(video_path: Path, etag: Optional[str]):
+    """Sends a video, honoring Range, If-None-Match and If-Range headers, so
+    that the browser can seek and play the video while it downloads.
 
-    this_roi = [x for x in rois if x['id'] == roi_id][0]
+    :param video_path:
+        Path to the video
+    :param etag:
+        Identifies the video content. Should be given for cached videos, since
+        the cache touches the file on each access, which would change the
+        default etag derived from the modification time
+    """
+    response = send_file(path_or_file=video_path,
+                         mimetype='video/mp4',
+                         conditional=True,
+                         etag=etag if etag is not None else True,
+                         max_age=3600 if etag is not None else None)
+    response.cache_control.private = True
+    return response
 
-    timesteps = np.arange(start, end)
 
-    if not include_current_roi_mask:
-        roi_color_map = None
+def _admit_user_roi_trace(request_data: dict):
+    """Computing the trace of a user-added ROI reads the video, so it is
+    admission controlled. Reading a precomputed trace is cheap."""
+    if request_data['roi']['isUserAdded']:
+        return admit(pool='user_roi_trace')
+    return nullcontext()
 
-    roi_list = rois if include_all_roi_masks else None
 
-    video = get_thumbnail_video_from_artifact_file(
-        artifact_path=artifact_path,
-        roi=this_roi,
-        padding=padding,
-        quality=9,
-        timesteps=timesteps,
-        fps=31,
-        other_roi=roi_list,
-        roi_color=roi_color_map)
-    return send_file(path_or_file=video.video_path)
+def _get_thumbnail_video_kwargs(request_data: dict) -> dict:
+    """Gets the kwargs to pass to `get_thumbnail_video_from_artifact_file`
+    from the request body of `get_video`"""
+    return util.get_thumbnail_video_kwargs(
+        experiment_id=request_data['experiment_id'],
+        region_id=int(request_data['region_id']),
+        roi_id=request_data['roi_id'],
+        is_user_added=request_data['is_user_added'],
+        color=request_data['color'],
+        contours=request_data['contours'],
+        include_current_roi_mask=request_data['include_current_roi_mask'],
+        include_all_roi_masks=request_data['include_all_roi_masks'],
+        padding=int(request_data.get('padding', 32)),
+        timeframe=request_data['timeframe'])
 
 
 @api.route('/get_default_video_timeframe', methods=['POST'])
 @login_required
 def get_default_video_timeframe():
     request_data = request.get_json(force=True)
-    trace = util.get_trace(
-        experiment_id=request_data['experiment_id'],
-        roi_id=request_data['roi']['id'],
-        contours=request_data['roi']['contours'],
-        is_user_added=request_data['roi']['isUserAdded'])
-
-    max_idx = trace.argmax()
-    start = float(max_idx - 300)
-    end = float(max_idx + 300)
+    with _admit_user_roi_trace(request_data=request_data):
+        start, end = util.get_default_video_timeframe(
+            experiment_id=request_data['experiment_id'],
+            roi_id=request_data['roi']['id'],
+            contours=request_data['roi']['contours'],
+            is_user_added=request_data['roi']['isUserAdded'])
+
+    start = float(start)
+    end = float(end)
     return {
         'timeframe': (start, end)
     }
 
 
-@api.route('/get_fov_bounds', methods=['POST'])
+@api.route('/get_fov_bounds', methods=['GET', 'POST'])
 @login_required
+@http_cached(identity=_get_artifact_and_predictions_identity)
 def get_fov_bounds():
-    """The FOV bounds are the min/max x, y values of the bounding boxes to
-    all ROIs that fit in the region. The reason why the region x, y, width,
-    height was not just used is in the case of ROIs that don't fit within
-    the region entirely. In that case, we need to expand the region
-    dimensions so that all ROIs are in view. """
-    r = request.get_json(force=True)
+    """Returns the FOV bounds of the region. See `util.get_fov_bounds`.
+    Takes the `experiment_id` and `region_id` args, or for POST, the region
+    as the request body"""
+    if request.method == 'GET':
+        experiment_id = request.args['experiment_id']
+        region_id = int(request.args['region_id'])
+    else:
+        r = request.get_json(force=True)
+        experiment_id = r['experiment_id']
+        region_id = r['id']
 
     region = (db.session.query(JobRegion)
-              .filter(JobRegion.id == r['id'])
+              .filter(JobRegion.id == region_id)
               .first())
+    return _get_fov_bounds(region=region, experiment_id=experiment_id)
 
-    contours = util.get_roi_contours_in_region(
-        experiment_id=r['experiment_id'], region=region)
 
-    if len(contours) == 0:
-        x_min, x_max = region.x, region.x + region.width
-        y_min, y_max = region.y, region.y + region.height
-    else:
-        x = np.array([x['box_x'] for x in contours])
-        y = np.array([x['box_y'] for x in contours])
-
-        widths = np.array([x['box_width'] for x in contours])
-        heights = np.array([x['box_height'] for x in contours])
-
-        x_min, x_max = x.min(), (x + widths).max()
-        y_min, y_max = y.min(), (y + heights).max()
-
-    # Find the larger box, either the region box or the box containing all ROIs
-    # that are contained within or overlap within the box
-    # The box containing all ROIs will be smaller in the case there are few
-    # ROIs within the region, and they are close together.
-    # This ensures that we always return at least the region box
-    # Region x is row and region y and col
-    x_range = [
-        min(float(x_min), region.y),
-        max(float(x_max), region.y + region.width)
-    ]
-
-    y_range = [
-        # Reversing because origin of plot is top-left instead of bottom-left
-        max(float(y_max), region.x + region.height),
-        min(float(y_min), region.x)
-    ]
+def _get_fov_bounds(region: JobRegion, experiment_id: str) -> Dict:
+    """Gets the FOV bounds of the region from its bundle if there is one,
+    else computes them"""
+    bundle = get_region_bundle(region=region)
+    if bundle is not None:
+        return bundle['fov_bounds']
 
-    return {
-        'x': x_range,
-        'y': y_range
-    }
+    with admit(pool='region_artifacts'):
+        contours = util.get_roi_contours_in_region(
+            experiment_id=experiment_id, region=region)
+    return util.get_fov_bounds(region=region, contours=contours)
 
 
 @api.route('/get_field_of_view_dimensions')
 @login_required
+@http_cached(identity=lambda: {
+    'dims': current_app.config['FIELD_OF_VIEW_DIMENSIONS']})
 def get_field_of_view_dimensions():
     dims = current_app.config['FIELD_OF_VIEW_DIMENSIONS']
     return {
@@ -296,6 +555,9 @@ def submit_region():
 
     db.session.commit()
 
+    if current_app.config.get('PREFETCH_QUEUE_SIZE'):
+        prefetch.invalidate_region(region_id=data['region_id'])
+
     return 'success'
 
 
@@ -328,9 +590,14 @@ def find_roi_at_coordinates():
               .filter(JobRegion.id == current_region_id)
               .first())
 
-    artifact_path = get_artifacts_path(experiment_id=region.experiment_id)
-    af = ArtifactFile(path=artifact_path)
-    rois = af.rois
+    bundle = get_region_bundle(region=region)
+    if bundle is not None:
+        rois = list(bundle['rois'])
+    else:
+        with admit(pool='region_artifacts'):
+            table = util.get_roi_table(experiment_id=region.experiment_id)
+            rows = np.flatnonzero(np.isin(table.ids, rois_in_region))
+            rois = [table.get_roi(index=i) for i in rows]
 
     # Add user-added rois to list of rois
     for roi in data['user_added_rois']:
@@ -396,6 +663,31 @@ def get_label_stats():
     }
 
 
+@api.route('/get_admission_stats', methods=['GET'])
+@login_required
+def get_admission_stats():
+    """
+    Gets the number of active, queued and rejected requests for each
+    admission control pool
+    :return:
+        Dict of stats by pool
+    """
+    return {
+        name: pool.get_stats()
+        for name, pool in get_admission_pools().items()
+    }
+
+
+@api.errorhandler(AdmissionRejectedError)
+def handle_admission_rejected(e: AdmissionRejectedError):
+    return str(e), 503, {'Retry-After': str(e.retry_after)}
+
+
+@api.errorhandler(TaskTimeoutError)
+def handle_task_timeout(e: TaskTimeoutError):
+    return str(e), 504
+
+
 @api.after_request
 def after_request(response):
     header = response.headers
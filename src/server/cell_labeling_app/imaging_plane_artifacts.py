@@ -2,11 +2,33 @@
 
 import json
 from pathlib import Path
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional, Tuple
 
 import h5py
 import numpy as np
 
+# Quantiles stored in the trace summary index
+TRACE_SUMMARY_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+# Dataset of each projection type
+PROJECTION_DATASETS = {
+    'max': 'max_projection',
+    'average': 'avg_projection',
+    'correlation': 'correlation_projection'
+}
+
+# Percentiles, in [0, 100], stored in the percentile table of each
+# projection
+PROJECTION_STATS_PERCENTILES = np.linspace(0, 100, 1001)
+
+# Number of bins of the histogram of each projection
+PROJECTION_STATS_N_BINS = 256
+
+# Datasets of the `roi_table` group, which stores the ROIs in the compact
+# format of `RoiTable` rather than as a json string in `rois`
+ROI_TABLE_COLUMNS = ('id', 'x', 'y', 'width', 'height', 'mask_offsets',
+                     'mask_bits')
+
 
 class MotionBorder:
     """Motion border"""
@@ -45,6 +67,261 @@ class MotionBorder:
         return self._bottom
 
 
+class TraceSummary:
+    """Precomputed summary statistics of a trace"""
+
+    def __init__(self, argmax: int, first_nonzero: int, last_nonzero: int,
+                 min: float, max: float, percentiles: Dict[float, float]):
+        """
+
+        :param argmax:
+            index of the trace max
+        :param first_nonzero:
+            index of the first nonzero sample. -1 if all samples are 0
+        :param last_nonzero:
+            index of the last nonzero sample. -1 if all samples are 0
+        :param min:
+            trace min
+        :param max:
+            trace max
+        :param percentiles:
+            Map from quantile to trace value at that quantile
+        """
+        self._argmax = argmax
+        self._first_nonzero = first_nonzero
+        self._last_nonzero = last_nonzero
+        self._min = min
+        self._max = max
+        self._percentiles = percentiles
+
+    @property
+    def argmax(self) -> int:
+        return self._argmax
+
+    @property
+    def first_nonzero(self) -> int:
+        return self._first_nonzero
+
+    @property
+    def last_nonzero(self) -> int:
+        return self._last_nonzero
+
+    @property
+    def min(self) -> float:
+        return self._min
+
+    @property
+    def max(self) -> float:
+        return self._max
+
+    @property
+    def percentiles(self) -> Dict[float, float]:
+        return self._percentiles
+
+    @classmethod
+    def from_trace(
+            cls,
+            trace: np.ndarray,
+            quantiles: Tuple[float, ...] = TRACE_SUMMARY_QUANTILES
+    ) -> "TraceSummary":
+        """Computes the summary of `trace`"""
+        nonzero = trace.nonzero()[0]
+        if len(nonzero) > 0:
+            first_nonzero, last_nonzero = int(nonzero[0]), int(nonzero[-1])
+        else:
+            first_nonzero, last_nonzero = -1, -1
+        percentiles = np.quantile(trace, quantiles)
+        return cls(argmax=int(trace.argmax()),
+                   first_nonzero=first_nonzero,
+                   last_nonzero=last_nonzero,
+                   min=float(trace.min()),
+                   max=float(trace.max()),
+                   percentiles={q: float(p) for q, p in
+                                zip(quantiles, percentiles)})
+
+
+class ProjectionStats:
+    """Precomputed histogram and percentile table of a projection"""
+
+    def __init__(self, percentiles: np.ndarray, values: np.ndarray,
+                 histogram: np.ndarray, bin_edges: np.ndarray):
+        """
+
+        :param percentiles:
+            Percentiles in [0, 100], increasing
+        :param values:
+            Projection value at each of `percentiles`
+        :param histogram:
+            Number of pixels in each bin
+        :param bin_edges:
+            Edges of the bins. One longer than `histogram`
+        """
+        self._percentiles = percentiles
+        self._values = values
+        self._histogram = histogram
+        self._bin_edges = bin_edges
+
+    @property
+    def percentiles(self) -> np.ndarray:
+        return self._percentiles
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._values
+
+    @property
+    def histogram(self) -> np.ndarray:
+        return self._histogram
+
+    @property
+    def bin_edges(self) -> np.ndarray:
+        return self._bin_edges
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """The stats as a dict of arrays, keyed by property name"""
+        return {'percentiles': self._percentiles,
+                'values': self._values,
+                'histogram': self._histogram,
+                'bin_edges': self._bin_edges}
+
+    def get_quantile(self, quantile: float) -> float:
+        """Gets the projection value at `quantile`, in [0, 1], interpolating
+        between the percentiles of the table"""
+        return float(np.interp(quantile * 100, self._percentiles,
+                               self._values))
+
+    @classmethod
+    def from_projection(
+            cls,
+            projection: np.ndarray,
+            percentiles: np.ndarray = PROJECTION_STATS_PERCENTILES,
+            n_bins: int = PROJECTION_STATS_N_BINS) -> "ProjectionStats":
+        """Computes the stats of `projection`"""
+        values = np.percentile(projection, percentiles)
+        histogram, bin_edges = np.histogram(
+            projection, bins=n_bins,
+            range=(float(projection.min()), float(projection.max())))
+        return cls(percentiles=np.array(percentiles, dtype='float64'),
+                   values=values.astype('float64'),
+                   histogram=histogram.astype('int64'),
+                   bin_edges=bin_edges.astype('float64'))
+
+
+class RoiTable:
+    """Columnar table of ROIs. Holds the same information as
+    `ArtifactFile.rois`, as a few flat arrays rather than a list of dicts,
+    so that it can be stored and shared as arrays. The masks are
+    concatenated bit-packed masks, with `mask_offsets[i]` the byte offset of
+    the ith mask"""
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """
+        :param arrays:
+            dict with keys id, x, y, width, height, mask_offsets, mask_bits.
+            See `from_rois`
+        """
+        self._arrays = arrays
+
+    def __len__(self):
+        return len(self._arrays['id'])
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return self._arrays
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._arrays['id']
+
+    @property
+    def x(self) -> np.ndarray:
+        return self._arrays['x']
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._arrays['y']
+
+    @property
+    def width(self) -> np.ndarray:
+        return self._arrays['width']
+
+    @property
+    def height(self) -> np.ndarray:
+        return self._arrays['height']
+
+    @classmethod
+    def from_rois(cls, rois: List[Dict]) -> 'RoiTable':
+        """
+        :param rois:
+            See `ArtifactFile.rois`
+        """
+        masks = [np.packbits(np.array(roi['mask'], dtype=bool).ravel())
+                 for roi in rois]
+        mask_offsets = np.zeros(len(rois) + 1, dtype='int64')
+        mask_offsets[1:] = np.cumsum([len(x) for x in masks])
+        arrays = {
+            'id': np.array([roi['id'] for roi in rois], dtype='int64'),
+            'mask_offsets': mask_offsets,
+            'mask_bits': (np.concatenate(masks) if masks else
+                          np.zeros(0, dtype='uint8'))
+        }
+        for name in ('x', 'y', 'width', 'height'):
+            arrays[name] = np.array([roi[name] for roi in rois],
+                                    dtype='int32')
+        return cls(arrays=arrays)
+
+    def get_index(self, roi_id: int) -> int:
+        """
+        :return:
+            The row of `roi_id`
+        :raises KeyError:
+            If there is no such ROI
+        """
+        index = np.flatnonzero(self.ids == roi_id)
+        if len(index) == 0:
+            raise KeyError(f'No roi with id {roi_id}')
+        return int(index[0])
+
+    def get_mask(self, index: int) -> np.ndarray:
+        """
+        :return:
+            Boolean mask of the ROI in row `index`, of shape
+            (height, width)
+        """
+        height = int(self.height[index])
+        width = int(self.width[index])
+        start, end = self._arrays['mask_offsets'][index:index + 2]
+        mask = np.unpackbits(self._arrays['mask_bits'][start:end],
+                             count=height * width)
+        return mask.astype(bool).reshape(height, width)
+
+    def get_roi(self, index: int) -> Dict:
+        """
+        :return:
+            The ROI in row `index`, in the format of `ArtifactFile.rois`,
+            with the mask as a boolean array
+        """
+        return {
+            'id': int(self.ids[index]),
+            'x': int(self.x[index]),
+            'y': int(self.y[index]),
+            'width': int(self.width[index]),
+            'height': int(self.height[index]),
+            'mask': self.get_mask(index=index)
+        }
+
+    def get_bbox_overlapping(self, row_start: int, row_end: int,
+                             col_start: int, col_end: int) -> np.ndarray:
+        """
+        :return:
+            Rows of the ROIs whose bounding box overlaps the rectangle
+            [row_start, row_end) x [col_start, col_end)
+        """
+        return np.flatnonzero(
+            (self.y < row_end) & (self.y + self.height > row_start) &
+            (self.x < col_end) & (self.x + self.width > col_start))
+
+
 class ArtifactFile:
     """Class for reading artifacts from hdf5 file"""
     def __init__(self, path: Union[Path, str]):
@@ -60,8 +337,25 @@ class ArtifactFile:
 
     @property
     def rois(self) -> List[dict]:
+        """
+        :return:
+            List of dicts with keys id, x, y, width, height, mask, where mask
+            is a boolean array of shape (height, width)
+        """
+        table = self.roi_table
+        return [table.get_roi(index=i) for i in range(len(table))]
+
+    @property
+    def roi_table(self) -> RoiTable:
+        """The ROIs, read from the `roi_table` group if the file has one
+        (see `convert_rois`), else from the `rois` json string"""
         with h5py.File(self._path, 'r') as f:
-            return json.loads((f['rois'][()]))
+            if 'roi_table' in f:
+                return RoiTable(arrays={
+                    name: f['roi_table'][name][()]
+                    for name in ROI_TABLE_COLUMNS})
+            rois = json.loads(f['rois'][()])
+        return RoiTable.from_rois(rois=rois)
 
     @property
     def motion_border(self) -> MotionBorder:
@@ -75,15 +369,9 @@ class ArtifactFile:
 
     def get_projection(self, projection_type: str) -> np.ndarray:
         with h5py.File(self._path, 'r') as f:
-            if projection_type == 'max':
-                dataset_name = 'max_projection'
-            elif projection_type == 'average':
-                dataset_name = 'avg_projection'
-            elif projection_type == 'correlation':
-                dataset_name = 'correlation_projection'
-            else:
+            if projection_type not in PROJECTION_DATASETS:
                 raise ValueError('bad projection type')
-            projection = f[dataset_name][:]
+            projection = f[PROJECTION_DATASETS[projection_type]][:]
 
         if len(projection.shape) == 3:
             projection = projection[:, :, 0]
@@ -91,11 +379,122 @@ class ArtifactFile:
 
         return projection
 
+    def get_projection_stats(
+            self, projection_type: str) -> Optional[ProjectionStats]:
+        """
+        Gets the precomputed stats of a projection
+
+        :param projection_type:
+            See `get_projection`
+        :return:
+            The stats, or None if they have not been built (see
+            `build_projection_stats`)
+        """
+        with h5py.File(self._path, 'r') as f:
+            if 'projection_stats' not in f or \
+                    projection_type not in f['projection_stats']:
+                return None
+            group = f['projection_stats'][projection_type]
+            return ProjectionStats(
+                percentiles=group['percentiles'][()],
+                values=group['values'][()],
+                histogram=group['histogram'][()],
+                bin_edges=group['bin_edges'][()])
+
+    @property
+    def video_shape(self) -> Tuple[int, int, int]:
+        """Shape of `video_data` (frames, height, width)"""
+        with h5py.File(self._path, 'r') as f:
+            return f['video_data'].shape
+
+    def get_video_crop(self, x: int, y: int, width: int, height: int,
+                       start: int, end: int,
+                       frames_per_read: int = 1024) -> np.ndarray:
+        """
+        Reads a rectangular crop of `video_data` for a range of frames.
+        The crop is read in blocks of frames aligned to the dataset's chunks,
+        so that each chunk is decompressed once and memory use is bounded by
+        the output.
+
+        :param x: left of the crop
+        :param y: top of the crop
+        :param width: width of the crop
+        :param height: height of the crop
+        :param start: first frame
+        :param end: frame after the last frame
+        :param frames_per_read: Number of frames read at a time if the
+            dataset is not chunked
+        :return:
+            Array of shape (end - start, height, width) with the dtype of
+            `video_data`
+        """
+        with h5py.File(self._path, 'r') as f:
+            dataset = f['video_data']
+            start = max(start, 0)
+            end = min(end, dataset.shape[0])
+            out = np.empty((max(end - start, 0), height, width),
+                           dtype=dataset.dtype)
+            if dataset.chunks is not None:
+                frames_per_read = dataset.chunks[0] * max(
+                    1, frames_per_read // dataset.chunks[0])
+
+            block_start = start
+            while block_start < end:
+                # Align the block end to a chunk boundary
+                block_end = min(
+                    (block_start // frames_per_read + 1) * frames_per_read,
+                    end)
+                dataset.read_direct(
+                    out,
+                    source_sel=np.s_[block_start:block_end,
+                                     y:y + height, x:x + width],
+                    dest_sel=np.s_[block_start - start:block_end - start])
+                block_start = block_end
+        return out
+
+    @property
+    def has_trace_summary(self) -> bool:
+        """Whether the trace summary index has been built for this file.
+        See `artifact_tools.build_trace_summary`"""
+        with h5py.File(self._path, 'r') as f:
+            return 'trace_summary' in f
+
+    def get_trace_summary(self, roi_id: int) -> Optional[TraceSummary]:
+        """
+        Gets the precomputed trace summary for `roi_id`
+
+        :param roi_id:
+            ROI id
+        :return:
+            The trace summary, or None if the index has not been built or
+            does not contain `roi_id`
+        """
+        with h5py.File(self._path, 'r') as f:
+            if 'trace_summary' not in f:
+                return None
+            group = f['trace_summary']
+            idx = np.flatnonzero(group['roi_id'][()] == roi_id)
+            if len(idx) == 0:
+                return None
+            idx = int(idx[0])
+            quantiles = group.attrs['quantiles']
+            percentiles = group['percentiles'][idx]
+            return TraceSummary(
+                argmax=int(group['argmax'][idx]),
+                first_nonzero=int(group['first_nonzero'][idx]),
+                last_nonzero=int(group['last_nonzero'][idx]),
+                min=float(group['min'][idx]),
+                max=float(group['max'][idx]),
+                percentiles={float(q): float(p) for q, p in
+                             zip(quantiles, percentiles)}
+            )
+
     def get_trace(
             self,
             is_user_added: bool,
             roi: Dict,
-            roi_id: int) -> np.ndarray:
+            roi_id: int,
+            end: Optional[int] = None) -> np.ndarray:
         """
         Gets trace. If roi_id not provided, gets trace at point from video
         :param roi_id:
@@ -104,17 +503,78 @@ class ArtifactFile:
             Whether the user added this roi or it was precomputed
         :param roi:
             Must include x, y, width, height
+        :param end:
+            If given, only the samples before `end` are read
 
         :return: trace
         """
         if is_user_added:
             trace = self._get_trace_for_user_added_roi(roi=roi)
+            if end is not None:
+                trace = trace[:end]
         else:
             with h5py.File(self._path, 'r') as f:
-                trace = (f['traces'][str(roi_id)][()])
+                if 'trace_matrix' in f:
+                    row = self._get_trace_matrix_rows(f=f, roi_ids=[roi_id])
+                    trace = f['trace_matrix'][int(row[0]), :end]
+                else:
+                    trace = (f['traces'][str(roi_id)][:end])
 
         return trace
 
+    @property
+    def trace_roi_ids(self) -> List[int]:
+        """The ids of all ROIs with a precomputed trace"""
+        with h5py.File(self._path, 'r') as f:
+            if 'trace_matrix' in f:
+                roi_ids = f['trace_matrix_roi_ids'][()].tolist()
+            else:
+                roi_ids = [int(roi_id) for roi_id in f['traces']]
+        return sorted(roi_ids)
+
+    def get_traces(self, roi_ids: List[int]) -> Dict[int, np.ndarray]:
+        """
+        Gets the precomputed traces for many ROIs. If the traces are stored
+        as a single (n_rois, n_frames) matrix (see
+        `artifact_tools.convert_traces`), they are read with a single
+        hyperslab read.
+
+        :param roi_ids:
+            ROI ids to retrieve traces for
+        :return:
+            Map from roi id to trace
+        """
+        with h5py.File(self._path, 'r') as f:
+            if 'trace_matrix' not in f:
+                return {roi_id: f['traces'][str(roi_id)][()]
+                        for roi_id in roi_ids}
+            if len(roi_ids) == 0:
+                return {}
+            rows = self._get_trace_matrix_rows(f=f, roi_ids=roi_ids)
+
+            # h5py requires strictly increasing indices
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            traces = f['trace_matrix'][unique_rows.tolist(), :]
+            return {roi_id: traces[inverse[i]]
+                    for i, roi_id in enumerate(roi_ids)}
+
+    @staticmethod
+    def _get_trace_matrix_rows(f: h5py.File,
+                               roi_ids: List[int]) -> np.ndarray:
+        """Gets the rows of `trace_matrix` storing the traces for `roi_ids`
+
+        :raises KeyError:
+            If there is no trace for one of the `roi_ids`
+        """
+        index = f['trace_matrix_roi_ids'][()]
+        roi_ids = np.array(roi_ids)
+        rows = np.searchsorted(index, roi_ids)
+        rows = np.clip(rows, 0, len(index) - 1)
+        missing = roi_ids[index[rows] != roi_ids]
+        if len(missing) > 0:
+            raise KeyError(f'No trace for roi ids {missing.tolist()}')
+        return rows
+
     def _get_trace_for_user_added_roi(self, roi: Dict) -> np.ndarray:
         """Calculates a trace for roi by finding the mean pixel value in ROI
         across time"""
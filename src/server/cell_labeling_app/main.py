@@ -1,17 +1,33 @@
 import json
+import logging
 import os
 import subprocess
 import sys
+import tempfile
 import uuid
 from pathlib import Path
 
 import argschema
+from marshmallow.validate import OneOf, Range
 from flask import Flask
+from sqlalchemy import Table, inspect
+from sqlalchemy.exc import SQLAlchemyError
 
 from cell_labeling_app.database.database import db
+from cell_labeling_app.database.schemas import PrefetchedRegion
 from cell_labeling_app.endpoints.endpoints import api
 from cell_labeling_app.endpoints.user_authentication import users
 from cell_labeling_app.user_authentication.user_authentication import login
+from cell_labeling_app.util import artifact_cache, deadline, \
+    response_encoding, warmup
+
+logger = logging.getLogger(__name__)
+
+# gunicorn kills workers whose request takes longer than this many seconds
+GUNICORN_TIMEOUT = 90
+
+# Time a request needs past its deadline to return the error, in seconds
+REQUEST_TIMEOUT_HEADROOM = 20
 
 
 class AppSchema(argschema.ArgSchema):
@@ -29,6 +45,21 @@ class AppSchema(argschema.ArgSchema):
         required=True,
         description='Path to pre-classification predictions'
     )
+    ARTIFACT_CACHE_DIR = argschema.fields.OutputDir(
+        default=None,
+        allow_none=True,
+        description='Local directory to which artifact files are copied in '
+                    'the background, and then read from, for when '
+                    'ARTIFACT_DIR is on a slow shared filesystem. The '
+                    'artifact files of the active labeling jobs are copied '
+                    'at startup. Should be on fast local disk. Set to null '
+                    'to always read from ARTIFACT_DIR'
+    )
+    ARTIFACT_CACHE_MAX_BYTES = argschema.fields.Integer(
+        default=200 * 1024 ** 3,
+        description='Maximum size of the artifact cache in bytes. Least '
+                    'recently used files are evicted when exceeded'
+    )
     PORT = argschema.fields.Integer(
         default=5000,
         description='Port the app should run on'
@@ -67,6 +98,199 @@ class AppSchema(argschema.ArgSchema):
         default=32,
         description='Number of workers to use for the webserver'
     )
+    worker_class = argschema.fields.String(
+        default='sync',
+        validate=OneOf(('sync', 'gthread')),
+        description='gunicorn worker class. "sync" workers handle one '
+                    'request at a time. "gthread" workers handle `threads` '
+                    'requests at a time, so that fewer workers, and fewer '
+                    'copies of the in-process caches, are needed. Use with '
+                    'PROCESS_POOL_SIZE'
+    )
+    threads = argschema.fields.Integer(
+        default=8,
+        description='Number of threads per worker, with the gthread worker '
+                    'class'
+    )
+    PROCESS_POOL_SIZE = argschema.fields.Integer(
+        default=0,
+        description='Number of processes each worker uses for CPU-bound '
+                    'and HDF5-bound work (ROI contours, video rendering, '
+                    'ROI frames, user-added ROI traces), so that the '
+                    'threads of a worker do not wait on each other for the '
+                    'GIL or the HDF5 lock. Set '
+                    'to 0 to do this work in the request thread'
+    )
+    REQUEST_TIMEOUT = argschema.fields.Float(
+        default=60.0,
+        validate=Range(min=1,
+                       max=GUNICORN_TIMEOUT - REQUEST_TIMEOUT_HEADROOM),
+        description='Deadline of each request in seconds. Every wait of a '
+                    'request (for admission, for the same computation by '
+                    'another request, for work in the process pool) is '
+                    'bounded by the time remaining, and a request that '
+                    'runs out of time gets a 503 or 504. Must be well under '
+                    f'the gunicorn worker timeout ({GUNICORN_TIMEOUT}s), '
+                    'which kills the whole worker'
+    )
+    preload = argschema.fields.Boolean(
+        default=False,
+        description='Whether to load the app in the gunicorn master process '
+                    'before forking the workers (gunicorn --preload). The '
+                    'workers then share the loaded modules, which lowers '
+                    'memory use and startup time. Code changes are not '
+                    'reloaded'
+    )
+    WARMUP_CACHES = argschema.fields.Boolean(
+        default=False,
+        description='Whether to warm the caches for all regions of the '
+                    'active labeling jobs at startup. Each worker does it '
+                    'in the background once it is serving, and fills its '
+                    'own in-process caches. Progress is reported by /ready'
+    )
+    HTTP_CACHE_MAX_AGE = argschema.fields.Integer(
+        default=3600,
+        description='Number of seconds browsers may reuse responses derived '
+                    'only from the artifact and predictions files (e.g. '
+                    'projections, contours) without revalidating them. '
+                    'Revalidation is cheap, and gets a 304 unless the files '
+                    'changed'
+    )
+    RESPONSE_COMPRESSION_MIN_BYTES = argschema.fields.Integer(
+        default=1024,
+        allow_none=True,
+        description='json and MessagePack responses of at least this many '
+                    'bytes are compressed with brotli (if installed) or '
+                    'gzip, if the client accepts it. Set to null to '
+                    'disable, e.g. if a proxy compresses responses'
+    )
+    VIDEO_CACHE_DIR = argschema.fields.OutputDir(
+        default=str(Path(tempfile.gettempdir()) / 'cell_labeling_app' /
+                    'videos'),
+        allow_none=True,
+        description='Local directory in which rendered videos are cached '
+                    'and shared between workers. Should be on fast local '
+                    'disk. Set to null to disable caching'
+    )
+    VIDEO_CACHE_MAX_BYTES = argschema.fields.Integer(
+        default=10 * 1024 ** 3,
+        description='Maximum size of the video cache in bytes. Least '
+                    'recently used videos are evicted when exceeded'
+    )
+    ARRAY_CACHE_DIR = argschema.fields.OutputDir(
+        default=str(Path(tempfile.gettempdir()) / 'cell_labeling_app' /
+                    'arrays'),
+        allow_none=True,
+        description='Local directory in which arrays derived from the '
+                    'artifact and predictions files (ROI tables, contours, '
+                    'projections, classifier scores) are stored and '
+                    'memory-mapped by every worker, so that they are held '
+                    'in memory once per host. Should be on fast local '
+                    'disk. Set to null to cache them in each worker'
+    )
+    ARRAY_CACHE_MAX_BYTES = argschema.fields.Integer(
+        default=20 * 1024 ** 3,
+        description='Maximum size of the array cache in bytes. Least '
+                    'recently built entries are evicted when exceeded'
+    )
+    SINGLE_FLIGHT_DIR = argschema.fields.OutputDir(
+        default=str(Path.home() / '.cache' / 'cell_labeling_app' /
+                    'single_flight'),
+        allow_none=True,
+        description='Local directory used to coalesce identical expensive '
+                    'computations (contours, user-added ROI traces) across '
+                    'workers. Must be owned by the user running the app, '
+                    'and is made accessible only by that user. Set to null '
+                    'to only coalesce within a worker'
+    )
+    SINGLE_FLIGHT_TTL = argschema.fields.Float(
+        default=60.0,
+        description='Number of seconds a coalesced result is shared between '
+                    'workers'
+    )
+    ADMISSION_CONTROL_DIR = argschema.fields.OutputDir(
+        default=str(Path(tempfile.gettempdir()) / 'cell_labeling_app' /
+                    'admission'),
+        allow_none=True,
+        description='Local directory for the admission control locks. Set '
+                    'to null to disable admission control'
+    )
+    ADMISSION_CONTROL_POOLS = argschema.fields.Dict(
+        default={
+            'video': {'max_concurrent': 4, 'max_queued': 4, 'max_wait': 30},
+            'user_roi_trace': {'max_concurrent': 4, 'max_queued': 2,
+                               'max_wait': 30},
+            'region_artifacts': {'max_concurrent': 6, 'max_queued': 4,
+                                 'max_wait': 10},
+            'video_job_status': {'max_concurrent': 4, 'max_queued': 0,
+                                 'max_wait': 0, 'retry_after': 1}
+        },
+        description='Concurrency limits of expensive endpoints, by pool. '
+                    'Each pool maps to a dict with keys max_concurrent, '
+                    'max_queued, max_wait (seconds) and optionally '
+                    'retry_after (seconds). Requests over the limits get a '
+                    '503. The sum of max_concurrent and max_queued over all '
+                    'pools should be less than num_workers, so that cheap '
+                    'endpoints such as /submit_region always find a free '
+                    'worker'
+    )
+    VIDEO_RENDER_PROCESSES = argschema.fields.Integer(
+        default=1,
+        description='Number of processes each worker uses to render videos '
+                    'in the background'
+    )
+    VIDEO_RENDER_MAX_CONCURRENT = argschema.fields.Integer(
+        default=4,
+        description='Maximum number of videos rendered at the same time, '
+                    'across all workers'
+    )
+    VIDEO_RENDER_MAX_PENDING = argschema.fields.Integer(
+        default=64,
+        description='Maximum number of queued or running video render jobs, '
+                    'across all workers. Further jobs are rejected until '
+                    'some finish'
+    )
+    REGION_BUNDLE_DIR = argschema.fields.String(
+        default=None,
+        allow_none=True,
+        description='Directory of precomputed region bundles, written by '
+                    'populate_labeling_job --region_bundle_dir. Regions '
+                    'without an up-to-date bundle are computed on the fly'
+    )
+    PREFETCH_QUEUE_SIZE = argschema.fields.Integer(
+        default=0,
+        description='Number of regions assigned to each user ahead of time, '
+                    'whose data is computed in the background while the '
+                    'user labels the current region. 0 disables prefetching'
+    )
+    PREFETCH_VIDEOS = argschema.fields.Boolean(
+        default=False,
+        description='Whether to render the default videos of the ROIs in '
+                    'prefetched regions. Requires VIDEO_CACHE_DIR'
+    )
+    PREFETCH_VIDEO_MAX_CONCURRENT = argschema.fields.Integer(
+        default=1,
+        description='Maximum number of prefetched videos rendered at the '
+                    'same time, across all workers. Prefetched videos are '
+                    'rendered at low priority, in addition to '
+                    'VIDEO_RENDER_MAX_CONCURRENT'
+    )
+    PREFETCH_VIDEO_MAX_PENDING = argschema.fields.Integer(
+        default=8,
+        description='Maximum number of queued or running prefetched video '
+                    'render jobs, across all workers. These do not count '
+                    'against VIDEO_RENDER_MAX_PENDING'
+    )
+    VIDEO_STREAMABLE_FORMAT = argschema.fields.String(
+        default='faststart',
+        allow_none=True,
+        validate=OneOf(('faststart', 'fragmented')),
+        description='How rendered videos are remuxed so that the browser '
+                    'can start playing them before they are fully '
+                    'downloaded. "faststart" moves the index to the start '
+                    'of the file, "fragmented" writes a fragmented mp4. Set '
+                    'to null to send videos as rendered. Requires ffmpeg'
+    )
 
 
 class App(argschema.ArgSchemaParser):
@@ -99,25 +323,56 @@ class App(argschema.ArgSchemaParser):
             self.args['sqlalchemy_database_uri']
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
         app.config['SESSION_SECRET_KEY'] = session_secret_key
+        if self.args['worker_class'] == 'gthread' and not \
+                self.args['sqlalchemy_database_uri'].startswith('sqlite'):
+            # Each thread may hold a connection
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+                'pool_size': self.args['threads']}
         app.register_blueprint(api)
         for k, v in self.args.items():
             app.config[k] = v
         db.init_app(app)
         app.register_blueprint(users)
+        response_encoding.init_app(app)
+        deadline.init_app(app)
         app.secret_key = app.config['SESSION_SECRET_KEY']
 
         login.init_app(app)
+        if self.args['PREFETCH_QUEUE_SIZE']:
+            with app.app_context():
+                _create_table(table=PrefetchedRegion.__table__)
+        self._check_admission_control_limits()
         return app
 
+    def _check_admission_control_limits(self):
+        """Warns if the heavy endpoints can occupy every worker"""
+        pools = self.args['ADMISSION_CONTROL_POOLS']
+        if self.args['ADMISSION_CONTROL_DIR'] is None or not pools:
+            return
+        n_heavy = sum([limits['max_concurrent'] + limits['max_queued']
+                       for limits in pools.values()])
+        n_slots = self.args['num_workers']
+        if self.args['worker_class'] == 'gthread':
+            n_slots *= self.args['threads']
+        if n_heavy >= n_slots:
+            logger.warning(
+                f'Expensive endpoints can occupy {n_heavy} request slots, '
+                f'but there are only {n_slots}. Cheap endpoints may have to '
+                f'wait for them. Lower ADMISSION_CONTROL_POOLS or increase '
+                f'num_workers or threads')
+
     def run_production_server(self):
         """Launches webserver running app"""
         gunicorn_cmd_args = [
             f'--bind=0.0.0.0:{self.args["PORT"]}',
             f'--workers={self.args["num_workers"]}',
+            f'--worker-class={self.args["worker_class"]}',
             '--capture-output',
             '--name=cell_labeling_app',
-            '--timeout=90'
+            f'--timeout={GUNICORN_TIMEOUT}'
         ]
+        if self.args['worker_class'] == 'gthread':
+            gunicorn_cmd_args.append(f'--threads={self.args["threads"]}')
         if self.args['ACCESS_LOG_FILE'] is not None:
             gunicorn_cmd_args.append(
                 f'--access-logfile {self.args["ACCESS_LOG_FILE"]}')
@@ -127,6 +382,8 @@ class App(argschema.ArgSchemaParser):
 
         if self.args['debug']:
             gunicorn_cmd_args.append('--reload')
+        elif self.args['preload']:
+            gunicorn_cmd_args.append('--preload')
 
         os.environ['GUNICORN_CMD_ARGS'] = ' '.join(gunicorn_cmd_args)
         input_json_path = sys.argv[-1]
@@ -141,12 +398,39 @@ class App(argschema.ArgSchemaParser):
                        env=os.environ)
 
 
+def _create_table(table: Table):
+    """Creates `table` if it does not exist, for tables added after a
+    database was created. Several workers may try at once"""
+    try:
+        table.create(bind=db.engine, checkfirst=True)
+    except SQLAlchemyError:
+        if not inspect(db.engine).has_table(table.name):
+            raise
+
+
 def main(input_json_path: str, session_secret_key: str) -> Flask:
     with open(input_json_path) as f:
         input_data = json.load(f)
     app = App(input_data=input_data, args=[])
-    app = app.create_flask_app(session_secret_key=session_secret_key)
-    return app
+    flask_app = app.create_flask_app(session_secret_key=session_secret_key)
+    artifact_cache.prefetch_active_jobs(app=flask_app)
+    with flask_app.app_context():
+        # With preload, the database was used in the gunicorn master, whose
+        # connections must not be shared with the forked workers
+        db.engine.dispose()
+    if app.args['WARMUP_CACHES']:
+        if app.args['preload'] and not app.args['debug']:
+            # This is the gunicorn master. Warms up in each worker once it
+            # is forked
+            master_pid = os.getpid()
+
+            def start_warm_up_in_worker():
+                if os.getppid() == master_pid:
+                    warmup.start_warm_up(app=flask_app)
+            os.register_at_fork(after_in_child=start_warm_up_in_worker)
+        else:
+            warmup.start_warm_up(app=flask_app)
+    return flask_app
 
 
 if __name__ == '__main__':
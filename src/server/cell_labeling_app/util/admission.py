@@ -0,0 +1,165 @@
+"""Admission control for expensive endpoints.
+
+Expensive endpoints are grouped into pools. Each pool admits a limited number
+of concurrent requests on the host, across all gunicorn workers. Requests
+over the limit wait in a bounded queue for a limited time. Requests that
+can't be queued, or that wait too long, are rejected right away with a 503
+rather than tying up a worker. Cheap endpoints don't belong to any pool.
+The limits must leave enough workers free for them."""
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from flask import current_app
+
+from cell_labeling_app.util.deadline import bound_timeout
+from cell_labeling_app.util.file_locks import SlotSemaphore, file_lock
+
+
+class AdmissionRejectedError(RuntimeError):
+    """Raised when a request is not admitted to a pool"""
+    def __init__(self, pool: str, retry_after: int):
+        super().__init__(f'Too many concurrent {pool} requests')
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class AdmissionPool:
+    """Limits the number of concurrent requests of a kind on a host"""
+    def __init__(self,
+                 lock_dir: Union[str, Path],
+                 name: str,
+                 max_concurrent: int,
+                 max_queued: int,
+                 max_wait: float,
+                 retry_after: int = 2):
+        """
+        :param lock_dir:
+            Local directory for lock files and counters
+        :param name:
+            Pool name
+        :param max_concurrent:
+            Maximum number of requests running concurrently
+        :param max_queued:
+            Maximum number of requests waiting to run
+        :param max_wait:
+            Maximum time in seconds that a request waits to run. Bounded by
+            the time remaining until the request's deadline
+        :param retry_after:
+            Value of the Retry-After header sent on rejection
+        """
+        self._dir = Path(lock_dir) / name
+        self._name = name
+        self._max_wait = max_wait
+        self._retry_after = retry_after
+        self._active = SlotSemaphore(lock_dir=self._dir / 'active',
+                                     n_slots=max_concurrent)
+        self._queue = SlotSemaphore(lock_dir=self._dir / 'queue',
+                                    n_slots=max_queued)
+
+    @contextmanager
+    def admit(self):
+        """Runs the context once admitted
+
+        :raises AdmissionRejectedError:
+            If the queue is full or waiting timed out
+        """
+        slot = self._active.try_acquire()
+        if slot is None:
+            queue_slot = self._queue.try_acquire()
+            if queue_slot is None:
+                self._reject()
+            try:
+                slot = self._active.acquire(
+                    timeout=bound_timeout(timeout=self._max_wait),
+                    poll_interval=0.05)
+            finally:
+                queue_slot.release()
+            if slot is None:
+                self._reject()
+        try:
+            yield
+        finally:
+            slot.release()
+
+    def get_stats(self) -> Dict:
+        """
+        :return:
+            Dict with keys
+                - active: number of running requests
+                - queued: number of waiting requests
+                - rejected: total number of rejected requests
+                - max_concurrent
+                - max_queued
+        """
+        return {
+            'active': self._active.count_held(),
+            'queued': self._queue.count_held(),
+            'rejected': self._read_rejected_count(),
+            'max_concurrent': self._active.n_slots,
+            'max_queued': self._queue.n_slots
+        }
+
+    def _reject(self):
+        with file_lock(path=self._dir / 'rejected.lock'):
+            count = self._read_rejected_count()
+            with open(self._dir / 'rejected', 'w') as f:
+                f.write(str(count + 1))
+        raise AdmissionRejectedError(pool=self._name,
+                                     retry_after=self._retry_after)
+
+    def _read_rejected_count(self) -> int:
+        try:
+            with open(self._dir / 'rejected') as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+
+# Built once per process, rather than on every request
+_admission_pools: Optional[Dict[str, AdmissionPool]] = None
+_admission_pools_lock = threading.Lock()
+
+
+def get_admission_pools() -> Dict[str, AdmissionPool]:
+    """Gets this process's admission pools, configured from the app. Empty
+    if admission control is disabled"""
+    global _admission_pools
+    with _admission_pools_lock:
+        if _admission_pools is None:
+            lock_dir = current_app.config.get('ADMISSION_CONTROL_DIR')
+            pools = current_app.config.get('ADMISSION_CONTROL_POOLS')
+            if lock_dir is None or not pools:
+                _admission_pools = {}
+            else:
+                _admission_pools = {
+                    name: AdmissionPool(lock_dir=lock_dir, name=name,
+                                        **limits)
+                    for name, limits in pools.items()}
+        return _admission_pools
+
+
+def admit(pool: str):
+    """Context manager which runs the context once admitted to `pool`. Does
+    nothing if `pool` is not configured
+
+    :raises AdmissionRejectedError:
+        If not admitted
+    """
+    pools = get_admission_pools()
+    if pool not in pools:
+        return nullcontext()
+    return pools[pool].admit()
+
+
+def admission_controlled(pool: str):
+    """Decorator which admits the endpoint to `pool` before running it"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with admit(pool=pool):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,198 @@
+"""Cache of immutable arrays shared by all processes on a host.
+
+Each entry is a directory of .npy files in a local cache directory. The
+first process to need an entry builds it under a file lock, and every
+process then maps the same files read-only with `np.load(mmap_mode='r')`,
+so that the bytes are held once in the page cache rather than once per
+gunicorn worker.
+
+Keys must identify the content, e.g. include the identity of the source
+file, since entries are never rebuilt."""
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+import numpy as np
+from flask import current_app
+
+from cell_labeling_app.util.file_locks import file_lock
+from cell_labeling_app.util.hashing import content_hash
+from cell_labeling_app.util.memory_cache import MemoryCache
+
+TMP_PREFIX = '.tmp-'
+LOCK_DIR = '.locks'
+
+# Entries being built for longer than this are assumed to belong to a
+# process that died
+STALE_TMP_AGE = 60 * 60
+
+
+class ArrayCache:
+    """Directory of memory-mapped array entries"""
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: int):
+        """
+        :param cache_dir:
+            Local directory of the entries
+        :param max_bytes:
+            Least recently built entries are removed when the total size
+            exceeds this. Processes which have mapped a removed entry can
+            keep using it
+        """
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def cache_dir(self) -> Path:
+        return self._cache_dir
+
+    def get_path(self, key: str) -> Path:
+        return self._cache_dir / key
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Maps the arrays of an entry
+
+        :param key:
+            key
+        :return:
+            Map from array name to read-only memory-mapped array, or None if
+            the entry does not exist
+        """
+        # Held so that the entry isn't evicted while it is being mapped
+        with file_lock(path=self._get_lock_path(key=key)):
+            return self._load(key=key)
+
+    def get_or_build(self, key: str,
+                     build: Callable[[], Dict[str, np.ndarray]]) \
+            -> Dict[str, np.ndarray]:
+        """
+        Maps the arrays of an entry, building it if it does not exist. Only
+        one process builds an entry; the others wait for it.
+
+        :param key:
+            key
+        :param build:
+            Returns the arrays of the entry by name
+        :return:
+            See `get`
+        """
+        arrays = self.get(key=key)
+        if arrays is not None:
+            return arrays
+
+        with file_lock(path=self._get_lock_path(key=key)):
+            arrays = self._load(key=key)
+            if arrays is not None:
+                return arrays
+            self._put(key=key, arrays=build())
+            # Mapped before evicting, which may remove the new entry. The
+            # mapping stays valid
+            arrays = self._load(key=key)
+        self.evict()
+        return arrays
+
+    def evict(self):
+        """Removes the least recently built entries until the total size is
+        within budget"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            if entry.name == LOCK_DIR:
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+                size = sum([x.stat().st_size for x in os.scandir(entry.path)])
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+            if entry.name.startswith(TMP_PREFIX):
+                if now - mtime > STALE_TMP_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            entries.append((mtime, size, entry.path))
+
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            with file_lock(path=self._get_lock_path(key=Path(path).name)):
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def _get_lock_path(self, key: str) -> Path:
+        return self._cache_dir / LOCK_DIR / f'{key}.lock'
+
+    def _load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """`get`, without the entry lock, which the caller must hold"""
+        path = self.get_path(key=key)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return None
+        return {
+            Path(name).stem: np.load(path / name, mmap_mode='r')
+            for name in names if name.endswith('.npy')}
+
+    def _put(self, key: str, arrays: Dict[str, np.ndarray]):
+        """Writes the entry to a temporary directory, then renames it, so
+        that readers never see a partial entry"""
+        tmp_dir = tempfile.mkdtemp(dir=self._cache_dir, prefix=TMP_PREFIX)
+        try:
+            for name, arr in arrays.items():
+                np.save(Path(tmp_dir) / f'{name}.npy',
+                        np.ascontiguousarray(arr))
+            os.rename(tmp_dir, self.get_path(key=key))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+
+def get_array_cache() -> Optional[ArrayCache]:
+    """Gets the array cache configured for the app, or None if it is
+    disabled"""
+    cache_dir = current_app.config.get('ARRAY_CACHE_DIR')
+    if cache_dir is None:
+        return None
+    return ArrayCache(cache_dir=cache_dir,
+                      max_bytes=current_app.config['ARRAY_CACHE_MAX_BYTES'])
+
+
+def get_cached_arrays(namespace: str, key: object,
+                      build: Callable[[], Dict[str, np.ndarray]]) \
+        -> Dict[str, np.ndarray]:
+    """
+    Gets arrays from the shared array cache, building them if needed. If the
+    shared cache is disabled, the arrays are cached in this process.
+
+    :param namespace:
+        Prefix of the key
+    :param key:
+        Identifies the arrays (see `hashing.content_hash`)
+    :param build:
+        Returns the arrays by name
+    :return:
+        Map from array name to read-only array
+    """
+    key = f'{namespace}-{content_hash(obj=key)}'
+    array_cache = get_array_cache()
+    if array_cache is None:
+        return _local_cache.get_or_compute(
+            key=key, fn=lambda: _make_read_only(arrays=build()))
+    # Avoids mapping the files again on each call
+    return _mapped_cache.get_or_compute(
+        key=(str(array_cache.cache_dir), key),
+        fn=lambda: array_cache.get_or_build(key=key, build=build))
+
+
+def _make_read_only(arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    for arr in arrays.values():
+        arr.flags.writeable = False
+    return arrays
+
+
+_local_cache = MemoryCache(max_entries=256)
+_mapped_cache = MemoryCache(max_entries=1024)
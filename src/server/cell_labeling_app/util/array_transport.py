@@ -0,0 +1,114 @@
+"""Binary transport of numpy arrays.
+
+Arrays are sent as their raw little-endian buffer. The dtype and shape are
+sent as response headers, so that the client can wrap the body in a typed
+array without parsing it."""
+import zlib
+from typing import Iterable, Optional
+
+import numpy as np
+from flask import Request, Response
+
+ARRAY_MIMETYPE = 'application/x-ndarray'
+
+# dtypes that the client knows how to wrap in a typed array
+SUPPORTED_DTYPES = ('uint8', 'uint16', 'int16', 'int32', 'float16',
+                    'float32', 'float64')
+
+
+def client_accepts_array(request: Request) -> bool:
+    """Whether the client prefers a binary array over json
+
+    :param request:
+        The request
+    :return:
+        True if `ARRAY_MIMETYPE` is the best match for the accept header
+    """
+    best = request.accept_mimetypes.best_match(
+        ['application/json', ARRAY_MIMETYPE])
+    return best == ARRAY_MIMETYPE
+
+
+def client_accepts_compression(request: Request) -> bool:
+    """Whether the client requested compression and can decode it
+
+    :param request:
+        The request
+    :return:
+        True if the `compress` arg is set and the client accepts deflate
+        encoded responses
+    """
+    compress = request.args.get('compress', 'false').lower() == 'true'
+    return compress and 'deflate' in request.accept_encodings
+
+
+def to_uint8(arr: np.ndarray) -> np.ndarray:
+    """Linearly rescales `arr` to the range [0, 255]
+
+    :param arr:
+        Array to rescale
+    :return:
+        uint8 array
+    """
+    arr = arr.astype('float32')
+    low = arr.min()
+    high = arr.max()
+    if high == low:
+        return np.zeros(arr.shape, dtype='uint8')
+    arr -= low
+    arr *= 255.0 / (high - low)
+    return arr.astype('uint8')
+
+
+def make_array_response(
+        arr: np.ndarray,
+        dtype: Optional[str] = None,
+        compress: bool = False,
+        compression_level: int = 6,
+        headers: Optional[dict] = None) -> Response:
+    """Creates a response containing the raw buffer of `arr`
+
+    :param arr:
+        The array to send
+    :param dtype:
+        Cast `arr` to this dtype before sending. If None, the dtype of `arr`
+        is used
+    :param compress:
+        Whether to deflate the body. The browser transparently decodes it.
+    :param compression_level:
+        zlib compression level
+    :param headers:
+        Additional headers to include in the response
+    :return:
+        Response with headers `X-Array-Dtype` and `X-Array-Shape`
+    :raises ValueError:
+        If the dtype is not supported
+    """
+    dtype = np.dtype(dtype if dtype is not None else arr.dtype)
+    if dtype.name not in SUPPORTED_DTYPES:
+        raise ValueError(f'Unsupported dtype {dtype.name}. Must be one of '
+                         f'{SUPPORTED_DTYPES}')
+    arr = np.ascontiguousarray(arr, dtype=dtype.newbyteorder('<'))
+    body = memoryview(arr).cast('B')
+
+    response = Response(mimetype=ARRAY_MIMETYPE)
+    if compress:
+        response.set_data(zlib.compress(body, compression_level))
+        response.headers['Content-Encoding'] = 'deflate'
+    else:
+        response.set_data(body.tobytes())
+
+    expose_headers = ['X-Array-Dtype', 'X-Array-Shape']
+    response.headers['X-Array-Dtype'] = dtype.name
+    response.headers['X-Array-Shape'] = _format_shape(shape=arr.shape)
+    if headers is not None:
+        for k, v in headers.items():
+            response.headers[k] = v
+            expose_headers.append(k)
+    response.headers['Access-Control-Expose-Headers'] = \
+        ', '.join(expose_headers)
+    return response
+
+
+def _format_shape(shape: Iterable[int]) -> str:
+    return ','.join([str(x) for x in shape])
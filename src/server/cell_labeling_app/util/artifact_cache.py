@@ -0,0 +1,286 @@
+"""Local read-through cache of artifact files.
+
+ARTIFACT_DIR is typically on a slow shared filesystem. Artifact files are
+copied to a local cache directory in the background, and
+`util.get_artifacts_path` resolves to the local copy once it is present.
+Until then, and whenever the copy is out of date, reads go to the shared
+filesystem.
+
+The local copy keeps the name, size and modification time of the source
+file, so the file identities used in cache keys (see
+`util.get_artifact_identity`) are the same for both. A local copy is valid
+as long as its size and modification time match the source. Copies are
+written to a temporary file and atomically renamed into place, so the cache
+can be shared by all gunicorn workers on a host, and only one process
+copies a file at a time. Least recently used copies are evicted once the
+total size exceeds the byte budget."""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional, Set, Union
+
+from flask import Flask, current_app
+
+from cell_labeling_app.util.file_locks import file_lock
+
+logger = logging.getLogger(__name__)
+
+TMP_PREFIX = '.tmp-'
+LOCK_DIR = '.locks'
+
+# Last use of each copy is tracked by the modification time of a marker
+# file, since the modification time of the copy must match the source
+USED_DIR = '.used'
+
+# Temporary files older than this are assumed to be left over from a crashed
+# process and are removed during eviction
+STALE_TMP_FILE_AGE = 6 * 60 * 60
+
+
+class ArtifactCache:
+    """Local copies of artifact files, with a byte budget"""
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: int):
+        """
+        :param cache_dir:
+            Local directory to copy artifact files to
+        :param max_bytes:
+            Maximum total size of the copies. Least recently used copies are
+            evicted once this is exceeded
+        """
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        (self._cache_dir / USED_DIR).mkdir(exist_ok=True)
+
+    @property
+    def cache_dir(self) -> Path:
+        return self._cache_dir
+
+    def get_path(self, source: Path) -> Path:
+        """Path of the local copy of `source`"""
+        return self._cache_dir / source.name
+
+    def get(self, source: Path) -> Optional[Path]:
+        """
+        Gets the local copy of `source` and marks it as recently used
+
+        :param source:
+            Path to the artifact file in ARTIFACT_DIR
+        :return:
+            Path to the local copy, or None if there is no copy or it is out
+            of date
+        """
+        path = self.get_path(source=source)
+        try:
+            local_stat = path.stat()
+        except FileNotFoundError:
+            return None
+        source_stat = source.stat()
+        if (local_stat.st_size != source_stat.st_size or
+                local_stat.st_mtime_ns != source_stat.st_mtime_ns):
+            return None
+        self._touch(name=path.name)
+        return path
+
+    def fetch(self, source: Path) -> Optional[Path]:
+        """
+        Copies `source` into the cache unless an up-to-date copy exists.
+        Processes fetching the same file wait for a single copy.
+
+        :param source:
+            Path to the artifact file in ARTIFACT_DIR
+        :return:
+            Path to the local copy, or None if `source` is larger than the
+            cache
+        """
+        path = self.get(source=source)
+        if path is not None:
+            return path
+        if source.stat().st_size > self._max_bytes:
+            return None
+
+        with file_lock(path=self._cache_dir / LOCK_DIR /
+                       f'{source.name}.lock'):
+            path = self.get(source=source)
+            if path is not None:
+                return path
+            start = time.time()
+            path = self._copy(source=source)
+        logger.info(f'Copied {source} to {path} in '
+                    f'{time.time() - start:.1f}s')
+        self.evict(keep=path.name)
+        return path
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Removes least recently used copies until the total size is within
+        budget
+
+        :param keep:
+            Name of a copy not to remove, e.g. the one just fetched
+        """
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            if entry.name in (LOCK_DIR, USED_DIR):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+            if entry.name.startswith(TMP_PREFIX):
+                if now - stat.st_mtime > STALE_TMP_FILE_AGE:
+                    _remove(path=entry.path)
+                continue
+            entries.append((self._get_last_used(name=entry.name,
+                                                default=stat.st_mtime),
+                            stat.st_size, entry.name))
+
+        total = sum([size for _, size, _ in entries])
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            if name == keep:
+                continue
+            # Processes which already opened the copy can keep reading it
+            _remove(path=self._cache_dir / name)
+            _remove(path=self._cache_dir / USED_DIR / name)
+            total -= size
+
+    def _copy(self, source: Path) -> Path:
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir,
+                                        prefix=TMP_PREFIX,
+                                        suffix=source.suffix)
+        os.close(fd)
+        try:
+            # Also copies the modification time
+            shutil.copy2(source, tmp_path)
+            path = self.get_path(source=source)
+            os.replace(tmp_path, path)
+        except BaseException:
+            _remove(path=tmp_path)
+            raise
+        self._touch(name=path.name)
+        return path
+
+    def _touch(self, name: str):
+        (self._cache_dir / USED_DIR / name).touch()
+
+    def _get_last_used(self, name: str, default: float) -> float:
+        try:
+            return (self._cache_dir / USED_DIR / name).stat().st_mtime
+        except FileNotFoundError:
+            return default
+
+
+def get_artifact_cache() -> Optional[ArtifactCache]:
+    """Gets the artifact cache configured for the app, or None if it is
+    disabled"""
+    cache_dir = current_app.config.get('ARTIFACT_CACHE_DIR')
+    if cache_dir is None:
+        return None
+    return ArtifactCache(
+        cache_dir=cache_dir,
+        max_bytes=current_app.config['ARTIFACT_CACHE_MAX_BYTES'])
+
+
+def resolve_artifact_path(source: Path) -> Path:
+    """
+    Gets the local copy of an artifact file if there is an up-to-date one.
+    Otherwise, starts copying it in the background and returns `source`.
+
+    :param source:
+        Path to the artifact file in ARTIFACT_DIR
+    :return:
+        Path to read the artifact file from
+    """
+    artifact_cache = get_artifact_cache()
+    if artifact_cache is None:
+        return source
+    path = artifact_cache.get(source=source)
+    if path is not None:
+        return path
+    fetch_in_background(artifact_cache=artifact_cache, sources=[source])
+    return source
+
+
+def fetch_in_background(artifact_cache: ArtifactCache,
+                        sources: Iterable[Path]):
+    """Copies `sources` into the cache one at a time in a background
+    thread. Files already being copied by this process are skipped"""
+    for source in sources:
+        with _in_progress_lock:
+            if source in _in_progress:
+                continue
+            _in_progress.add(source)
+        _executor.submit(_fetch, artifact_cache=artifact_cache,
+                         source=source)
+
+
+def prefetch_active_jobs(app: Flask):
+    """Copies the artifact files of the experiments of the active labeling
+    jobs into the cache in the background. Does nothing if the cache is
+    disabled"""
+    # Imported here since warmup depends on util, which depends on this
+    from cell_labeling_app.database.database import db
+    from cell_labeling_app.database.schemas import JobRegion
+    from cell_labeling_app.util import util, warmup
+
+    with app.app_context():
+        artifact_cache = get_artifact_cache()
+        if artifact_cache is None:
+            return
+        try:
+            experiment_ids = [
+                x.experiment_id for x in
+                db.session.query(JobRegion.experiment_id)
+                .filter(JobRegion.job_id.in_(warmup.get_active_job_ids()))
+                .distinct()
+                .all()]
+            sources = [util.get_source_artifacts_path(experiment_id=x)
+                       for x in experiment_ids]
+        finally:
+            db.session.remove()
+    fetch_in_background(artifact_cache=artifact_cache, sources=sources)
+
+
+def _fetch(artifact_cache: ArtifactCache, source: Path):
+    try:
+        artifact_cache.fetch(source=source)
+    except Exception:
+        logger.exception(f'Failed to copy {source} to the artifact cache')
+    finally:
+        with _in_progress_lock:
+            _in_progress.discard(source)
+
+
+def _remove(path: Union[str, Path]):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # Removed by another process
+        pass
+
+
+# Copies are done one at a time, to limit the load on the shared filesystem
+_executor = ThreadPoolExecutor(max_workers=1)
+_in_progress: Set[Path] = set()
+_in_progress_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """The copying thread is not inherited by forked gunicorn workers, e.g.
+    with --preload"""
+    global _executor, _in_progress, _in_progress_lock
+    _executor = ThreadPoolExecutor(max_workers=1)
+    _in_progress = set()
+    _in_progress_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,118 @@
+"""Compact encoding of ROI contours.
+
+Contours are found with `CHAIN_APPROX_NONE`, i.e. with every boundary
+pixel. Most of these points lie on straight runs. The encoding drops them
+(or, given a tolerance, simplifies the contour further) and delta encodes
+the remaining points. The points of all contours of all ROIs are sent as
+one flat array of x, y pairs plus offsets, rather than as nested lists.
+
+Contour j is points[contour_offsets[j]:contour_offsets[j + 1]]. Its first
+point is absolute and each following point is relative to the previous
+one. The contours of ROI i are roi_contour_offsets[i] to
+roi_contour_offsets[i + 1]."""
+from typing import Dict, List, Union
+
+import numpy as np
+
+# Encodings of `get_roi_contours` responses
+CONTOUR_ENCODINGS = ('nested', 'delta')
+
+
+def simplify_contour(contour: Union[np.ndarray, List],
+                     tolerance: float = 0.0) -> np.ndarray:
+    """
+    Simplifies a closed contour
+
+    :param contour:
+        (n points, 2) x, y coordinates, or (n points, 1, 2) as returned by
+        cv2.findContours
+    :param tolerance:
+        If 0, only the points in the middle of straight runs are removed,
+        so the contour draws exactly the same polygon. Otherwise the
+        contour is simplified with Douglas-Peucker, moving the outline by
+        at most `tolerance` pixels
+    :return:
+        (n simplified points, 2) int32 array
+    """
+    points = np.asarray(contour, dtype='int32').reshape(-1, 2)
+    if len(points) < 3:
+        return points
+
+    if tolerance > 0:
+        import cv2
+
+        return cv2.approxPolyDP(points.reshape(-1, 1, 2),
+                                epsilon=tolerance,
+                                closed=True).reshape(-1, 2)
+
+    incoming = points - np.roll(points, 1, axis=0)
+    outgoing = np.roll(points, -1, axis=0) - points
+    cross = incoming[:, 0] * outgoing[:, 1] - incoming[:, 1] * outgoing[:, 0]
+    dot = (incoming * outgoing).sum(axis=1)
+    # A point is redundant if the outline continues in the same direction
+    redundant = (cross == 0) & (dot > 0)
+    if redundant.all():
+        return points[:1]
+    return points[~redundant]
+
+
+def encode_contours(rois: List[Dict], tolerance: float = 0.0) -> Dict:
+    """
+    Encodes the contours of ROIs (see the module docstring)
+
+    :param rois:
+        Output of `get_roi_contours_in_region`
+    :param tolerance:
+        See `simplify_contour`
+    :return:
+        dict with keys
+            - rois: `rois` without their contours
+            - points: flat array of delta encoded x, y values
+            - contour_offsets: offsets of each contour into the points
+                (counted in points, not values)
+            - roi_contour_offsets: offsets of the contours of each ROI
+    """
+    points = []
+    contour_offsets = [0]
+    roi_contour_offsets = [0]
+    for roi in rois:
+        for contour in roi['contours']:
+            contour = simplify_contour(contour=contour, tolerance=tolerance)
+            deltas = contour.copy()
+            deltas[1:] -= contour[:-1]
+            points.append(deltas)
+            contour_offsets.append(contour_offsets[-1] + len(contour))
+        roi_contour_offsets.append(len(contour_offsets) - 1)
+
+    points = np.concatenate(points) if points else \
+        np.zeros((0, 2), dtype='int32')
+    return {
+        'rois': [{k: v for k, v in roi.items() if k != 'contours'}
+                 for roi in rois],
+        'points': points.ravel(),
+        'contour_offsets': np.array(contour_offsets, dtype='int64'),
+        'roi_contour_offsets': np.array(roi_contour_offsets, dtype='int64')
+    }
+
+
+def decode_contours(encoded: Dict) -> List[Dict]:
+    """
+    Inverse of `encode_contours`
+
+    :param encoded:
+        Output of `encode_contours`
+    :return:
+        The ROIs, with contours as lists of x, y coordinates
+    """
+    points = np.array(encoded['points'], dtype='int32').reshape(-1, 2)
+    contour_offsets = encoded['contour_offsets']
+    roi_contour_offsets = encoded['roi_contour_offsets']
+    rois = []
+    for i, roi in enumerate(encoded['rois']):
+        contours = [
+            np.cumsum(points[contour_offsets[j]:contour_offsets[j + 1]],
+                      axis=0).tolist()
+            for j in range(roi_contour_offsets[i],
+                           roi_contour_offsets[i + 1])]
+        rois.append({**roi, 'contours': contours})
+    return rois
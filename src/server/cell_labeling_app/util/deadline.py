@@ -0,0 +1,63 @@
+"""Request deadlines.
+
+gunicorn kills a worker whose request runs past its timeout, along with the
+other requests the worker is serving. So that slow requests get a 503 or 504
+instead, each request has a deadline REQUEST_TIMEOUT seconds after it starts,
+well under gunicorn's timeout. Every wait on the way (admission queues,
+identical computations by other requests, the process pool) is bounded by
+the time remaining, and raises `TaskTimeoutError` once it has run out.
+
+Outside of a request, e.g. in background threads and pool processes, there
+is no deadline."""
+import time
+from typing import Optional
+
+from flask import Flask, current_app, g, has_request_context
+
+
+class TaskTimeoutError(TimeoutError):
+    """Raised when a request runs out of time waiting for work"""
+    def __init__(self, what: str, timeout: float):
+        super().__init__(f'{what} did not finish within {timeout:.1f}s')
+        self.timeout = timeout
+
+
+def init_app(app: Flask):
+    """Starts the deadline of each request"""
+    app.before_request(_start_deadline)
+
+
+def get_remaining_time() -> Optional[float]:
+    """
+    :return:
+        Seconds until the current request's deadline, at least 0, or None if
+        there is no deadline
+    """
+    if not has_request_context():
+        return None
+    deadline = g.get('request_deadline')
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def bound_timeout(timeout: Optional[float] = None) -> Optional[float]:
+    """
+    :param timeout:
+        A timeout in seconds, or None for no timeout
+    :return:
+        `timeout`, bounded by the time remaining until the current request's
+        deadline. None if neither is set
+    """
+    remaining = get_remaining_time()
+    if remaining is None:
+        return timeout
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+def _start_deadline():
+    timeout = current_app.config.get('REQUEST_TIMEOUT')
+    g.request_deadline = time.monotonic() + timeout \
+        if timeout is not None else None
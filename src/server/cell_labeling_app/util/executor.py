@@ -0,0 +1,119 @@
+"""Process pool for CPU-bound and HDF5-bound work.
+
+With the threaded worker class, the requests handled by a worker share a
+process. CPU-bound work (e.g. finding contours) holds the GIL, and h5py
+serializes all HDF5 calls of a process behind a single lock, so such work
+from requests for unrelated experiments would run one at a time.
+`run_in_process` runs it in a pool of processes instead.
+
+Tasks have a timeout, by default the time remaining until the request's
+deadline (see `deadline`), so that one slow task can't hold a request past
+gunicorn's timeout and get the whole worker killed. A task that times out
+raises `TaskTimeoutError`, which endpoints return as a 504. If it has not
+started yet, it is cancelled. A task that has started runs to completion,
+since the pool can't stop a running task without breaking; the pool is
+bounded, so at most PROCESS_POOL_SIZE such tasks run at once.
+
+Pool processes have an app context with the app config listed in
+`PROCESS_CONFIG_KEYS`, so that functions which read the config
+(e.g. `util.get_artifacts_path`) can run there. They have no database
+session."""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, \
+    TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional, TypeVar
+
+from flask import Flask, current_app, has_app_context
+
+from cell_labeling_app.util.deadline import TaskTimeoutError, bound_timeout
+
+# App config copied to the pool processes
+PROCESS_CONFIG_KEYS = (
+    'ARTIFACT_DIR',
+    'ARTIFACT_CACHE_DIR',
+    'ARTIFACT_CACHE_MAX_BYTES',
+    'PREDICTIONS_DIR',
+    'FIELD_OF_VIEW_DIMENSIONS',
+    'ARRAY_CACHE_DIR',
+    'ARRAY_CACHE_MAX_BYTES',
+    'SINGLE_FLIGHT_DIR',
+    'SINGLE_FLIGHT_TTL',
+    'VIDEO_CACHE_DIR',
+    'VIDEO_CACHE_MAX_BYTES'
+)
+
+T = TypeVar('T')
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> Optional[ProcessPoolExecutor]:
+    """Gets this process's pool, sized by the PROCESS_POOL_SIZE config, or
+    None if it is disabled. Must be called within an app context"""
+    global _executor, _executor_pid
+
+    n_processes = current_app.config.get('PROCESS_POOL_SIZE') or 0
+    if n_processes == 0:
+        return None
+    with _executor_lock:
+        # A pool inherited from the parent of a forked worker is unusable
+        if _executor is None or _executor_pid != os.getpid():
+            config = {k: current_app.config.get(k)
+                      for k in PROCESS_CONFIG_KEYS}
+            _executor = ProcessPoolExecutor(
+                max_workers=n_processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_process,
+                initargs=(config,))
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def run_in_process(fn: Callable[..., T], timeout: Optional[float] = None,
+                   **kwargs) -> T:
+    """
+    Runs `fn` in the process pool and waits for the result. Runs it in this
+    process, without a timeout, if the pool is disabled or there is no app
+    context.
+
+    :param fn:
+        Module-level function. It and its arguments and result must be
+        picklable
+    :param timeout:
+        Maximum time in seconds to wait for the result, including time
+        waiting for a free process. Bounded by the time remaining until the
+        request's deadline. Without either, waits until the task finishes
+    :param kwargs:
+        kwargs passed to `fn`
+    :return:
+        The result of `fn`
+    :raises TaskTimeoutError:
+        If the task did not finish in time. It is cancelled if it has not
+        started
+    """
+    executor = get_executor() if has_app_context() else None
+    if executor is None:
+        return fn(**kwargs)
+    timeout = bound_timeout(timeout=timeout)
+    if timeout is not None and timeout <= 0:
+        raise TaskTimeoutError(what=fn.__name__, timeout=0)
+
+    future = executor.submit(fn, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise TaskTimeoutError(what=fn.__name__, timeout=timeout)
+
+
+def _init_process(config: Dict):
+    """Gives a pool process an app context for the lifetime of the
+    process"""
+    app = Flask(__name__)
+    app.config.update(config)
+    app.app_context().push()
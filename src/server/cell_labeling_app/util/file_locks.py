@@ -0,0 +1,177 @@
+"""Advisory file locks, used to coordinate gunicorn workers and their child
+processes on a single host. Locks are released by the OS if the holding
+process dies."""
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Union, Callable
+
+from cell_labeling_app.util.deadline import TaskTimeoutError
+
+
+class Slot:
+    """A held slot of a `SlotSemaphore`"""
+    def __init__(self, fd: int, index: int):
+        self._fd = fd
+        self._index = index
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    def release(self):
+        if self._fd is None:
+            return
+        # Clears the holder pid, see `SlotSemaphore.count_held`
+        os.ftruncate(self._fd, 0)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class SlotSemaphore:
+    """A counting semaphore shared across processes. Each of the `n_slots`
+    slots is an exclusive lock on a file in `lock_dir`. The holder of a slot
+    writes its pid to the file, so that held slots can be counted without
+    locking"""
+    def __init__(self, lock_dir: Union[str, Path], n_slots: int):
+        """
+        :param lock_dir:
+            Directory to store the lock files in
+        :param n_slots:
+            Number of slots
+        """
+        self._lock_dir = Path(lock_dir)
+        self._n_slots = n_slots
+        self._lock_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def n_slots(self) -> int:
+        return self._n_slots
+
+    def try_acquire(self) -> Optional[Slot]:
+        """Acquires a free slot without blocking
+
+        :return:
+            The slot, or None if all slots are held
+        """
+        for i in range(self._n_slots):
+            fd = os.open(self._lock_dir / f'{i}.lock',
+                         os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(os.getpid()).encode('utf-8'), 0)
+            return Slot(fd=fd, index=i)
+        return None
+
+    def acquire(self,
+                timeout: Optional[float] = None,
+                poll_interval: float = 0.1,
+                should_abort: Optional[Callable[[], bool]] = None) \
+            -> Optional[Slot]:
+        """Acquires a slot, waiting until one is free
+
+        :param timeout:
+            Maximum time to wait in seconds. Waits indefinitely if None
+        :param poll_interval:
+            Time between attempts in seconds
+        :param should_abort:
+            Called between attempts. Stops waiting if it returns True
+        :return:
+            The slot, or None if it could not be acquired in time or
+            waiting was aborted
+        """
+        start = time.monotonic()
+        while True:
+            slot = self.try_acquire()
+            if slot is not None:
+                return slot
+            if should_abort is not None and should_abort():
+                return None
+            if timeout is not None and time.monotonic() - start >= timeout:
+                return None
+            time.sleep(poll_interval)
+
+    def count_held(self) -> int:
+        """Number of slots currently held by any process. This is a snapshot
+        and may be out of date as soon as it is returned.
+
+        The slot files are read rather than locked, since briefly taking a
+        free slot's lock would make it look held to `try_acquire`. A slot
+        counts as held if it names a live process: a process that dies
+        while holding a slot leaves its pid behind"""
+        n = 0
+        for i in range(self._n_slots):
+            try:
+                with open(self._lock_dir / f'{i}.lock') as f:
+                    pid = f.read()
+            except FileNotFoundError:
+                continue
+            if pid and _is_process_alive(pid=int(pid)):
+                n += 1
+        return n
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Owned by another user
+        pass
+    return True
+
+
+@contextmanager
+def file_lock(path: Union[str, Path], timeout: Optional[float] = None,
+              poll_interval: float = 0.05):
+    """Holds an exclusive lock on `path` while in the context
+
+    :param path:
+        Path of the lock file
+    :param timeout:
+        Maximum time in seconds to wait for the lock. Waits indefinitely if
+        None
+    :param poll_interval:
+        Time between attempts in seconds, if `timeout` is given
+    :raises TaskTimeoutError:
+        If the lock could not be acquired in time
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            _flock_with_timeout(fd=fd, path=path, timeout=timeout,
+                                poll_interval=poll_interval)
+    except BaseException:
+        os.close(fd)
+        raise
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _flock_with_timeout(fd: int, path: Union[str, Path], timeout: float,
+                        poll_interval: float):
+    start = time.monotonic()
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+        if time.monotonic() - start >= timeout:
+            raise TaskTimeoutError(what=f'Waiting for {Path(path).name}',
+                                   timeout=timeout)
+        time.sleep(poll_interval)
@@ -0,0 +1,52 @@
+"""Deterministic hashing of request parameters, used to build cache keys"""
+import hashlib
+import json
+from typing import Any
+
+import numpy as np
+
+
+def content_hash(obj: Any) -> str:
+    """
+    Hashes `obj`, which may be any combination of dicts, lists, tuples,
+    numpy arrays and json-serializable scalars
+
+    :param obj:
+        object to hash
+    :return:
+        hex digest
+    """
+    h = hashlib.sha256()
+    update_hash(h=h, obj=obj)
+    return h.hexdigest()
+
+
+def update_hash(h: Any, obj: Any):
+    """Recursively feeds `obj` into hash `h`. Arrays are hashed by their
+    bytes so that masks don't need to be converted to lists"""
+    if isinstance(obj, (dict, list, tuple)):
+        try:
+            # Fast path for containers of plain python objects
+            h.update(json.dumps(obj, sort_keys=True).encode())
+            return
+        except TypeError:
+            pass
+
+    if isinstance(obj, dict):
+        h.update(b'{')
+        for k in sorted(obj.keys(), key=str):
+            update_hash(h=h, obj=str(k))
+            update_hash(h=h, obj=obj[k])
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for x in obj:
+            update_hash(h=h, obj=x)
+        h.update(b']')
+    elif isinstance(obj, np.ndarray):
+        h.update(f'ndarray{obj.dtype.str}{obj.shape}'.encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        update_hash(h=h, obj=obj.item())
+    else:
+        h.update(json.dumps(obj).encode())
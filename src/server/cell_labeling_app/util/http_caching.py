@@ -0,0 +1,61 @@
+"""HTTP caching of responses which only change when the artifact or
+predictions files change.
+
+The ETag is a hash of the request (path, query args, and the headers which
+select the encoding) and of the identity (name, size, modification time) of
+the files the response is derived from. It is computed without computing
+the response body, so a revalidation whose ETag matches gets a 304 without
+any artifact reads."""
+import functools
+from typing import Callable, Dict
+
+from flask import current_app, make_response, request
+
+from cell_labeling_app.util.hashing import content_hash
+
+# Bump when the format of a cached response changes, so that browsers don't
+# revalidate old responses
+ETAG_VERSION = 1
+
+# Request headers that the responses depend on
+VARY_HEADERS = ('Accept', 'Accept-Encoding')
+
+
+def http_cached(identity: Callable[[], Dict]):
+    """
+    Decorator which adds a strong ETag and `Cache-Control: private,
+    max-age` to the responses of an endpoint to GET requests, and responds
+    with a 304 if the request's If-None-Match matches the ETag. max-age is
+    given by the HTTP_CACHE_MAX_AGE config.
+
+    :param identity:
+        Called within the request. Returns what the response is derived
+        from besides the request itself, e.g. the identity of the artifact
+        file. Must be cheap to compute
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return fn(*args, **kwargs)
+            etag = content_hash(obj={
+                'version': ETAG_VERSION,
+                'path': request.path,
+                'args': sorted(request.args.items(multi=True)),
+                'headers': [request.headers.get(x) for x in VARY_HEADERS],
+                'identity': identity()
+            })
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.max_age = \
+                current_app.config.get('HTTP_CACHE_MAX_AGE', 0)
+            response.vary.update(VARY_HEADERS)
+            return response
+        return wrapper
+    return decorator
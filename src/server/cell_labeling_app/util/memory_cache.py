@@ -0,0 +1,49 @@
+"""In-process cache of computed values"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class MemoryCache:
+    """Thread-safe least-recently-used cache, bounded by number of entries.
+    Cached values are shared between callers and must not be modified."""
+    def __init__(self, max_entries: int):
+        """
+        :param max_entries:
+            Maximum number of entries. The least recently used entries are
+            evicted beyond this
+        """
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Gets the value of `key`, computing it with `fn` if not cached
+
+        :param key:
+            key
+        :param fn:
+            Computes the value. Not called with the lock held, so two threads
+            may compute the same value at once
+        :return:
+            The value
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = fn()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
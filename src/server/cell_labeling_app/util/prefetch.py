@@ -0,0 +1,232 @@
+"""Per-user prefetch of the next regions to label.
+
+Each user has a small queue of regions assigned ahead of time
+(`PrefetchedRegion`). While the user labels the current region, the data of
+the queued regions is computed in a background thread: the ROI contours, the
+region bundle, if REGION_BUNDLE_DIR is set, and the default ROI videos, if
+PREFETCH_VIDEOS is set. Videos are rendered by a low priority render queue
+with its own limits, so that prefetching doesn't hold up or fill the
+interactive render queue. When the user asks for the next region it is taken
+from the queue, so that it loads from cache.
+
+A queued region is dropped if the user has labeled it, or if other labelers
+completed it in the meantime."""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Set, Tuple
+
+from flask import current_app, Flask
+
+from cell_labeling_app.database.database import db
+from cell_labeling_app.database.schemas import JobRegion, PrefetchedRegion, \
+    UserLabels
+from cell_labeling_app.util import util
+from cell_labeling_app.util.region_bundles import get_region_bundle_store, \
+    build_region_bundle
+
+logger = logging.getLogger(__name__)
+
+
+def pop_prefetched_region(job_id: int, user_id: str) -> Optional[JobRegion]:
+    """
+    Takes the next region from the user's prefetch queue. Regions that are
+    no longer valid are dropped.
+
+    :param job_id:
+        Job id
+    :param user_id:
+        User id
+    :return:
+        The region, or None if the queue is empty
+    """
+    queued = _get_queue(job_id=job_id, user_id=user_id)
+    if not queued:
+        return None
+    invalid = _get_invalid_region_ids(
+        job_id=job_id, user_id=user_id,
+        region_ids=[x.region_id for x in queued])
+
+    next_region = None
+    for prefetched in queued:
+        if next_region is None and prefetched.region_id not in invalid:
+            next_region = util.get_region(region_id=prefetched.region_id)
+            db.session.delete(prefetched)
+        elif prefetched.region_id in invalid:
+            db.session.delete(prefetched)
+    db.session.commit()
+    return next_region
+
+
+def refill_prefetch_queue(job_id: int, user_id: str,
+                          current_region_id: Optional[int],
+                          queue_size: int) -> List[JobRegion]:
+    """
+    Assigns regions to the user's prefetch queue until it holds
+    `queue_size` regions
+
+    :param job_id:
+        Job id
+    :param user_id:
+        User id
+    :param current_region_id:
+        The region the user is labeling, which should not be queued
+    :param queue_size:
+        Number of regions to keep in the queue
+    :return:
+        The newly queued regions
+    """
+    queued = [x.region_id for x in _get_queue(job_id=job_id,
+                                              user_id=user_id)]
+    exclude = list(queued)
+    if current_region_id is not None:
+        exclude.append(current_region_id)
+
+    added = []
+    for _ in range(queue_size - len(queued)):
+        region = util.get_next_region(job_id=job_id, user_id=user_id,
+                                      exclude_region_ids=exclude)
+        if region is None:
+            break
+        db.session.add(PrefetchedRegion(user_id=user_id, region_id=region.id,
+                                        job_id=job_id))
+        exclude.append(region.id)
+        added.append(region)
+    db.session.commit()
+    return added
+
+
+def invalidate_region(region_id: int):
+    """
+    Drops `region_id` from all prefetch queues if it has enough labels.
+    Should be called when labels are submitted for the region
+
+    :param region_id:
+        region id
+    """
+    required = current_app.config.get('LABELERS_REQUIRED_PER_REGION')
+    if required is None:
+        return
+    n_labelers = (db.session
+                  .query(UserLabels.user_id)
+                  .filter(UserLabels.region_id == region_id)
+                  .distinct()
+                  .count())
+    if n_labelers >= required:
+        (db.session
+         .query(PrefetchedRegion)
+         .filter(PrefetchedRegion.region_id == region_id)
+         .delete())
+        db.session.commit()
+
+
+def warm_region(region: JobRegion):
+    """
+    Computes and caches the data of a region. Must be called within an app
+    context.
+
+    :param region:
+        region
+    """
+    # Through the cached path used when there is no bundle. The FOV bounds
+    # are derived from the contours
+    util.get_roi_contours_in_region(experiment_id=region.experiment_id,
+                                    region=region)
+
+    bundle_store = get_region_bundle_store()
+    if bundle_store is not None and bundle_store.get(region=region) is None:
+        bundle_store.put(region_id=region.id,
+                         bundle=build_region_bundle(region=region))
+
+    if current_app.config.get('PREFETCH_VIDEOS') and \
+            current_app.config.get('VIDEO_CACHE_DIR') is not None:
+        # Imported here so that prefetching regions doesn't require the
+        # video rendering dependencies
+        from cell_labeling_app.util.video_rendering import \
+            get_prefetch_render_queue, RenderQueueFullError
+
+        render_queue = get_prefetch_render_queue()
+        video_kwargs = util.get_default_thumbnail_video_kwargs(region=region)
+        for kwargs in video_kwargs.values():
+            try:
+                render_queue.submit(**kwargs)
+            except RenderQueueFullError:
+                logger.info('Prefetch render queue is full. Not prefetching '
+                            f'the remaining videos of region {region.id}')
+                break
+
+
+def schedule_prefetch(job_id: int, user_id: str,
+                      current_region_id: Optional[int]):
+    """
+    Refills the user's prefetch queue and warms the queued regions, in a
+    background thread. Does nothing if prefetching is disabled or a refill
+    for this user is already running
+
+    :param job_id:
+        Job id
+    :param user_id:
+        User id
+    :param current_region_id:
+        The region the user is labeling
+    """
+    queue_size = current_app.config.get('PREFETCH_QUEUE_SIZE', 0)
+    if not queue_size:
+        return
+    key = (job_id, user_id)
+    with _in_progress_lock:
+        if key in _in_progress:
+            return
+        _in_progress.add(key)
+    _executor.submit(_prefetch,
+                     app=current_app._get_current_object(),
+                     job_id=job_id,
+                     user_id=user_id,
+                     current_region_id=current_region_id,
+                     queue_size=queue_size)
+
+
+def _prefetch(app: Flask, job_id: int, user_id: str,
+              current_region_id: Optional[int], queue_size: int):
+    """Runs in the background thread"""
+    try:
+        with app.app_context():
+            refill_prefetch_queue(job_id=job_id, user_id=user_id,
+                                  current_region_id=current_region_id,
+                                  queue_size=queue_size)
+            for prefetched in _get_queue(job_id=job_id, user_id=user_id):
+                warm_region(
+                    region=util.get_region(region_id=prefetched.region_id))
+    except Exception:
+        logger.exception(f'Failed to prefetch regions for user {user_id}')
+    finally:
+        with _in_progress_lock:
+            _in_progress.discard((job_id, user_id))
+
+
+def _get_queue(job_id: int, user_id: str) -> List[PrefetchedRegion]:
+    return (db.session
+            .query(PrefetchedRegion)
+            .filter(PrefetchedRegion.job_id == job_id,
+                    PrefetchedRegion.user_id == user_id)
+            .order_by(PrefetchedRegion.timestamp)
+            .all())
+
+
+def _get_invalid_region_ids(job_id: int, user_id: str,
+                            region_ids: List[int]) -> Set[int]:
+    """Gets the regions in `region_ids` which the user has labeled or which
+    have enough labels"""
+    user_has_labeled = util.get_user_has_labeled(job_id=job_id,
+                                                 user_id=user_id)
+    invalid = set([x.region_id for x in user_has_labeled])
+    if current_app.config.get('LABELERS_REQUIRED_PER_REGION') is not None:
+        invalid |= set(util.get_completed_regions(job_id=job_id))
+    return invalid & set(region_ids)
+
+
+# Prefetching runs in a single thread per worker, so that it doesn't compete
+# much with serving requests
+_executor = ThreadPoolExecutor(max_workers=1)
+_in_progress: Set[Tuple[int, str]] = set()
+_in_progress_lock = threading.Lock()
@@ -0,0 +1,149 @@
+"""Projection images for the client: cropped to a region, optionally
+contrast-stretched to uint8 using the percentile table of the projection,
+and optionally encoded as PNG. Projection stats and encoded images are
+cached in the shared array cache (see `array_cache`), so they are computed
+once per host rather than on each request."""
+import math
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from cell_labeling_app.imaging_plane_artifacts import ArtifactFile, \
+    ProjectionStats
+from cell_labeling_app.util import util
+from cell_labeling_app.util.array_cache import get_cached_arrays
+from cell_labeling_app.util.array_transport import to_uint8
+
+
+def get_projection_stats(experiment_id: str,
+                         projection_type: str) -> ProjectionStats:
+    """
+    Gets the histogram and percentile table of a projection. These are read
+    from the artifact file if they have been built (see
+    `build_projection_stats`), else computed from the projection
+
+    :param experiment_id:
+        experiment id
+    :param projection_type:
+        See `ArtifactFile.get_projection`
+    :return:
+        The stats
+    """
+    def build():
+        stats = ArtifactFile(
+            path=util.get_artifacts_path(experiment_id=experiment_id)) \
+            .get_projection_stats(projection_type=projection_type)
+        if stats is None:
+            stats = ProjectionStats.from_projection(
+                projection=util.get_projection(
+                    experiment_id=experiment_id,
+                    projection_type=projection_type))
+        return stats.arrays
+    arrays = get_cached_arrays(
+        namespace='projection_stats',
+        key={'artifact': util.get_artifact_identity(
+                experiment_id=experiment_id),
+             'projection_type': projection_type},
+        build=build)
+    return ProjectionStats(**arrays)
+
+
+def contrast_stretch(projection: np.ndarray, low: float,
+                     high: float) -> np.ndarray:
+    """Clips `projection` to [low, high] and rescales that range to
+    [0, 255]"""
+    if high <= low:
+        return np.zeros(projection.shape, dtype='uint8')
+    projection = np.clip(projection.astype('float32'), low, high)
+    projection -= low
+    projection *= 255.0 / (high - low)
+    return projection.astype('uint8')
+
+
+def get_crop_box(fov_bounds: Dict, shape: Tuple[int, int]) -> Dict:
+    """
+    Gets the rectangle of the projection shown for a region
+
+    :param fov_bounds:
+        See `util.get_fov_bounds`
+    :param shape:
+        Shape of the projection
+    :return:
+        dict with keys x, y, width, height
+    """
+    x0 = max(int(math.floor(min(fov_bounds['x']))), 0)
+    x1 = min(int(math.ceil(max(fov_bounds['x']))), shape[1])
+    y0 = max(int(math.floor(min(fov_bounds['y']))), 0)
+    y1 = min(int(math.ceil(max(fov_bounds['y']))), shape[0])
+    return {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0}
+
+
+def get_projection_image(
+        experiment_id: str,
+        projection_type: str,
+        box: Optional[Dict] = None,
+        dtype: str = 'uint16',
+        quantiles: Optional[Tuple[float, float]] = None) -> np.ndarray:
+    """
+    Gets a projection as an image
+
+    :param experiment_id:
+        experiment id
+    :param projection_type:
+        See `ArtifactFile.get_projection`
+    :param box:
+        If given, the projection is cropped to this rectangle (see
+        `get_crop_box`)
+    :param dtype:
+        "uint16", or "uint8" to rescale to [0, 255]
+    :param quantiles:
+        If given, the projection is clipped to these low, high quantiles of
+        the whole projection and rescaled to uint8, regardless of `dtype`
+    :return:
+        The image
+    """
+    projection = util.get_projection(experiment_id=experiment_id,
+                                     projection_type=projection_type)
+    if box is not None:
+        projection = projection[box['y']:box['y'] + box['height'],
+                                box['x']:box['x'] + box['width']]
+    if quantiles is not None:
+        stats = get_projection_stats(experiment_id=experiment_id,
+                                     projection_type=projection_type)
+        low, high = [stats.get_quantile(quantile=q) for q in quantiles]
+        return contrast_stretch(projection=projection, low=low, high=high)
+    if dtype == 'uint8':
+        return to_uint8(projection)
+    return projection
+
+
+def get_projection_png(experiment_id: str, projection_type: str,
+                       **kwargs) -> bytes:
+    """
+    Gets a projection image (see `get_projection_image`) encoded as a
+    grayscale PNG. Cached until the artifact file changes.
+
+    :param experiment_id:
+        experiment id
+    :param projection_type:
+        See `ArtifactFile.get_projection`
+    :param kwargs:
+        Passed to `get_projection_image`
+    :return:
+        PNG bytes
+    """
+    def build():
+        import cv2
+
+        image = get_projection_image(experiment_id=experiment_id,
+                                     projection_type=projection_type,
+                                     **kwargs)
+        _, png = cv2.imencode('.png', np.ascontiguousarray(image))
+        return {'png': png.ravel()}
+    return get_cached_arrays(
+        namespace='projection_png',
+        key={'artifact': util.get_artifact_identity(
+                experiment_id=experiment_id),
+             'projection_type': projection_type,
+             **kwargs},
+        build=build)['png'].tobytes()
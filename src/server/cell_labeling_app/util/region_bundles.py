@@ -0,0 +1,236 @@
+"""Precomputed region bundles.
+
+Everything the app shows for a region (ROI contours, colors and classifier
+scores, FOV bounds, motion border and ROI masks) only depends on the
+artifact file, the predictions and the region. A bundle stores all of it in
+a gzipped json file per region, built once when the labeling job is
+created. The endpoints serve the bundle if there is an up-to-date one, and
+otherwise compute everything on the fly."""
+import functools
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Union, List
+
+import numpy as np
+from flask import current_app, Flask
+
+from cell_labeling_app.database.schemas import JobRegion
+from cell_labeling_app.imaging_plane_artifacts import ArtifactFile
+from cell_labeling_app.util import util
+
+logger = logging.getLogger(__name__)
+
+# Incremented whenever the bundle contents change
+BUNDLE_VERSION = 1
+
+
+class RegionBundleStore:
+    """Directory of region bundles, named by region id"""
+    def __init__(self, bundle_dir: Union[str, Path]):
+        """
+        :param bundle_dir:
+            Directory of the bundles
+        """
+        self._bundle_dir = Path(bundle_dir)
+
+    @property
+    def bundle_dir(self) -> Path:
+        return self._bundle_dir
+
+    def get_path(self, region_id: int) -> Path:
+        return self._bundle_dir / f'{region_id}.json.gz'
+
+    def get(self, region: JobRegion) -> Optional[Dict]:
+        """
+        Gets the bundle of a region
+
+        :param region:
+            region
+        :return:
+            The bundle, or None if there is none or it is out of date with
+            the artifact file or predictions
+        """
+        path = self.get_path(region_id=region.id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        bundle = _read_bundle(path=str(path), mtime=mtime)
+        if not _is_up_to_date(bundle=bundle, region=region):
+            logger.info(f'Bundle for region {region.id} is out of date')
+            return None
+        return bundle
+
+    def put(self, region_id: int, bundle: Dict):
+        """
+        Writes the bundle of a region
+
+        :param region_id:
+            region id
+        :param bundle:
+            Output of `build_region_bundle`
+        """
+        self._bundle_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._bundle_dir,
+                                        prefix='.tmp-')
+        try:
+            with gzip.open(os.fdopen(fd, 'wb'), 'wt') as f:
+                json.dump(bundle, f)
+            os.replace(tmp_path, self.get_path(region_id=region_id))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def build_region_bundle(region: JobRegion) -> Dict:
+    """
+    Computes everything the app shows for a region. Must be called within
+    an app context.
+
+    :param region:
+        region
+    :return:
+        dict with keys
+            - version: `BUNDLE_VERSION`
+            - artifact: identity of the artifact file
+            - predictions: identity of the predictions file
+            - region: the region
+            - contours: output of `get_roi_contours_in_region`
+            - fov_bounds: output of `get_fov_bounds`
+            - motion_border: motion border of the experiment
+            - rois: id, x, y, width, height and mask of the ROIs in the
+                region
+    """
+    experiment_id = region.experiment_id
+    contours = util.get_roi_contours_in_region(experiment_id=experiment_id,
+                                               region=region)
+    rois = util.get_rois_in_region(region=region)
+    artifact_path = util.get_artifacts_path(experiment_id=experiment_id)
+    motion_border = ArtifactFile(path=artifact_path).motion_border
+    return {
+        'version': BUNDLE_VERSION,
+        'artifact': util.get_artifact_identity(experiment_id=experiment_id),
+        'predictions': util.get_predictions_identity(
+            experiment_id=experiment_id),
+        'region': region.to_dict(),
+        'contours': _to_json_compatible(contours),
+        'fov_bounds': util.get_fov_bounds(region=region, contours=contours),
+        'motion_border': {
+            'left_side': motion_border.left_side,
+            'right_side': motion_border.right_side,
+            'top': motion_border.top,
+            'bottom': motion_border.bottom
+        },
+        'rois': _to_json_compatible([{
+            'id': roi['id'],
+            'x': roi['x'],
+            'y': roi['y'],
+            'width': roi['width'],
+            'height': roi['height'],
+            'mask': roi['mask']
+        } for roi in rois])
+    }
+
+
+def build_region_bundles(regions: List[JobRegion],
+                         bundle_dir: Union[str, Path],
+                         artifact_dir: Union[str, Path],
+                         predictions_dir: Union[str, Path],
+                         n_processes: int = 1):
+    """
+    Builds and writes the bundles of `regions` in parallel
+
+    :param regions:
+        regions
+    :param bundle_dir:
+        Directory to write the bundles to
+    :param artifact_dir:
+        ARTIFACT_DIR of the app
+    :param predictions_dir:
+        PREDICTIONS_DIR of the app
+    :param n_processes:
+        Number of processes building bundles
+    """
+    with ProcessPoolExecutor(
+            max_workers=n_processes,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [
+            executor.submit(
+                _build_and_write_region_bundle,
+                region=region.to_dict(),
+                bundle_dir=str(bundle_dir),
+                artifact_dir=str(artifact_dir),
+                predictions_dir=str(predictions_dir))
+            for region in regions]
+        for future in futures:
+            future.result()
+    logger.info(f'Built {len(regions)} region bundles in {bundle_dir}')
+
+
+def get_region_bundle_store() -> Optional[RegionBundleStore]:
+    """Gets the region bundle store configured for the app, or None if
+    bundles are disabled"""
+    bundle_dir = current_app.config.get('REGION_BUNDLE_DIR')
+    if bundle_dir is None:
+        return None
+    return RegionBundleStore(bundle_dir=bundle_dir)
+
+
+def get_region_bundle(region: JobRegion) -> Optional[Dict]:
+    """Gets the up-to-date bundle of a region, or None if there is none"""
+    store = get_region_bundle_store()
+    if store is None:
+        return None
+    return store.get(region=region)
+
+
+def _build_and_write_region_bundle(region: Dict, bundle_dir: str,
+                                   artifact_dir: str, predictions_dir: str):
+    """Builds and writes the bundle of a region. Runs in a pool process."""
+    app = Flask(__name__)
+    app.config['ARTIFACT_DIR'] = artifact_dir
+    app.config['PREDICTIONS_DIR'] = predictions_dir
+    with app.app_context():
+        region = JobRegion(**region)
+        bundle = build_region_bundle(region=region)
+    RegionBundleStore(bundle_dir=bundle_dir).put(region_id=region.id,
+                                                 bundle=bundle)
+
+
+@functools.lru_cache(maxsize=128)
+def _read_bundle(path: str, mtime: int) -> Dict:
+    """Reads a bundle. Cached by path and modification time, so that a
+    rewritten bundle is read again"""
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+
+def _is_up_to_date(bundle: Dict, region: JobRegion) -> bool:
+    experiment_id = region.experiment_id
+    return (
+        bundle.get('version') == BUNDLE_VERSION and
+        bundle['region'] == region.to_dict() and
+        bundle['artifact'] == util.get_artifact_identity(
+            experiment_id=experiment_id) and
+        bundle['predictions'] == util.get_predictions_identity(
+            experiment_id=experiment_id)
+    )
+
+
+def _to_json_compatible(obj):
+    """Converts numpy values in `obj` to python values"""
+    if isinstance(obj, dict):
+        return {k: _to_json_compatible(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_json_compatible(x) for x in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
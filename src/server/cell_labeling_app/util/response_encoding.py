@@ -0,0 +1,181 @@
+"""Encoding of the json responses of the app.
+
+`FastJSONProvider` replaces Flask's json provider, so it applies to every
+view returning a dict or list, and to `jsonify`. It encodes with orjson if
+it is installed, and otherwise with the standard library. Numpy arrays and
+scalars can be returned as is. Clients whose Accept header prefers
+`MSGPACK_MIMETYPE` get MessagePack instead, if msgpack is installed.
+
+`init_app` also compresses json and MessagePack responses of at least
+RESPONSE_COMPRESSION_MIN_BYTES with brotli (if installed and accepted) or
+gzip."""
+import gzip
+import json
+from typing import Any, Optional
+
+import numpy as np
+from flask import Flask, Response, current_app, has_request_context, \
+    request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+# Mimetypes of the responses which are compressed
+COMPRESSIBLE_MIMETYPES = ('application/json', MSGPACK_MIMETYPE)
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _default(obj: Any) -> Any:
+    """Converts what neither the encoders nor Flask's provider handle"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return DefaultJSONProvider.default(obj)
+
+
+def encode_json(obj: Any, sort_keys: bool = True) -> bytes:
+    """
+    Encodes `obj` as json, with orjson if it is installed
+
+    :param obj:
+        Anything Flask's json provider can encode, plus numpy arrays and
+        scalars
+    :param sort_keys:
+        Whether to sort the keys of dicts
+    :return:
+        Compact utf-8 encoded json
+    """
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | \
+            orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=_default, option=option)
+        except TypeError:
+            # e.g. integers beyond 64 bits. Fall back to the standard
+            # library
+            pass
+    return json.dumps(obj, default=_default, sort_keys=sort_keys,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def encode_msgpack(obj: Any) -> bytes:
+    """
+    Encodes `obj` as MessagePack
+
+    :param obj:
+        See `encode_json`
+    :return:
+        MessagePack bytes
+    :raises RuntimeError:
+        If msgpack is not installed
+    """
+    if msgpack is None:
+        raise RuntimeError('msgpack is not installed')
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compresses `data`
+
+    :param data:
+        Data to compress
+    :param encoding:
+        "br" or "gzip"
+    :return:
+        Compressed data
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+
+def client_accepts_msgpack() -> bool:
+    """Whether msgpack is installed and the client prefers MessagePack over
+    json"""
+    if msgpack is None or not has_request_context():
+        return False
+    best = request.accept_mimetypes.best_match(
+        ['application/json', MSGPACK_MIMETYPE])
+    return best == MSGPACK_MIMETYPE
+
+
+def get_content_encoding() -> Optional[str]:
+    """The best supported content encoding accepted by the client, or None
+    """
+    supported = ['gzip'] if brotli is None else ['br', 'gzip']
+    return request.accept_encodings.best_match(supported)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask json provider which encodes with `encode_json`, or with
+    `encode_msgpack` if the client prefers MessagePack"""
+
+    def dumps(self, obj: Any, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, default=_default, **kwargs)
+        return encode_json(obj, sort_keys=self.sort_keys).decode('utf-8')
+
+    def response(self, *args, **kwargs) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        if client_accepts_msgpack():
+            response = self._app.response_class(
+                encode_msgpack(obj), mimetype=MSGPACK_MIMETYPE)
+        elif (self.compact is None and self._app.debug) or \
+                self.compact is False:
+            return super().response(obj)
+        else:
+            response = self._app.response_class(
+                encode_json(obj, sort_keys=self.sort_keys),
+                mimetype=self.mimetype)
+        response.vary.add('Accept')
+        return response
+
+
+def compress_response(response: Response) -> Response:
+    """`after_request` hook which compresses json and MessagePack responses
+    of at least RESPONSE_COMPRESSION_MIN_BYTES"""
+    min_bytes = current_app.config.get('RESPONSE_COMPRESSION_MIN_BYTES')
+    if min_bytes is None or response.status_code != 200 or \
+            response.direct_passthrough or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES or \
+            'Content-Encoding' in response.headers or \
+            (response.content_length or 0) < min_bytes:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = get_content_encoding()
+    if encoding is None:
+        return response
+    response.set_data(compress(data=response.get_data(), encoding=encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app: Flask):
+    """Sets `FastJSONProvider` as the json provider of `app` and registers
+    response compression"""
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
@@ -0,0 +1,249 @@
+"""Request coalescing ("single-flight") for expensive computations.
+
+Concurrent identical calls share a single computation. Within a process,
+followers wait for the leader's result. Across gunicorn workers, the leader
+holds a file lock while computing and stores the result on local disk for a
+short time, so that workers waiting on the lock can read it rather than
+computing it again.
+
+Followers wait at most until their request's deadline (see `deadline`),
+since the leader may itself take up to a whole request's time.
+
+Results are stored as .npy or json, never pickled, in a directory which
+only this user can access, so that other local users can't plant results."""
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+import numpy as np
+from flask import current_app
+
+from cell_labeling_app.util.deadline import TaskTimeoutError, bound_timeout
+from cell_labeling_app.util.file_locks import file_lock
+from cell_labeling_app.util.hashing import content_hash
+from cell_labeling_app.util.response_encoding import encode_json
+
+
+class _Call:
+    """A computation in progress"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key within a process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Calls `fn`, unless a call with the same key is in progress, in which
+        case waits for and returns its result
+
+        :param key:
+            Identifies the computation
+        :param fn:
+            The computation
+        :return:
+            Result of `fn`
+        :raises TaskTimeoutError:
+            If the request's deadline passed while waiting for another call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            timeout = bound_timeout()
+            if not call.done.wait(timeout=timeout):
+                raise TaskTimeoutError(what=f'Waiting for {key}',
+                                       timeout=timeout)
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class FileSingleFlight:
+    """Coalesces calls with the same key across processes on a host"""
+    def __init__(self, directory: Union[str, Path], ttl: float):
+        """
+        :param directory:
+            Local directory to store lock files and results in. There is
+            one lock file per key, which is never removed. Created with
+            permissions 0700 if it does not exist
+        :param ttl:
+            How long a result is shared for, in seconds
+        :raises PermissionError:
+            If `directory` is owned by another user
+        """
+        self._directory = Path(directory)
+        self._ttl = ttl
+        self._last_cleanup = 0.0
+        self._directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        _make_private(path=self._directory)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Returns a result for `key` computed within the last `ttl` seconds,
+        otherwise calls `fn` while holding a lock on `key`
+
+        :param key:
+            Identifies the computation
+        :param fn:
+            The computation. The result must be a numeric numpy array or
+            json serializable. Other processes get it back as read from
+            json, e.g. with lists in place of tuples
+        :return:
+            Result of `fn`
+        :raises TaskTimeoutError:
+            If the request's deadline passed while waiting for another
+            process
+        """
+        found, result = self._load(key=key)
+        if found:
+            return result
+
+        with file_lock(path=self._directory / f'{key}.lock',
+                       timeout=bound_timeout()):
+            # Another process may have computed it while we waited
+            found, result = self._load(key=key)
+            if found:
+                return result
+            result = fn()
+            self._store(key=key, result=result)
+        self._cleanup()
+        return result
+
+    def _load(self, key: str) -> Tuple[bool, Any]:
+        for suffix in ('.npy', '.json'):
+            path = self._directory / f'{key}{suffix}'
+            try:
+                if time.time() - path.stat().st_mtime > self._ttl:
+                    continue
+                if suffix == '.npy':
+                    return True, np.load(path, allow_pickle=False)
+                with open(path, 'rb') as f:
+                    return True, json.loads(f.read())
+            except (FileNotFoundError, ValueError):
+                # ValueError includes truncated or invalid files
+                continue
+        return False, None
+
+    def _store(self, key: str, result: Any):
+        is_array = isinstance(result, np.ndarray) and \
+            result.dtype != object
+        path = self._directory / f'{key}{".npy" if is_array else ".json"}'
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if is_array:
+                    np.save(f, result, allow_pickle=False)
+                else:
+                    f.write(encode_json(result))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _cleanup(self):
+        """Removes expired results, at most once per ttl.
+
+        Lock files are kept: flock doesn't update the modification time, so
+        an old lock file may be held, and a process waiting on an unlinked
+        lock file would compute concurrently with one that locked a new
+        file at the same path"""
+        now = time.time()
+        if now - self._last_cleanup < self._ttl:
+            return
+        self._last_cleanup = now
+        for entry in os.scandir(self._directory):
+            if not (entry.name.endswith(('.npy', '.json')) or
+                    entry.name.startswith('.tmp-')):
+                continue
+            try:
+                if now - entry.stat().st_mtime > 2 * self._ttl:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+
+
+def _make_private(path: Path):
+    """Makes `path` accessible only by this user
+
+    :raises PermissionError:
+        If `path` is owned by another user
+    """
+    stat = path.stat()
+    if stat.st_uid != os.getuid():
+        raise PermissionError(f'{path} is owned by another user')
+    if stat.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+_single_flight = SingleFlight()
+
+
+def get_file_single_flight() -> Optional[FileSingleFlight]:
+    """Gets the cross-process single-flight configured for the app, or None
+    if it is disabled"""
+    directory = current_app.config.get('SINGLE_FLIGHT_DIR')
+    if directory is None:
+        return None
+    return _get_file_single_flight(
+        directory=directory, ttl=current_app.config['SINGLE_FLIGHT_TTL'])
+
+
+@functools.lru_cache()
+def _get_file_single_flight(directory: str, ttl: float) -> FileSingleFlight:
+    return FileSingleFlight(directory=directory, ttl=ttl)
+
+
+def coalesced(namespace: str, key: Callable[..., Any]):
+    """
+    Decorator which coalesces concurrent identical calls to the decorated
+    function, within the process and across processes. The decorated
+    function must be called with keyword arguments only.
+
+    :param namespace:
+        Prefix for keys of the decorated function
+    :param key:
+        Called with the same kwargs as the decorated function. Returns an
+        object (see `hashing.content_hash`) which identifies the result
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(**kwargs):
+            call_key = f'{namespace}-{content_hash(obj=key(**kwargs))}'
+            file_single_flight = get_file_single_flight()
+
+            def compute():
+                if file_single_flight is None:
+                    return fn(**kwargs)
+                return file_single_flight.do(key=call_key,
+                                             fn=lambda: fn(**kwargs))
+            return _single_flight.do(key=call_key, fn=compute)
+        return wrapper
+    return decorator
@@ -3,22 +3,42 @@ import json
 import random
 from io import BytesIO
 from pathlib import Path
-from typing import Dict, Tuple, Optional, List
+from typing import Dict, Tuple, Optional, List, TYPE_CHECKING
 
-import cv2
-import matplotlib.cm
 import numpy as np
-import pandas as pd
-from PIL import Image
 from cell_labeling_app.database.database import db
 from flask import current_app
 
 from cell_labeling_app.database.schemas import JobRegion, UserLabels, \
     UserRoiExtra, LabelingJob
-from cell_labeling_app.imaging_plane_artifacts import ArtifactFile
+from cell_labeling_app.imaging_plane_artifacts import ArtifactFile, \
+    RoiTable, TraceSummary
+from cell_labeling_app.util.array_cache import get_cached_arrays
+from cell_labeling_app.util.artifact_cache import resolve_artifact_path
+from cell_labeling_app.util.array_transport import to_uint8
+from cell_labeling_app.util.executor import run_in_process
+from cell_labeling_app.util.hashing import content_hash
+from cell_labeling_app.util.memory_cache import MemoryCache
+from cell_labeling_app.util.single_flight import coalesced
 from flask_login import current_user
 from sqlalchemy import func
 
+if TYPE_CHECKING:
+    # cv2, matplotlib, pandas and PIL are slow to import, so are imported
+    # where used rather than when the app starts
+    import pandas as pd
+    from PIL import Image
+
+_classifier_scores_cache = MemoryCache(max_entries=64)
+_roi_contours_cache = MemoryCache(max_entries=4096)
+
+# Video options the client requests by default
+DEFAULT_VIDEO_OPTIONS = {
+    'include_current_roi_mask': True,
+    'include_all_roi_masks': False,
+    'padding': 32
+}
+
 
 def _is_roi_within_region(roi: Dict, region: JobRegion,
                           field_of_view_dimension=(512, 512),
@@ -62,16 +82,148 @@ def _get_classifier_score_for_roi(roi_id: int, experiment_id: str):
     :return:
         Classifier probability of cell for ROI
     """
-    predictions = pd.read_csv(
-        Path(current_app.config['PREDICTIONS_DIR']) /
-        f'{experiment_id}' / 'predictions' /
-        f'{experiment_id}_inference.csv',
-        dtype={'experiment_id': str})
-    predictions = predictions[predictions['experiment_id'] == experiment_id]
-    predictions = predictions.set_index('roi-id')
+    return get_classifier_scores(experiment_id=experiment_id)[roi_id]
 
-    classifier_score = predictions.loc[roi_id]['y_score']
-    return classifier_score
+
+def get_classifier_scores(experiment_id: str) -> Dict[int, float]:
+    """
+    Gets the classifier probability of cell for every ROI of an experiment.
+    Cached until the predictions file changes.
+
+    :param experiment_id:
+        experiment id
+    :return:
+        Map from roi id to classifier probability of cell
+    """
+    path = get_predictions_path(experiment_id=experiment_id)
+    identity = _get_file_identity(path=path)
+
+    def read():
+        import pandas as pd
+
+        predictions = pd.read_csv(path, dtype={'experiment_id': str})
+        predictions = predictions[
+            predictions['experiment_id'] == experiment_id]
+        return {
+            'roi_id': predictions['roi-id'].to_numpy(dtype='int64'),
+            'score': predictions['y_score'].to_numpy(dtype='float64')
+        }
+
+    def to_dict():
+        arrays = get_cached_arrays(
+            namespace='classifier_scores',
+            key={'path': str(path), **identity,
+                 'experiment_id': experiment_id},
+            build=read)
+        return dict(zip(arrays['roi_id'].tolist(), arrays['score'].tolist()))
+    return _classifier_scores_cache.get_or_compute(
+        key=(str(path), identity['size'], identity['mtime']), fn=to_dict)
+
+
+def get_roi_table(experiment_id: str) -> RoiTable:
+    """
+    Gets the ROIs of an experiment. Cached in the shared array cache (see
+    `array_cache`) until the artifact file changes.
+
+    :param experiment_id:
+        experiment id
+    :return:
+        The ROIs
+    """
+    path = get_artifacts_path(experiment_id=experiment_id)
+    arrays = get_cached_arrays(
+        namespace='roi_table',
+        key=_get_file_identity(path=path),
+        build=lambda: ArtifactFile(path=path).roi_table.arrays)
+    return RoiTable(arrays=arrays)
+
+
+def get_rois(experiment_id: str) -> List[Dict]:
+    """
+    Gets the ROIs of an experiment
+
+    :param experiment_id:
+        experiment id
+    :return:
+        See `ArtifactFile.rois`. The masks are boolean arrays
+    """
+    table = get_roi_table(experiment_id=experiment_id)
+    return [table.get_roi(index=i) for i in range(len(table))]
+
+
+def get_roi_contour_buffers(experiment_id: str) -> Dict[str, np.ndarray]:
+    """
+    Gets the contours of every ROI of an experiment, as flat arrays. Cached
+    in the shared array cache until the artifact file changes.
+
+    :param experiment_id:
+        experiment id
+    :return:
+        dict with keys
+            - points: (n points, 2) array of contour x, y coordinates
+            - contour_offsets: contour i is
+                points[contour_offsets[i]:contour_offsets[i + 1]]
+            - roi_contour_offsets: the contours of the ROI in row i of
+                `get_roi_table` are
+                roi_contour_offsets[i] to roi_contour_offsets[i + 1]
+    """
+    path = get_artifacts_path(experiment_id=experiment_id)
+
+    def build():
+        import cv2
+
+        table = get_roi_table(experiment_id=experiment_id)
+        points = []
+        contour_offsets = [0]
+        roi_contour_offsets = [0]
+        for i in range(len(table)):
+            roi = table.get_roi(index=i)
+            blank = np.zeros((512, 512), dtype='uint8')
+            blank[roi['y']:roi['y'] + roi['height'],
+                  roi['x']:roi['x'] + roi['width']] = roi['mask']
+            contours, _ = cv2.findContours(blank, cv2.RETR_TREE,
+                                           cv2.CHAIN_APPROX_NONE)
+            for contour in contours:
+                points.append(contour.reshape(contour.shape[0], 2))
+                contour_offsets.append(contour_offsets[-1] + len(contour))
+            roi_contour_offsets.append(len(contour_offsets) - 1)
+        return {
+            'points': (np.concatenate(points).astype('int32') if points
+                       else np.zeros((0, 2), dtype='int32')),
+            'contour_offsets': np.array(contour_offsets, dtype='int64'),
+            'roi_contour_offsets': np.array(roi_contour_offsets,
+                                            dtype='int64')
+        }
+    return get_cached_arrays(
+        namespace='roi_contours',
+        key=_get_file_identity(path=path),
+        build=build)
+
+
+def get_projection(experiment_id: str, projection_type: str) -> np.ndarray:
+    """
+    Gets a projection of an experiment. Cached in the shared array cache
+    until the artifact file changes.
+
+    :param experiment_id:
+        experiment id
+    :param projection_type:
+        See `ArtifactFile.get_projection`
+    :return:
+        The projection. Read-only
+    :raises ValueError:
+        If the projection type is invalid
+    """
+    if projection_type not in ('max', 'average', 'correlation'):
+        raise ValueError('bad projection type')
+    path = get_artifacts_path(experiment_id=experiment_id)
+    arrays = get_cached_arrays(
+        namespace='projection',
+        key={**_get_file_identity(path=path),
+             'projection_type': projection_type},
+        build=lambda: {'projection': ArtifactFile(path=path).get_projection(
+            projection_type=projection_type)})
+    return arrays['projection']
 
 
 def get_soft_filter_roi_color(classifier_score: float,
@@ -80,6 +232,8 @@ def get_soft_filter_roi_color(classifier_score: float,
     """Gets color based on classifier score for a given ROI in order to draw
     attention to ROIs the classifier thinks are cells. Uses color map
     defined by color_map"""
+    import matplotlib.cm
+
     cmap = matplotlib.cm.get_cmap(color_map)
 
     color = tuple([int(255 * x) for x in cmap(classifier_score)][:-1])
@@ -105,39 +259,41 @@ def get_rois_in_region(region: JobRegion,
             - id: roi id
             - classifier_score: classifier score
     """
-    artifact_path = get_artifacts_path(experiment_id=region.experiment_id)
-    af = ArtifactFile(path=artifact_path)
-    rois = af.rois
-
     res = []
-    for roi in rois:
-        if not _is_roi_within_region(
-                roi=roi, region=region,
-                include_overlapping_rois=include_overlapping_rois):
-            continue
-
-        mask = roi['mask']
-        x = roi['x']
-        y = roi['y']
-        width = roi['width']
-        height = roi['height']
-        id = roi['id']
-        classifier_score = _get_classifier_score_for_roi(
-            roi_id=id, experiment_id=region.experiment_id)
-
+    for index in _get_table_rows_in_region(
+            region=region,
+            include_overlapping_rois=include_overlapping_rois):
+        roi = get_roi_table(experiment_id=region.experiment_id).get_roi(
+            index=index)
         res.append({
-            'mask': mask,
-            'x': x,
-            'y': y,
-            'width': width,
-            'height': height,
-            'id': id,
-            'classifier_score': classifier_score
+            **roi,
+            'classifier_score': _get_classifier_score_for_roi(
+                roi_id=roi['id'], experiment_id=region.experiment_id)
         })
     return res
 
 
-def convert_pil_image_to_base64(img: Image) -> str:
+def _get_table_rows_in_region(region: JobRegion,
+                              include_overlapping_rois=True) -> List[int]:
+    """Gets the rows of `get_roi_table` of the ROIs within a region. See
+    `get_rois_in_region`"""
+    table = get_roi_table(experiment_id=region.experiment_id)
+    if include_overlapping_rois:
+        # Only ROIs whose bounding box overlaps the region can intersect it
+        # Note that region.x indexes rows, see `_is_roi_within_region`
+        candidates = table.get_bbox_overlapping(
+            row_start=region.x, row_end=region.x + region.height,
+            col_start=region.y, col_end=region.y + region.width)
+    else:
+        candidates = range(len(table))
+
+    return [int(index) for index in candidates
+            if _is_roi_within_region(
+                roi=table.get_roi(index=index), region=region,
+                include_overlapping_rois=include_overlapping_rois)]
+
+
+def convert_pil_image_to_base64(img: 'Image') -> str:
     buffered = BytesIO()
     img.save(buffered, format="png")
     img_str = base64.b64encode(buffered.getvalue())
@@ -149,6 +305,67 @@ def get_roi_contours_in_region(experiment_id: str, region: JobRegion,
                                include_overlapping_rois=True,
                                reshape_contours_to_list=True):
     """Gets all ROI contours within a given region of the field of view.
+    Concurrent identical calls share a single computation (see
+    `single_flight`), which runs in the process pool (see `executor`).
+    :param experiment_id:
+        experiment id
+    :param region:
+        region to get contours for
+    :param include_overlapping_rois:
+        Whether to include ROIs that overlap with region but don't fit
+        entirely within region
+    :param reshape_contours_to_list:
+    :return:
+        See `_get_roi_contours_in_region`. Cached in memory, and must not be
+        modified
+    """
+    key = _get_roi_contours_key(
+        experiment_id=experiment_id,
+        region=region,
+        include_overlapping_rois=include_overlapping_rois,
+        reshape_contours_to_list=reshape_contours_to_list)
+    return _roi_contours_cache.get_or_compute(
+        key=content_hash(obj=key),
+        fn=lambda: _compute_roi_contours_in_region(
+            experiment_id=experiment_id,
+            region=region,
+            include_overlapping_rois=include_overlapping_rois,
+            reshape_contours_to_list=reshape_contours_to_list))
+
+
+def _get_roi_contours_key(experiment_id: str, region: JobRegion,
+                          **kwargs) -> Dict:
+    """Identifies the output of `_get_roi_contours_in_region`"""
+    return {
+        'artifact': get_artifact_identity(experiment_id=experiment_id),
+        'predictions': get_predictions_identity(experiment_id=experiment_id),
+        'region': region.to_dict(),
+        **kwargs
+    }
+
+
+@coalesced(namespace='roi_contours', key=_get_roi_contours_key)
+def _compute_roi_contours_in_region(experiment_id: str, region: JobRegion,
+                                    **kwargs):
+    """Runs `_get_roi_contours_in_region` in the process pool. Coalesced
+    here, in the calling process, so that identical concurrent calls are
+    sent to the pool once"""
+    return run_in_process(_get_roi_contours_in_region_from_dict,
+                          experiment_id=experiment_id,
+                          region=region.to_dict(),
+                          **kwargs)
+
+
+def _get_roi_contours_in_region_from_dict(region: Dict, **kwargs):
+    """`_get_roi_contours_in_region`, taking the region as a dict so that
+    it can run in a pool process"""
+    return _get_roi_contours_in_region(region=JobRegion(**region), **kwargs)
+
+
+def _get_roi_contours_in_region(experiment_id: str, region: JobRegion,
+                                include_overlapping_rois=True,
+                                reshape_contours_to_list=True):
+    """Gets all ROI contours within a given region of the field of view.
     :param experiment_id:
         experiment id
     :param region:
@@ -171,49 +388,101 @@ def get_roi_contours_in_region(experiment_id: str, region: JobRegion,
     """
     all_contours = []
 
-    rois = get_rois_in_region(
-        region=region, include_overlapping_rois=include_overlapping_rois)
+    table = get_roi_table(experiment_id=experiment_id)
+    buffers = get_roi_contour_buffers(experiment_id=experiment_id)
+    points = buffers['points']
+    contour_offsets = buffers['contour_offsets']
+    roi_contour_offsets = buffers['roi_contour_offsets']
 
-    for roi in rois:
-        x = roi['x']
-        y = roi['y']
-        width = roi['width']
-        height = roi['height']
-        mask = roi['mask']
-        id = roi['id']
-        classifier_score = roi['classifier_score']
-
-        blank = np.zeros((512, 512), dtype='uint8')
-        blank[y:y + height, x:x + width] = mask
-        contours, _ = cv2.findContours(blank, cv2.RETR_TREE,
-                                       cv2.CHAIN_APPROX_NONE)
+    for index in _get_table_rows_in_region(
+            region=region, include_overlapping_rois=include_overlapping_rois):
+        id = int(table.ids[index])
+        classifier_score = _get_classifier_score_for_roi(
+            roi_id=id, experiment_id=experiment_id)
+
+        contours = [
+            points[contour_offsets[i]:contour_offsets[i + 1]]
+            for i in range(roi_contour_offsets[index],
+                           roi_contour_offsets[index + 1])]
         if reshape_contours_to_list:
-            contours = [
-                contour.reshape(contour.shape[0], 2).tolist()
-                for contour in contours
-            ]
+            contours = [contour.tolist() for contour in contours]
+        else:
+            contours = [contour.reshape(contour.shape[0], 1, 2)
+                        for contour in contours]
 
-        color = get_soft_filter_roi_color(
-            classifier_score=roi['classifier_score'])
+        color = get_soft_filter_roi_color(classifier_score=classifier_score)
         all_contours.append({
             'contours': contours,
             'color': color,
             'id': id,
             'classifier_score': classifier_score,
-            'box_x': x,
-            'box_y': y,
-            'box_width': width,
-            'box_height': height,
+            'box_x': int(table.x[index]),
+            'box_y': int(table.y[index]),
+            'box_width': int(table.width[index]),
+            'box_height': int(table.height[index]),
             'experiment_id': experiment_id
         })
     return all_contours
 
 
+def get_fov_bounds(region: JobRegion, contours: List[Dict]) -> Dict:
+    """The FOV bounds are the min/max x, y values of the bounding boxes to
+    all ROIs that fit in the region. The reason why the region x, y, width,
+    height was not just used is in the case of ROIs that don't fit within
+    the region entirely. In that case, we need to expand the region
+    dimensions so that all ROIs are in view.
+
+    :param region:
+        region
+    :param contours:
+        Output of `get_roi_contours_in_region` for the region
+    :return:
+        dict with keys
+            - x: min, max x
+            - y: max, min y
+    """
+    if len(contours) == 0:
+        x_min, x_max = region.x, region.x + region.width
+        y_min, y_max = region.y, region.y + region.height
+    else:
+        x = np.array([x['box_x'] for x in contours])
+        y = np.array([x['box_y'] for x in contours])
+
+        widths = np.array([x['box_width'] for x in contours])
+        heights = np.array([x['box_height'] for x in contours])
+
+        x_min, x_max = x.min(), (x + widths).max()
+        y_min, y_max = y.min(), (y + heights).max()
+
+    # Find the larger box, either the region box or the box containing all ROIs
+    # that are contained within or overlap within the box
+    # The box containing all ROIs will be smaller in the case there are few
+    # ROIs within the region, and they are close together.
+    # This ensures that we always return at least the region box
+    # Region x is row and region y and col
+    x_range = [
+        min(float(x_min), region.y),
+        max(float(x_max), region.y + region.width)
+    ]
+
+    y_range = [
+        # Reversing because origin of plot is top-left instead of bottom-left
+        max(float(y_max), region.x + region.height),
+        min(float(y_min), region.x)
+    ]
+
+    return {
+        'x': x_range,
+        'y': y_range
+    }
+
+
 def get_trace(
         experiment_id: str,
         roi_id: int,
         is_user_added: bool,
-        contours: List[List[int]]
+        contours: List[List[int]],
+        end: Optional[int] = None
 ):
     """
     Gets a trace. If it is an already segmented object, pulls the precomputed
@@ -223,30 +492,389 @@ def get_trace(
     @param roi_id: roi id
     @param is_user_added: Whether the user added this ROI or it was precomputed
     @param contours: ROI contours, needed if is_user_added
+    @param end: If given, only the samples before `end` are returned
     @return: trace
     """
+    if is_user_added:
+        trace = _compute_trace_for_user_added_roi(
+            experiment_id=experiment_id, contours=contours)
+        if end is not None:
+            trace = trace[:end]
+        return trace
+
     artifact_path = get_artifacts_path(experiment_id=experiment_id)
     af = ArtifactFile(path=artifact_path)
-
-    roi = create_roi_from_contours(contours=contours)
     trace = af.get_trace(
         roi_id=roi_id,
-        roi=roi,
-        is_user_added=is_user_added)
+        roi=None,
+        is_user_added=False,
+        end=end)
 
     return trace
 
 
-def get_artifacts_path(experiment_id: str):
+@coalesced(namespace='user_roi_trace',
+           key=lambda experiment_id, contours: {
+               'artifact': get_artifact_identity(experiment_id=experiment_id),
+               'contours': contours
+           })
+def _compute_trace_for_user_added_roi(
+        experiment_id: str,
+        contours: List[List[int]]) -> np.ndarray:
+    """Runs `_get_trace_for_user_added_roi` in the process pool. This reads
+    the video, so concurrent identical calls share a single computation
+    (see `single_flight`), coalesced here so that it is sent to the pool
+    once"""
+    return run_in_process(_get_trace_for_user_added_roi,
+                          experiment_id=experiment_id,
+                          contours=contours)
+
+
+def _get_trace_for_user_added_roi(
+        experiment_id: str,
+        contours: List[List[int]]) -> np.ndarray:
+    """Computes the trace of a user-added ROI"""
+    artifact_path = get_artifacts_path(experiment_id=experiment_id)
+    af = ArtifactFile(path=artifact_path)
+    roi = create_roi_from_contours(contours=contours)
+    return af.get_trace(roi_id=None, roi=roi, is_user_added=True)
+
+
+def get_trace_summary(
+        experiment_id: str,
+        roi_id: int,
+        is_user_added: bool) -> Optional[TraceSummary]:
+    """
+    Gets the precomputed trace summary.
+
+    @param experiment_id: experiment id
+    @param roi_id: roi id
+    @param is_user_added: Whether the user added this ROI or it was precomputed
+    @return: The trace summary, or None if the ROI was added by the user or
+        the summary index has not been built
+    """
+    if is_user_added:
+        return None
+    artifact_path = get_artifacts_path(experiment_id=experiment_id)
+    af = ArtifactFile(path=artifact_path)
+    return af.get_trace_summary(roi_id=roi_id)
+
+
+def get_trimmed_trace(
+        experiment_id: str,
+        roi_id: int,
+        is_user_added: bool,
+        contours: List[List[int]]
+) -> Tuple[np.ndarray, int]:
+    """
+    Gets a trace, trimmed to the last nonzero sample.
+    The trace seems to decrease to 0 at the end which makes visualization
+    worse. Uses the trace summary index if it exists so that only the
+    retained samples are read.
+
+    @param experiment_id: experiment id
+    @param roi_id: roi id
+    @param is_user_added: Whether the user added this ROI or it was precomputed
+    @param contours: ROI contours, needed if is_user_added
+    @return: tuple of trimmed trace, index of first nonzero sample (0 if there
+        are none)
+    """
+    summary = get_trace_summary(experiment_id=experiment_id, roi_id=roi_id,
+                                is_user_added=is_user_added)
+    if summary is not None:
+        if summary.last_nonzero >= 0:
+            end = summary.last_nonzero
+            first_nonzero = summary.first_nonzero
+        else:
+            end = None
+            first_nonzero = 0
+        trace = get_trace(experiment_id=experiment_id, roi_id=roi_id,
+                          is_user_added=is_user_added, contours=contours,
+                          end=end)
+    else:
+        trace = get_trace(experiment_id=experiment_id, roi_id=roi_id,
+                          is_user_added=is_user_added, contours=contours)
+        nonzero = trace.nonzero()[0]
+        if len(nonzero) > 0:
+            trace = trace[:nonzero[-1]]
+            first_nonzero = int(nonzero[0])
+        else:
+            first_nonzero = 0
+    return trace, first_nonzero
+
+
+def get_default_video_timeframe(
+        experiment_id: str,
+        roi_id: int,
+        is_user_added: bool,
+        contours: List[List[int]]
+) -> Tuple[int, int]:
+    """
+    Gets the default timeframe of the thumbnail video, centered on the peak
+    of the trace. Uses the trace summary index if it exists.
+
+    :param experiment_id: experiment id
+    :param roi_id: roi id
+    :param is_user_added: Whether the user added this ROI
+    :param contours: ROI contours, needed if is_user_added
+    :return:
+        start, end timestep
+    """
+    summary = get_trace_summary(experiment_id=experiment_id, roi_id=roi_id,
+                                is_user_added=is_user_added)
+    if summary is not None:
+        max_idx = summary.argmax
+    else:
+        trace = get_trace(experiment_id=experiment_id, roi_id=roi_id,
+                          contours=contours, is_user_added=is_user_added)
+        max_idx = int(trace.argmax())
+    return max_idx - 300, max_idx + 300
+
+
+def get_thumbnail_video_kwargs(
+        experiment_id: str,
+        region_id: int,
+        roi_id: int,
+        is_user_added: bool,
+        color: Tuple[int, int, int],
+        contours: List,
+        include_current_roi_mask: bool,
+        include_all_roi_masks: bool,
+        padding: int,
+        timeframe: Tuple[int, int],
+        rois: Optional[List[Dict]] = None
+) -> Dict:
+    """
+    Gets the kwargs to pass to `get_thumbnail_video_from_artifact_file`
+
+    :param experiment_id: experiment id
+    :param region_id: region id
+    :param roi_id: roi id
+    :param is_user_added: Whether the user added this ROI
+    :param color: color of the ROI, used if is_user_added
+    :param contours: ROI contours, used if is_user_added
+    :param include_current_roi_mask: Whether to draw the ROI outline
+    :param include_all_roi_masks: Whether to draw the outlines of all ROIs
+        in the region
+    :param padding: padding around the ROI
+    :param timeframe: start, end timestep
+    :param rois: The output of `get_rois_in_region` for the region, if
+        already known. Avoids recomputing it for each ROI in the region
+    :return:
+        kwargs
+    """
+    artifact_path = get_artifacts_path(experiment_id=experiment_id)
+
+    if rois is None:
+        region = get_region(region_id=region_id)
+        rois = get_rois_in_region(region=region)
+    else:
+        rois = list(rois)
+    roi_color_map = {
+        roi['id']: get_soft_filter_roi_color(
+            classifier_score=roi['classifier_score']) for roi in rois}
+    if is_user_added:
+        roi = create_roi_from_contours(contours=contours)
+        roi['id'] = roi_id
+
+        # Add the user-drawn roi to the list of rois
+        rois.append(roi)
+
+        # Add a color
+        roi_color_map[roi_id] = color
+
+    this_roi = [x for x in rois if x['id'] == roi_id][0]
+
+    start, end = timeframe
+    timesteps = np.arange(start, end)
+
+    if not include_current_roi_mask:
+        roi_color_map = None
+
+    roi_list = rois if include_all_roi_masks else None
+
+    return dict(
+        artifact_path=artifact_path,
+        roi=this_roi,
+        padding=padding,
+        quality=9,
+        timesteps=timesteps,
+        fps=31,
+        other_roi=roi_list,
+        roi_color=roi_color_map)
+
+
+def get_default_thumbnail_video_kwargs(
+        region: JobRegion,
+        rois: Optional[List[Dict]] = None
+) -> Dict[int, Dict]:
+    """
+    Gets the kwargs of the video the client shows by default for each ROI
+    in a region. Videos rendered with these kwargs have the same cache keys
+    as videos requested by the client.
+
+    :param region: region
+    :param rois: The output of `get_rois_in_region` for the region, if
+        already known
+    :return:
+        Map from roi id to the kwargs to pass to
+        `get_thumbnail_video_from_artifact_file`
+    """
+    if rois is None:
+        rois = get_rois_in_region(region=region)
+    res = {}
+    for roi in rois:
+        timeframe = get_default_video_timeframe(
+            experiment_id=region.experiment_id,
+            roi_id=roi['id'],
+            is_user_added=False,
+            contours=None)
+        res[roi['id']] = get_thumbnail_video_kwargs(
+            experiment_id=region.experiment_id,
+            region_id=region.id,
+            roi_id=roi['id'],
+            is_user_added=False,
+            color=None,
+            contours=None,
+            timeframe=timeframe,
+            rois=rois,
+            **DEFAULT_VIDEO_OPTIONS)
+    return res
+
+
+def get_roi_frames(
+        experiment_id: str,
+        roi_id: int,
+        is_user_added: bool,
+        contours: List,
+        padding: int,
+        timeframe: Tuple[int, int],
+        quantiles: Tuple[float, float] = (0.001, 0.999)
+) -> Dict:
+    """
+    Gets the frames of the movie around an ROI, as a lightweight alternative
+    to rendering a thumbnail video. The crop is the ROI bounding box plus
+    `padding`, clipped to the field of view.
+
+    :param experiment_id: experiment id
+    :param roi_id: roi id
+    :param is_user_added: Whether the user added this ROI
+    :param contours: ROI contours, used if is_user_added
+    :param padding: padding around the ROI
+    :param timeframe: start, end frame
+    :param quantiles: The crop is clipped to these quantiles before being
+        scaled to uint8, unless the movie is already uint8
+    :return:
+        dict with keys
+            - frames: uint8 array of shape (frames, height, width)
+            - box: dict with keys x, y, width, height giving the crop in the
+                field of view
+            - outline: list of ROI contours, in crop coordinates
+    """
+    import cv2
+
+    artifact_path = get_artifacts_path(experiment_id=experiment_id)
+    af = ArtifactFile(path=artifact_path)
+    if is_user_added:
+        roi = create_roi_from_contours(contours=contours)
+    else:
+        table = get_roi_table(experiment_id=experiment_id)
+        roi = table.get_roi(index=table.get_index(roi_id=roi_id))
+
+    _, fov_height, fov_width = af.video_shape
+    x0 = max(roi['x'] - padding, 0)
+    y0 = max(roi['y'] - padding, 0)
+    x1 = min(roi['x'] + roi['width'] + padding, fov_width)
+    y1 = min(roi['y'] + roi['height'] + padding, fov_height)
+
+    start, end = timeframe
+    frames = af.get_video_crop(x=x0, y=y0, width=x1 - x0, height=y1 - y0,
+                               start=start, end=end)
+    frames = quantize_frames(frames=frames, quantiles=quantiles)
+
+    mask = np.zeros((y1 - y0, x1 - x0), dtype='uint8')
+    mask[roi['y'] - y0:roi['y'] - y0 + roi['height'],
+         roi['x'] - x0:roi['x'] - x0 + roi['width']] = \
+        np.array(roi['mask'], dtype='uint8')
+    outline, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                                  cv2.CHAIN_APPROX_SIMPLE)
+    outline = [contour.reshape(contour.shape[0], 2).tolist()
+               for contour in outline]
+
+    return {
+        'frames': frames,
+        'box': {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0},
+        'outline': outline
+    }
+
+
+def quantize_frames(frames: np.ndarray,
+                    quantiles: Tuple[float, float]) -> np.ndarray:
+    """Clips `frames` to `quantiles` and scales to uint8. Frames which are
+    already uint8 are returned as is
+
+    :param frames: movie frames
+    :param quantiles: low, high quantile
+    :return:
+        uint8 frames
+    """
+    if frames.dtype == np.uint8:
+        return frames
+    if frames.size == 0:
+        return frames.astype('uint8')
+    low, high = np.quantile(frames, quantiles)
+    frames = frames.astype('float32')
+    np.clip(frames, low, high, out=frames)
+    return to_uint8(arr=frames)
+
+
+def get_artifacts_path(experiment_id: str) -> Path:
+    """Gets the path to read the artifact file from. This is the local copy
+    if there is an up-to-date one (see `artifact_cache`)"""
+    return resolve_artifact_path(
+        source=get_source_artifacts_path(experiment_id=experiment_id))
+
+
+def get_source_artifacts_path(experiment_id: str) -> Path:
+    """Gets the path of the artifact file in ARTIFACT_DIR"""
     artifact_dir = Path(current_app.config['ARTIFACT_DIR'])
     artifact_path = artifact_dir / f'{experiment_id}_artifacts.h5'
     return artifact_path
 
 
+def get_predictions_path(experiment_id: str) -> Path:
+    return (Path(current_app.config['PREDICTIONS_DIR']) /
+            f'{experiment_id}' / 'predictions' /
+            f'{experiment_id}_inference.csv')
+
+
+def get_artifact_identity(experiment_id: str) -> Dict:
+    """Identifies the current version of the artifact file. Changes if the
+    file is modified"""
+    return _get_file_identity(
+        path=get_artifacts_path(experiment_id=experiment_id))
+
+
+def get_predictions_identity(experiment_id: str) -> Dict:
+    """Identifies the current version of the predictions file. Changes if
+    the file is modified"""
+    return _get_file_identity(
+        path=get_predictions_path(experiment_id=experiment_id))
+
+
+def _get_file_identity(path: Path) -> Dict:
+    stat = path.stat()
+    return {
+        'name': path.name,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns
+    }
+
+
 def get_region_label_counts(
         job_id: int,
         exclude_current_user: bool = False,
-        region_ids: Optional[List[int]] = None) -> pd.Series:
+        region_ids: Optional[List[int]] = None) -> 'pd.Series':
     """
     :param job_id
         Job id
@@ -255,6 +883,8 @@ def get_region_label_counts(
     :param region_ids: Optional list of region ids to get counts for
     :return: Series with index region_id and values n_labelers
     """
+    import pandas as pd
+
     region_label_counts = \
         (db.session
          .query(UserLabels.region_id,
@@ -317,12 +947,15 @@ def get_completed_regions(
 
 
 def get_user_has_labeled(
-    job_id: int
+    job_id: int,
+    user_id: Optional[str] = None
 ) -> List[Dict]:
     """
     Gets the list of region ids that the current user has labeled
     :param job_id
         Job id
+    :param user_id
+        User id. Defaults to the current user
 
     :return:
         List of dict with keys
@@ -331,6 +964,8 @@ def get_user_has_labeled(
             experiment_id
             x
     """
+    if user_id is None:
+        user_id = current_user.get_id()
     user_has_labeled = \
         (db.session
          .query(UserLabels.timestamp.label('submitted'),
@@ -339,7 +974,7 @@ def get_user_has_labeled(
                 JobRegion.experiment_id)
          .join(JobRegion, JobRegion.id == UserLabels.region_id)
          .filter(JobRegion.job_id == job_id,
-                 UserLabels.user_id == current_user.get_id())
+                 UserLabels.user_id == user_id)
          .order_by(UserLabels.timestamp.desc())
          .all())
     return user_has_labeled
@@ -347,7 +982,9 @@ def get_user_has_labeled(
 
 def get_next_region(
     job_id: int,
-    prioritize_regions_by_label_count: bool = True
+    prioritize_regions_by_label_count: bool = True,
+    user_id: Optional[str] = None,
+    exclude_region_ids: Optional[List[int]] = None
 ) -> Optional[JobRegion]:
     """Samples a region randomly from a set of candidate regions.
     The candidate regions are those that have not already been labeled by the
@@ -360,6 +997,10 @@ def get_next_region(
         sampling regions that
         have been labeled more times. Encourages `LABELERS_REQUIRED_PER_REGION`
         to be met quicker for a given region
+    :param user_id
+        User id. Defaults to the current user
+    :param exclude_region_ids
+        Regions which should not be sampled
     :rtype: optional JobRegion
         JobRegion, if a candidate region exists, otherwise None
     """
@@ -387,11 +1028,13 @@ def get_next_region(
         return prioritized_regions
 
     # Get all region ids user has labeled
-    user_has_labeled = get_user_has_labeled(job_id=job_id)
+    user_has_labeled = get_user_has_labeled(job_id=job_id, user_id=user_id)
     user_has_labeled = [region['region_id'] for region in user_has_labeled]
 
     regions_with_enough_labels = get_completed_regions(job_id=job_id)
     exclude_regions = user_has_labeled + regions_with_enough_labels
+    if exclude_region_ids is not None:
+        exclude_regions += exclude_region_ids
 
     # Get initial next region candidates query
     next_region_candidates = \
@@ -486,8 +1129,10 @@ def get_labels_for_region(region_id: int) -> Tuple[List[dict], List[dict]]:
     return labels, roi_extra
 
 
-def get_all_labels() -> pd.DataFrame:
+def get_all_labels() -> 'pd.DataFrame':
     """Gets all labels"""
+    import pandas as pd
+
     labels = (
         db.session.query(
             LabelingJob.name,
@@ -585,6 +1230,8 @@ def create_roi_from_contours(contours: List, image_dims=(512, 512)) -> Dict:
         height: height of roi bounding box
         mask: roi boolean mask within bounding box of size height x width
     """
+    import cv2
+
     contours = np.array(contours, dtype=int)
 
     # 1. Get bounding box of contours
@@ -0,0 +1,168 @@
+"""Content-keyed cache of rendered thumbnail videos on local disk.
+
+Entries are written to a temporary file and atomically renamed into place, so
+the cache can be shared by all gunicorn workers on a host. The key includes
+the size and modification time of the artifact file, so entries rendered
+from an older artifact are never served. Those entries are evicted
+eventually by the LRU policy."""
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from flask import current_app
+
+from cell_labeling_app.util.hashing import content_hash
+
+VIDEO_SUFFIX = '.mp4'
+TMP_PREFIX = '.tmp-'
+LOCK_DIR = '.locks'
+
+# Temporary files older than this are assumed to be left over from a crashed
+# worker and are removed during eviction
+STALE_TMP_FILE_AGE = 60 * 60
+
+
+class VideoCache:
+    """Disk-backed LRU cache of videos with a byte budget"""
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: int):
+        """
+        :param cache_dir:
+            Directory to store videos in
+        :param max_bytes:
+            Maximum total size of the cached videos. Least recently used
+            videos are evicted once this is exceeded
+        """
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def cache_dir(self) -> Path:
+        return self._cache_dir
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    def get_path(self, key: str) -> Path:
+        """Path where the video for `key` is stored"""
+        return self._cache_dir / f'{key}{VIDEO_SUFFIX}'
+
+    def get_lock_path(self, key: str) -> Path:
+        """Path of the lock file held while the video for `key` is
+        rendered"""
+        return self._cache_dir / LOCK_DIR / f'{key}.lock'
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        Gets the video for `key` and marks it as recently used
+
+        :param key:
+            cache key
+        :return:
+            Path to the video, or None if it is not cached
+        """
+        path = self.get_path(key=key)
+        try:
+            # mtime is used to track recency of use
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, video_path: Union[str, Path]) -> Path:
+        """
+        Moves `video_path` into the cache
+
+        :param key:
+            cache key
+        :param video_path:
+            Path to the rendered video. Removed once it is cached
+        :return:
+            Path to the cached video
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir,
+                                        prefix=TMP_PREFIX,
+                                        suffix=VIDEO_SUFFIX)
+        os.close(fd)
+        try:
+            # A rename if on the same filesystem, else a copy and unlink
+            shutil.move(str(video_path), tmp_path)
+            path = self.get_path(key=key)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        """Removes least recently used videos until the total size is
+        within budget. Lock files are kept, since flock doesn't update their
+        modification time, so an old lock file may still be held"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Removed by another worker
+                continue
+            if entry.name.startswith(TMP_PREFIX):
+                if now - stat.st_mtime > STALE_TMP_FILE_AGE:
+                    _remove(path=entry.path)
+                continue
+            if not entry.name.endswith(VIDEO_SUFFIX):
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            _remove(path=path)
+            total -= size
+
+
+def get_video_cache() -> Optional[VideoCache]:
+    """Gets the video cache configured for the app, or None if caching is
+    disabled"""
+    cache_dir = current_app.config.get('VIDEO_CACHE_DIR')
+    if cache_dir is None:
+        return None
+    return VideoCache(cache_dir=cache_dir,
+                      max_bytes=current_app.config['VIDEO_CACHE_MAX_BYTES'])
+
+
+def make_video_cache_key(artifact_path: Union[str, Path], **video_kwargs) \
+        -> str:
+    """
+    Creates a cache key from the artifact file identity and all options
+    used to render the video
+
+    :param artifact_path:
+        Path to the artifact file
+    :param video_kwargs:
+        All other kwargs passed to `get_thumbnail_video_from_artifact_file`
+    :return:
+        hex digest
+    """
+    stat = os.stat(artifact_path)
+    return content_hash(obj={
+        'artifact': Path(artifact_path).name,
+        'artifact_size': stat.st_size,
+        'artifact_mtime': stat.st_mtime_ns,
+        **video_kwargs
+    })
+
+
+def _remove(path: Union[str, Path]):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # Removed by another worker
+        pass
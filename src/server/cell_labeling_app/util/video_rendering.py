@@ -0,0 +1,522 @@
+"""Rendering of ROI thumbnail videos.
+
+Videos can be rendered synchronously (`render_thumbnail_video`) or as a
+background job (`VideoRenderQueue`). Background jobs run in a local process
+pool and the rendered video is written to the video cache. The job id is the
+video cache key, and job state is kept as marker files next to the cached
+videos, so that any gunicorn worker can report the status of a job submitted
+through another worker."""
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from pathlib import Path
+from typing import Optional, Dict
+
+from flask import current_app
+
+from cell_labeling_app.util.deadline import bound_timeout
+from cell_labeling_app.util.executor import run_in_process
+from cell_labeling_app.util.file_locks import SlotSemaphore, file_lock
+from cell_labeling_app.util.video_cache import VideoCache, \
+    make_video_cache_key, get_video_cache
+
+logger = logging.getLogger(__name__)
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# A pending job older than this is assumed to belong to a process that died
+STALE_JOB_AGE = 15 * 60
+
+# Niceness of the processes rendering low priority jobs
+LOW_PRIORITY_NICENESS = 10
+
+
+class RenderQueueFullError(RuntimeError):
+    """Raised when too many render jobs are pending"""
+    pass
+
+
+def render_thumbnail_video(
+        video_cache: Optional[VideoCache],
+        streamable: Optional[str] = None,
+        **video_kwargs) -> Path:
+    """
+    Renders a thumbnail video, or gets it from the cache if an identical
+    video has already been rendered. Renders in the process pool (see
+    `executor`)
+
+    :param video_cache:
+        Video cache. If None, the video is always rendered
+    :param streamable:
+        See `make_streamable`. If None, the video is not remuxed
+    :param video_kwargs:
+        kwargs passed to `get_thumbnail_video_from_artifact_file`
+    :return:
+        Path to the video. If `video_cache` is None, this is a temporary
+        file which the caller must remove
+    :raises TaskTimeoutError:
+        If the request's deadline passed while rendering or waiting for
+        another worker to render the video
+    """
+    if video_cache is None:
+        return run_in_process(_render, streamable=streamable, **video_kwargs)
+
+    key = make_video_cache_key(streamable=streamable, **video_kwargs)
+    path = video_cache.get(key=key)
+    if path is not None:
+        return path
+
+    # Workers requesting the same video wait for a single render, at most
+    # until the request's deadline
+    with file_lock(path=video_cache.get_lock_path(key=key),
+                   timeout=bound_timeout()):
+        path = video_cache.get(key=key)
+        if path is not None:
+            return path
+        video_path = run_in_process(_render, streamable=streamable,
+                                    **video_kwargs)
+        try:
+            return video_cache.put(key=key, video_path=video_path)
+        finally:
+            # Already moved into the cache, unless caching failed
+            _remove(path=video_path)
+
+
+def make_streamable(video_path: Path, out_path: Path, mode: str):
+    """
+    Remuxes an mp4 video, without re-encoding it, so that the browser can
+    start playing it before it has been downloaded completely.
+
+    :param video_path:
+        Path to the video
+    :param out_path:
+        Path to write the remuxed video to. If ffmpeg is not available, the
+        video is copied here as is
+    :param mode:
+        "faststart": moves the index to the start of the file
+        "fragmented": writes the video as a series of self-contained
+        fragments
+    :return:
+        None
+    """
+    movflags = {
+        'faststart': '+faststart',
+        'fragmented': 'frag_keyframe+empty_moov+default_base_moof'
+    }[mode]
+    ffmpeg = _get_ffmpeg_exe()
+    if ffmpeg is None:
+        shutil.copyfile(video_path, out_path)
+        return
+
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error',
+                    '-i', str(video_path),
+                    '-c', 'copy',
+                    '-movflags', movflags,
+                    str(out_path)],
+                   check=True)
+
+
+def _render(streamable: Optional[str], **video_kwargs) -> Path:
+    """Renders a video to a new temporary file, which the caller owns and
+    must move or remove"""
+    # ophys_etl is slow to import, and only needed to render
+    from ophys_etl.modules.roi_cell_classifier.video_utils import \
+        get_thumbnail_video_from_artifact_file
+
+    video = get_thumbnail_video_from_artifact_file(**video_kwargs)
+    rendered_path = Path(video.video_path)
+    fd, out_path = tempfile.mkstemp(prefix='thumbnail_', suffix='.mp4')
+    os.close(fd)
+    out_path = Path(out_path)
+    try:
+        # `video` owns `rendered_path`, so it is kept alive until the video
+        # has been copied or remuxed
+        if streamable is not None:
+            make_streamable(video_path=rendered_path, out_path=out_path,
+                            mode=streamable)
+        else:
+            shutil.copyfile(rendered_path, out_path)
+    except BaseException:
+        _remove(path=out_path)
+        raise
+    finally:
+        del video
+        _remove(path=rendered_path)
+    return out_path
+
+
+@functools.lru_cache()
+def _get_ffmpeg_exe() -> Optional[str]:
+    """Gets the ffmpeg bundled with imageio, or else the one on the path"""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        pass
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.warning('ffmpeg not found. Videos will not be remuxed to be '
+                       'streamable')
+    return ffmpeg
+
+
+class VideoRenderQueue:
+    """Queue of background video render jobs"""
+    def __init__(self,
+                 video_cache: VideoCache,
+                 max_concurrent: int,
+                 max_pending: int,
+                 n_processes: int = 1,
+                 streamable: Optional[str] = None,
+                 low_priority: bool = False):
+        """
+        :param video_cache:
+            Video cache to write rendered videos to
+        :param max_concurrent:
+            Maximum number of videos rendered at the same time on this host,
+            across all workers
+        :param max_pending:
+            Maximum number of submitted jobs that have not finished, on this
+            host across all workers. Submitting more raises
+            `RenderQueueFullError`
+        :param n_processes:
+            Number of processes in this worker's pool
+        :param streamable:
+            See `make_streamable`
+        :param low_priority:
+            Whether the jobs are background work, such as prefetching. Low
+            priority jobs have their own job markers and render slots, so
+            they don't count against the limits of the interactive queue,
+            and are rendered by niced processes
+        """
+        self._video_cache = video_cache
+        self._max_concurrent = max_concurrent
+        self._max_pending = max_pending
+        self._n_processes = n_processes
+        self._streamable = streamable
+        self._low_priority = low_priority
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}
+
+    @property
+    def jobs_dir(self) -> Path:
+        return self._video_cache.cache_dir / \
+            ('.low_priority_jobs' if self._low_priority else '.jobs')
+
+    @property
+    def slots_dir(self) -> Path:
+        return self._video_cache.cache_dir / \
+            ('.low_priority_render_slots' if self._low_priority
+             else '.render_slots')
+
+    def submit(self, waiter_id: Optional[str] = None, **video_kwargs) -> str:
+        """
+        Submits a render job. If the video is already cached or is being
+        rendered, no new job is started.
+
+        :param waiter_id:
+            Identifies who is waiting for the video, e.g. the user id. The
+            job is only cancelled once every waiter has cancelled it (see
+            `cancel`). If None, the job is not waited on by anyone
+        :param video_kwargs:
+            kwargs passed to `get_thumbnail_video_from_artifact_file`
+        :return:
+            job id
+        :raises RenderQueueFullError:
+            If too many jobs are pending
+        """
+        job_id = make_video_cache_key(streamable=self._streamable,
+                                      **video_kwargs)
+        if self._video_cache.get(key=job_id) is not None:
+            return job_id
+
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self._remove_stale_jobs()
+        if self._count_pending() >= self._max_pending:
+            raise RenderQueueFullError('Too many videos are being rendered')
+
+        try:
+            # Atomically claim the job, so that identical requests through
+            # other workers share the same render
+            fd = os.open(self._marker_path(job_id=job_id, state='pending'),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+        except FileExistsError:
+            # Someone still wants this video
+            self._add_waiter(job_id=job_id, waiter_id=waiter_id)
+            _remove(path=self._marker_path(job_id=job_id, state='cancelled'))
+            return job_id
+
+        for state in ('failed', 'cancelled'):
+            _remove(path=self._marker_path(job_id=job_id, state=state))
+        self._add_waiter(job_id=job_id, waiter_id=waiter_id)
+
+        future = self._get_executor().submit(
+            _render_job,
+            job_id=job_id,
+            cache_dir=self._video_cache.cache_dir,
+            jobs_dir=self.jobs_dir,
+            slots_dir=self.slots_dir,
+            max_bytes=self._video_cache.max_bytes,
+            max_concurrent=self._max_concurrent,
+            streamable=self._streamable,
+            video_kwargs=video_kwargs)
+        self._futures[job_id] = future
+        future.add_done_callback(
+            lambda f: self._on_job_done(job_id=job_id, future=f))
+        return job_id
+
+    def get_status(self, job_id: str) -> str:
+        """
+        Gets the status of a job
+
+        :param job_id:
+            job id
+        :return:
+            One of "done", "pending", "failed", "cancelled", "unknown"
+        """
+        if self._video_cache.get_path(key=job_id).exists():
+            return 'done'
+        for state in ('pending', 'failed', 'cancelled'):
+            if self._marker_path(job_id=job_id, state=state).exists():
+                return state
+        return 'unknown'
+
+    def wait(self, job_id: str, timeout: float,
+             poll_interval: float = 0.25) -> str:
+        """
+        Waits until the job is no longer pending
+
+        :param job_id:
+            job id
+        :param timeout:
+            Maximum time to wait in seconds
+        :param poll_interval:
+            Time between status checks in seconds
+        :return:
+            job status
+        """
+        start = time.monotonic()
+        while True:
+            status = self.get_status(job_id=job_id)
+            if status != 'pending' or time.monotonic() - start >= timeout:
+                return status
+            time.sleep(poll_interval)
+
+    def cancel(self, job_id: str, waiter_id: Optional[str] = None):
+        """
+        Stops waiting for a job. Once no one is waiting for it, the job is
+        cancelled: a job that is still waiting to be rendered is dropped,
+        and a job that has started rendering finishes and is cached.
+
+        :param job_id:
+            job id
+        :param waiter_id:
+            The `waiter_id` the job was submitted with
+        """
+        if waiter_id is not None:
+            _remove(path=self._waiter_path(job_id=job_id,
+                                           waiter_id=waiter_id))
+        if _has_waiters(jobs_dir=self.jobs_dir, job_id=job_id):
+            return
+        if self.get_status(job_id=job_id) != 'pending':
+            return
+        future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            # The callback removes the pending marker
+            return
+        with open(self._marker_path(job_id=job_id, state='cancelled'), 'w'):
+            pass
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._n_processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=(_lower_priority if self._low_priority
+                                 else None))
+            return self._executor
+
+    def _on_job_done(self, job_id: str, future: Future):
+        self._futures.pop(job_id, None)
+        if future.cancelled():
+            _remove(path=self._marker_path(job_id=job_id, state='pending'))
+            _remove_waiters(jobs_dir=self.jobs_dir, job_id=job_id)
+            with open(self._marker_path(job_id=job_id, state='cancelled'),
+                      'w'):
+                pass
+        elif future.exception() is not None:
+            # The render process died without recording the failure
+            _write_failure(jobs_dir=self.jobs_dir, job_id=job_id,
+                           msg=str(future.exception()))
+
+    def _marker_path(self, job_id: str, state: str) -> Path:
+        return _marker_path(jobs_dir=self.jobs_dir, job_id=job_id,
+                            state=state)
+
+    def _waiter_path(self, job_id: str, waiter_id: str) -> Path:
+        # Waiter ids come from the client, so are hashed to be safe in file
+        # names
+        waiter_hash = hashlib.sha1(waiter_id.encode('utf-8')).hexdigest()
+        return self._marker_path(job_id=job_id,
+                                 state=f'waiter-{waiter_hash[:16]}')
+
+    def _add_waiter(self, job_id: str, waiter_id: Optional[str]):
+        if waiter_id is None:
+            return
+        with open(self._waiter_path(job_id=job_id, waiter_id=waiter_id),
+                  'w'):
+            pass
+
+    def _count_pending(self) -> int:
+        return len(list(self.jobs_dir.glob('*.pending')))
+
+    def _remove_stale_jobs(self):
+        now = time.time()
+        for path in self.jobs_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime > STALE_JOB_AGE:
+                    _remove(path=path)
+            except FileNotFoundError:
+                continue
+
+
+# One queue per process, so that the pool outlives requests
+_video_render_queue: Optional[VideoRenderQueue] = None
+_video_render_queue_lock = threading.Lock()
+
+
+def get_video_render_queue() -> VideoRenderQueue:
+    """Gets this process's video render queue, configured from the app
+
+    :raises RuntimeError:
+        If the video cache is disabled, since it stores the rendered videos
+    """
+    global _video_render_queue
+    with _video_render_queue_lock:
+        if _video_render_queue is None:
+            video_cache = get_video_cache()
+            if video_cache is None:
+                raise RuntimeError('Background rendering requires '
+                                   'VIDEO_CACHE_DIR to be set')
+            config = current_app.config
+            _video_render_queue = VideoRenderQueue(
+                video_cache=video_cache,
+                max_concurrent=config['VIDEO_RENDER_MAX_CONCURRENT'],
+                max_pending=config['VIDEO_RENDER_MAX_PENDING'],
+                n_processes=config['VIDEO_RENDER_PROCESSES'],
+                streamable=config.get('VIDEO_STREAMABLE_FORMAT'))
+        return _video_render_queue
+
+
+_prefetch_render_queue: Optional[VideoRenderQueue] = None
+_prefetch_render_queue_lock = threading.Lock()
+
+
+def get_prefetch_render_queue() -> VideoRenderQueue:
+    """Gets this process's low priority queue for prefetched videos,
+    configured from the app
+
+    :raises RuntimeError:
+        If the video cache is disabled
+    """
+    global _prefetch_render_queue
+    with _prefetch_render_queue_lock:
+        if _prefetch_render_queue is None:
+            video_cache = get_video_cache()
+            if video_cache is None:
+                raise RuntimeError('Background rendering requires '
+                                   'VIDEO_CACHE_DIR to be set')
+            config = current_app.config
+            _prefetch_render_queue = VideoRenderQueue(
+                video_cache=video_cache,
+                max_concurrent=config['PREFETCH_VIDEO_MAX_CONCURRENT'],
+                max_pending=config['PREFETCH_VIDEO_MAX_PENDING'],
+                n_processes=1,
+                streamable=config.get('VIDEO_STREAMABLE_FORMAT'),
+                low_priority=True)
+        return _prefetch_render_queue
+
+
+def is_valid_job_id(job_id: str) -> bool:
+    """Whether `job_id` is well-formed. Job ids are used in file names, so
+    this must be checked for ids received from the client"""
+    return JOB_ID_PATTERN.match(job_id) is not None
+
+
+def _render_job(job_id: str, cache_dir: Path, jobs_dir: Path,
+                slots_dir: Path, max_bytes: int, max_concurrent: int,
+                streamable: Optional[str], video_kwargs: dict):
+    """Renders a video into the cache. Runs in a pool process."""
+    pending_path = _marker_path(jobs_dir=jobs_dir, job_id=job_id,
+                                state='pending')
+    cancelled_path = _marker_path(jobs_dir=jobs_dir, job_id=job_id,
+                                  state='cancelled')
+
+    slots = SlotSemaphore(lock_dir=slots_dir, n_slots=max_concurrent)
+    slot = slots.acquire(should_abort=cancelled_path.exists)
+    if slot is None:
+        # Cancelled while waiting for a slot. The marker is written again in
+        # case a resubmission removed it in the meantime
+        with open(cancelled_path, 'w'):
+            pass
+        _remove_waiters(jobs_dir=jobs_dir, job_id=job_id)
+        _remove(path=pending_path)
+        return
+    try:
+        video_cache = VideoCache(cache_dir=cache_dir, max_bytes=max_bytes)
+        render_thumbnail_video(video_cache=video_cache,
+                               streamable=streamable,
+                               **video_kwargs)
+        _remove_waiters(jobs_dir=jobs_dir, job_id=job_id)
+        _remove(path=pending_path)
+    except Exception as e:
+        logger.exception(f'Failed to render video {job_id}')
+        _write_failure(jobs_dir=jobs_dir, job_id=job_id, msg=str(e))
+    finally:
+        slot.release()
+
+
+def _lower_priority():
+    """Initializes the processes rendering low priority jobs"""
+    os.nice(LOW_PRIORITY_NICENESS)
+
+
+def _marker_path(jobs_dir: Path, job_id: str, state: str) -> Path:
+    return jobs_dir / f'{job_id}.{state}'
+
+
+def _has_waiters(jobs_dir: Path, job_id: str) -> bool:
+    return next(jobs_dir.glob(f'{job_id}.waiter-*'), None) is not None
+
+
+def _remove_waiters(jobs_dir: Path, job_id: str):
+    for path in jobs_dir.glob(f'{job_id}.waiter-*'):
+        _remove(path=path)
+
+
+def _write_failure(jobs_dir: Path, job_id: str, msg: str):
+    with open(_marker_path(jobs_dir=jobs_dir, job_id=job_id,
+                           state='failed'), 'w') as f:
+        f.write(msg)
+    _remove_waiters(jobs_dir=jobs_dir, job_id=job_id)
+    _remove(path=_marker_path(jobs_dir=jobs_dir, job_id=job_id,
+                              state='pending'))
+
+
+def _remove(path: Path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,110 @@
+"""Warms the in-process caches for the experiments of the active labeling
+jobs: the ROI tables, classifier scores and ROI contours of every region.
+
+Each gunicorn worker warms its caches in a background thread once it is
+serving, so that `get_warmup_status`, which is served by the /ready
+endpoint, reports the progress while it runs. Arrays are built once per host
+in the shared array cache, so workers after the first mostly fill their
+in-process caches. Warm-up never runs in the gunicorn master, which must not
+start the process pool before forking."""
+import copy
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from flask import Flask, current_app
+
+from cell_labeling_app.database.database import db
+from cell_labeling_app.database.schemas import JobRegion, LabelingJob
+from cell_labeling_app.util import util
+
+logger = logging.getLogger(__name__)
+
+_status = {
+    'state': 'disabled',
+    'n_regions': 0,
+    'n_regions_done': 0,
+    'started': None,
+    'finished': None,
+    'error': None
+}
+_status_lock = threading.Lock()
+
+
+def get_warmup_status() -> Dict:
+    """
+    :return:
+        dict with keys
+            - state: "disabled", "running", "done" or "failed"
+            - n_regions: number of regions to warm
+            - n_regions_done: number of regions warmed so far
+            - started: start time (unix time)
+            - finished: end time (unix time)
+            - error: error message if failed
+    """
+    with _status_lock:
+        return copy.deepcopy(_status)
+
+
+def get_active_job_ids() -> List[int]:
+    """Gets the labeling jobs which have regions that don't have enough
+    labels yet"""
+    job_ids = [x.job_id for x in db.session.query(LabelingJob.job_id).all()]
+    if current_app.config.get('LABELERS_REQUIRED_PER_REGION') is None:
+        return job_ids
+    active = []
+    for job_id in job_ids:
+        n_completed = len(util.get_completed_regions(job_id=job_id))
+        if n_completed < util.get_total_regions_in_labeling_job(
+                job_id=job_id):
+            active.append(job_id)
+    return active
+
+
+def warm_up_caches():
+    """Warms the caches for every region of the active jobs. Must be called
+    within an app context"""
+    _update_status(state='running', started=time.time(), finished=None,
+                   error=None, n_regions=0, n_regions_done=0)
+    try:
+        regions = (db.session.query(JobRegion)
+                   .filter(JobRegion.job_id.in_(get_active_job_ids()))
+                   .all())
+        _update_status(n_regions=len(regions))
+        for i, region in enumerate(regions):
+            util.get_roi_contours_in_region(
+                experiment_id=region.experiment_id, region=region)
+            _update_status(n_regions_done=i + 1)
+    except Exception as e:
+        logger.exception('Failed to warm up caches')
+        _update_status(state='failed', error=str(e), finished=time.time())
+        return
+    finally:
+        db.session.remove()
+    status = _update_status(state='done', finished=time.time())
+    logger.info(f'Warmed caches for {status["n_regions"]} regions in '
+                f'{status["finished"] - status["started"]:.1f}s')
+
+
+def start_warm_up(app: Flask):
+    """
+    Warms the caches in a background thread. Must be called in the process
+    serving requests, i.e. in a gunicorn worker rather than the master
+
+    :param app:
+        The app
+    """
+    def run():
+        with app.app_context():
+            warm_up_caches()
+
+    # Not ready until the thread has started
+    _update_status(state='running', started=time.time())
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _update_status(**kwargs) -> Dict:
+    with _status_lock:
+        _status.update(kwargs)
+        return copy.deepcopy(_status)
@@ -0,0 +1,233 @@
+import json
+import tempfile
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+
+from cell_labeling_app.artifact_tools.build_projection_stats import \
+    build_projection_stats
+from cell_labeling_app.artifact_tools.build_trace_summary import \
+    build_trace_summary
+from cell_labeling_app.artifact_tools.convert_rois import \
+    convert_rois_to_table
+from cell_labeling_app.artifact_tools.convert_traces import \
+    convert_traces_to_matrix
+from cell_labeling_app.artifact_tools.rechunk_video import rechunk_video
+from cell_labeling_app.imaging_plane_artifacts import ArtifactFile, \
+    ProjectionStats, RoiTable, TraceSummary
+
+
+class TestArtifactFile:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.artifact_path = Path(self.tmp_dir.name) / '1_artifacts.h5'
+
+        rng = np.random.default_rng(1234)
+        self.traces = {
+            0: np.concatenate([np.zeros(5), rng.random(100) + 1,
+                               np.zeros(10)]),
+            1: rng.random(115),
+            2: np.zeros(115)
+        }
+        with h5py.File(self.artifact_path, 'w') as f:
+            for roi_id, trace in self.traces.items():
+                f.create_dataset(f'traces/{roi_id}', data=trace)
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    @pytest.mark.parametrize('trace_matrix', (True, False))
+    def test_trace_summary(self, trace_matrix):
+        if trace_matrix:
+            convert_traces_to_matrix(artifact_path=self.artifact_path)
+        af = ArtifactFile(path=self.artifact_path)
+        assert not af.has_trace_summary
+        assert af.get_trace_summary(roi_id=0) is None
+
+        build_trace_summary(artifact_path=self.artifact_path)
+        assert af.has_trace_summary
+
+        for roi_id, trace in self.traces.items():
+            summary = af.get_trace_summary(roi_id=roi_id)
+            expected = TraceSummary.from_trace(trace=trace)
+            assert summary.argmax == trace.argmax()
+            assert summary.first_nonzero == expected.first_nonzero
+            assert summary.last_nonzero == expected.last_nonzero
+            assert summary.min == trace.min()
+            assert summary.max == trace.max()
+            assert summary.percentiles == pytest.approx(
+                expected.percentiles)
+
+        summary = af.get_trace_summary(roi_id=0)
+        assert (summary.first_nonzero, summary.last_nonzero) == (5, 104)
+        summary = af.get_trace_summary(roi_id=2)
+        assert (summary.first_nonzero, summary.last_nonzero) == (-1, -1)
+
+        assert af.get_trace_summary(roi_id=3) is None
+
+    def test_projection_stats(self):
+        projection = np.random.default_rng(0).integers(
+            0, 1000, size=(32, 32)).astype('uint16')
+        with h5py.File(self.artifact_path, 'a') as f:
+            f.create_dataset('max_projection', data=projection)
+        af = ArtifactFile(path=self.artifact_path)
+        assert af.get_projection_stats(projection_type='max') is None
+
+        build_projection_stats(artifact_path=self.artifact_path)
+        stats = af.get_projection_stats(projection_type='max')
+        expected = ProjectionStats.from_projection(projection=projection)
+        for name, arr in expected.arrays.items():
+            np.testing.assert_array_equal(getattr(stats, name), arr)
+        assert stats.get_quantile(quantile=0.5) == np.median(projection)
+
+        # Only projections in the file
+        assert af.get_projection_stats(projection_type='average') is None
+
+    @pytest.mark.parametrize('trace_matrix', (True, False))
+    def test_get_trace_end(self, trace_matrix):
+        if trace_matrix:
+            convert_traces_to_matrix(artifact_path=self.artifact_path)
+        af = ArtifactFile(path=self.artifact_path)
+        trace = af.get_trace(is_user_added=False, roi=None, roi_id=0,
+                             end=20)
+        np.testing.assert_array_equal(trace, self.traces[0][:20])
+
+    @pytest.mark.parametrize('remove_per_roi_traces', (True, False))
+    def test_convert_traces_to_matrix(self, remove_per_roi_traces):
+        output_path = Path(self.tmp_dir.name) / 'converted' / \
+            '1_artifacts.h5'
+        output_path.parent.mkdir()
+        convert_traces_to_matrix(
+            artifact_path=self.artifact_path,
+            output_path=output_path,
+            remove_per_roi_traces=remove_per_roi_traces)
+
+        with h5py.File(output_path, 'r') as f:
+            assert f['trace_matrix'].shape == (3, 115)
+            assert ('traces' in f) != remove_per_roi_traces
+        with h5py.File(self.artifact_path, 'r') as f:
+            assert 'trace_matrix' not in f
+
+        af = ArtifactFile(path=output_path)
+        assert af.trace_roi_ids == [0, 1, 2]
+        for roi_id, trace in self.traces.items():
+            np.testing.assert_array_equal(
+                af.get_trace(is_user_added=False, roi=None, roi_id=roi_id),
+                trace)
+
+        traces = af.get_traces(roi_ids=[2, 0, 2])
+        assert list(traces.keys()) == [2, 0]
+        np.testing.assert_array_equal(traces[0], self.traces[0])
+        np.testing.assert_array_equal(traces[2], self.traces[2])
+
+        with pytest.raises(KeyError):
+            af.get_traces(roi_ids=[0, 5])
+
+    @pytest.mark.parametrize('chunks', (None, (7, 8, 8)))
+    @pytest.mark.parametrize('start, end', ((0, 50), (3, 30), (40, 80)))
+    def test_get_video_crop(self, chunks, start, end):
+        video = np.arange(50 * 20 * 24, dtype='uint16').reshape(50, 20, 24)
+        with h5py.File(self.artifact_path, 'a') as f:
+            f.create_dataset('video_data', data=video, chunks=chunks)
+        af = ArtifactFile(path=self.artifact_path)
+        assert af.video_shape == (50, 20, 24)
+
+        crop = af.get_video_crop(x=5, y=2, width=10, height=6, start=start,
+                                 end=end, frames_per_read=10)
+        np.testing.assert_array_equal(crop, video[start:end, 2:8, 5:15])
+
+    @pytest.mark.parametrize('roi_table', (True, False))
+    def test_rois(self, roi_table):
+        rois = [
+            {'id': 0, 'x': 1, 'y': 2, 'width': 3, 'height': 2,
+             'mask': [[True, False, True], [False, True, True]]},
+            {'id': 5, 'x': 10, 'y': 20, 'width': 1, 'height': 1,
+             'mask': [[True]]}
+        ]
+        with h5py.File(self.artifact_path, 'a') as f:
+            f.create_dataset('rois', data=json.dumps(rois))
+        if roi_table:
+            convert_rois_to_table(artifact_path=self.artifact_path)
+            with h5py.File(self.artifact_path, 'r') as f:
+                assert 'rois' not in f
+
+        actual = ArtifactFile(path=self.artifact_path).rois
+        assert len(actual) == len(rois)
+        for roi, expected in zip(actual, rois):
+            np.testing.assert_array_equal(roi.pop('mask'), expected['mask'])
+            assert roi == {k: v for k, v in expected.items() if k != 'mask'}
+
+
+class TestRoiTable:
+    def test_from_rois(self):
+        rng = np.random.default_rng(1234)
+        rois = []
+        for roi_id, (height, width) in enumerate([(3, 5), (7, 2), (1, 1)]):
+            rois.append({
+                'id': roi_id + 10,
+                'x': roi_id,
+                'y': 2 * roi_id,
+                'width': width,
+                'height': height,
+                'mask': (rng.random((height, width)) > 0.5).tolist()
+            })
+        table = RoiTable.from_rois(rois=rois)
+        assert len(table) == 3
+
+        for roi in rois:
+            actual = table.get_roi(index=table.get_index(roi_id=roi['id']))
+            np.testing.assert_array_equal(actual.pop('mask'), roi['mask'])
+            assert actual == {k: v for k, v in roi.items() if k != 'mask'}
+
+        with pytest.raises(KeyError):
+            table.get_index(roi_id=0)
+
+    def test_get_bbox_overlapping(self):
+        rois = [
+            {'id': 0, 'x': 0, 'y': 0, 'width': 2, 'height': 2,
+             'mask': np.ones((2, 2), dtype=bool)},
+            {'id': 1, 'x': 10, 'y': 10, 'width': 2, 'height': 2,
+             'mask': np.ones((2, 2), dtype=bool)}
+        ]
+        table = RoiTable.from_rois(rois=rois)
+        assert table.get_bbox_overlapping(
+            row_start=1, row_end=5, col_start=1, col_end=5).tolist() == [0]
+        assert table.get_bbox_overlapping(
+            row_start=2, row_end=10, col_start=0, col_end=20).tolist() == []
+
+
+class TestRechunkVideo:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.artifact_path = Path(self.tmp_dir.name) / '1_artifacts.h5'
+
+        rng = np.random.default_rng(1234)
+        self.video = rng.integers(0, 1000, size=(300, 128, 128),
+                                  dtype='uint16')
+        with h5py.File(self.artifact_path, 'w') as f:
+            f.create_dataset('video_data', data=self.video,
+                             chunks=(10, 128, 128))
+            f.create_dataset('traces/0', data=np.arange(300))
+            f.attrs['version'] = 1
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    @pytest.mark.parametrize('compression', (None, 'lzf'))
+    def test_rechunk_video(self, compression):
+        read_bytes = rechunk_video(artifact_path=self.artifact_path,
+                                   frames_per_chunk=50, tile_size=32,
+                                   compression=compression)
+        assert read_bytes['after'] < read_bytes['before']
+
+        with h5py.File(self.artifact_path, 'r') as f:
+            assert f['video_data'].chunks == (50, 32, 32)
+            np.testing.assert_array_equal(f['video_data'][()], self.video)
+            np.testing.assert_array_equal(f['traces/0'][()], np.arange(300))
+            assert f.attrs['version'] == 1
+
+        crop = ArtifactFile(path=self.artifact_path).get_video_crop(
+            x=5, y=40, width=20, height=30, start=20, end=120)
+        np.testing.assert_array_equal(crop, self.video[20:120, 40:70, 5:25])
@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+# Modules which are slow to import, and must only be imported where used
+LAZY_MODULES = ('cv2', 'matplotlib', 'pandas', 'PIL', 'ophys_etl')
+
+# Cumulative import time budget of cell_labeling_app.main, in microseconds.
+# Generous, so that it only catches a heavy dependency imported at startup
+IMPORT_TIME_BUDGET = 3 * 10 ** 6
+
+
+def _get_import_times(module: str) -> dict:
+    """Imports `module` in a fresh interpreter and returns the cumulative
+    import time in microseconds of each module it imported"""
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True)
+    import_times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+class TestImportTime:
+    def test_main_import_time(self):
+        import_times = _get_import_times(module='cell_labeling_app.main')
+
+        imported = {name.split('.')[0] for name in import_times}
+        assert imported.isdisjoint(LAZY_MODULES)
+        assert import_times['cell_labeling_app.main'] < IMPORT_TIME_BUDGET
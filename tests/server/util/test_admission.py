@@ -0,0 +1,38 @@
+import tempfile
+
+import pytest
+
+from cell_labeling_app.util.admission import AdmissionPool, \
+    AdmissionRejectedError
+
+
+class TestAdmissionPool:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def _get_pool(self, max_queued: int) -> AdmissionPool:
+        return AdmissionPool(lock_dir=self.tmp_dir.name, name='video',
+                             max_concurrent=1, max_queued=max_queued,
+                             max_wait=0.1, retry_after=3)
+
+    @pytest.mark.parametrize('max_queued', (0, 1))
+    def test_rejects_when_saturated(self, max_queued):
+        pool = self._get_pool(max_queued=max_queued)
+        with pool.admit():
+            assert pool.get_stats()['active'] == 1
+            with pytest.raises(AdmissionRejectedError) as e:
+                with pool.admit():
+                    pass
+            assert e.value.retry_after == 3
+
+        stats = pool.get_stats()
+        assert stats['active'] == 0
+        assert stats['queued'] == 0
+        assert stats['rejected'] == 1
+
+        # Admitted once the running request finishes
+        with pool.admit():
+            pass
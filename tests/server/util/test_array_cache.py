@@ -0,0 +1,58 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from cell_labeling_app.util.array_cache import ArrayCache, LOCK_DIR
+
+
+class TestArrayCache:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmp_dir.name) / 'arrays'
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_build_once(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return {'a': np.arange(10), 'b': np.zeros((0, 2))}
+
+        arrays = ArrayCache(cache_dir=self.cache_dir, max_bytes=10 ** 6) \
+            .get_or_build(key='x', build=build)
+        # Another process sees the same entry
+        other = ArrayCache(cache_dir=self.cache_dir, max_bytes=10 ** 6) \
+            .get_or_build(key='x', build=build)
+        assert len(calls) == 1
+
+        for res in (arrays, other):
+            assert isinstance(res['a'], np.memmap)
+            np.testing.assert_array_equal(res['a'], np.arange(10))
+            assert res['b'].shape == (0, 2)
+            with pytest.raises(ValueError):
+                res['a'][0] = 1
+
+        # No temporary directories left behind
+        assert sorted(os.listdir(self.cache_dir)) == [LOCK_DIR, 'x']
+
+    def test_eviction(self):
+        cache = ArrayCache(cache_dir=self.cache_dir, max_bytes=1000)
+        cache.get_or_build(key='a', build=lambda: {'a': np.zeros(100)})
+        os.utime(cache.get_path(key='a'), (0, 0))
+        cache.get_or_build(key='b', build=lambda: {'b': np.zeros(100)})
+
+        assert cache.get(key='a') is None
+        assert cache.get(key='b') is not None
+
+    def test_entry_over_budget(self):
+        cache = ArrayCache(cache_dir=self.cache_dir, max_bytes=10)
+        arrays = cache.get_or_build(key='a',
+                                    build=lambda: {'a': np.arange(100)})
+        # Evicted, but the mapping returned stays valid
+        np.testing.assert_array_equal(arrays['a'], np.arange(100))
+        assert cache.get(key='a') is None
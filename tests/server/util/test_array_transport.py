@@ -0,0 +1,48 @@
+import zlib
+
+import numpy as np
+import pytest
+from flask import Flask, request
+
+from cell_labeling_app.util.array_transport import make_array_response, \
+    client_accepts_array, ARRAY_MIMETYPE, to_uint8
+
+
+class TestArrayTransport:
+    @pytest.mark.parametrize('dtype', ('float32', 'float16', 'uint16'))
+    @pytest.mark.parametrize('compress', (True, False))
+    def test_make_array_response(self, dtype, compress):
+        arr = np.arange(12, dtype='float64').reshape(3, 4)
+        response = make_array_response(arr, dtype=dtype, compress=compress)
+
+        body = response.get_data()
+        if compress:
+            assert response.headers['Content-Encoding'] == 'deflate'
+            body = zlib.decompress(body)
+        assert response.mimetype == ARRAY_MIMETYPE
+        assert response.headers['X-Array-Dtype'] == dtype
+        assert response.headers['X-Array-Shape'] == '3,4'
+
+        res = np.frombuffer(body, dtype=np.dtype(dtype).newbyteorder('<'))
+        np.testing.assert_array_equal(res.reshape(3, 4), arr.astype(dtype))
+
+    def test_unsupported_dtype(self):
+        with pytest.raises(ValueError, match='Unsupported dtype'):
+            make_array_response(np.zeros(3, dtype='complex64'))
+
+    @pytest.mark.parametrize('accept, expected', (
+            (ARRAY_MIMETYPE, True),
+            ('application/json', False),
+            ('*/*', False)
+    ))
+    def test_client_accepts_array(self, accept, expected):
+        app = Flask(__name__)
+        with app.test_request_context(headers={'Accept': accept}):
+            assert client_accepts_array(request=request) == expected
+
+    def test_to_uint8(self):
+        arr = np.array([[10, 20], [30, 10]], dtype='uint16')
+        res = to_uint8(arr)
+        assert res.dtype == np.uint8
+        np.testing.assert_array_equal(res, [[0, 127], [255, 0]])
+        np.testing.assert_array_equal(to_uint8(np.ones(3)), [0, 0, 0])
@@ -0,0 +1,72 @@
+import os
+import tempfile
+from pathlib import Path
+
+from flask import Flask
+
+from cell_labeling_app.util import util
+from cell_labeling_app.util.artifact_cache import ArtifactCache
+
+
+class TestArtifactCache:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.artifact_dir = Path(self.tmp_dir.name) / 'artifacts'
+        self.artifact_dir.mkdir()
+        self.cache_dir = Path(self.tmp_dir.name) / 'cache'
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def _write_artifact(self, experiment_id: str, size: int) -> Path:
+        path = self.artifact_dir / f'{experiment_id}_artifacts.h5'
+        path.write_bytes(b'0' * size)
+        return path
+
+    def test_fetch(self):
+        source = self._write_artifact(experiment_id='1', size=10)
+        cache = ArtifactCache(cache_dir=self.cache_dir, max_bytes=100)
+        assert cache.get(source=source) is None
+
+        path = cache.fetch(source=source)
+        assert path.parent == self.cache_dir
+        assert cache.get(source=source) == path
+        assert path.read_bytes() == source.read_bytes()
+
+        # Same identity as the source
+        assert path.stat().st_mtime_ns == source.stat().st_mtime_ns
+
+        # Out of date once the source changes
+        source.write_bytes(b'1' * 11)
+        assert cache.get(source=source) is None
+        assert cache.fetch(source=source).read_bytes() == b'1' * 11
+
+    def test_lru_eviction(self):
+        cache = ArtifactCache(cache_dir=self.cache_dir, max_bytes=25)
+        sources = [self._write_artifact(experiment_id=str(i), size=10)
+                   for i in range(3)]
+        for i, source in enumerate(sources[:2]):
+            cache.fetch(source=source)
+            used = self.cache_dir / '.used' / source.name
+            os.utime(used, (i, i))
+        # Use the first, so that the second is least recently used
+        cache.get(source=sources[0])
+
+        cache.fetch(source=sources[2])
+        assert cache.get(source=sources[0]) is not None
+        assert cache.get(source=sources[1]) is None
+        assert cache.get(source=sources[2]) is not None
+
+    def test_get_artifacts_path(self):
+        source = self._write_artifact(experiment_id='1', size=10)
+        app = Flask(__name__)
+        app.config['ARTIFACT_DIR'] = str(self.artifact_dir)
+        with app.app_context():
+            assert util.get_artifacts_path(experiment_id='1') == source
+
+            app.config['ARTIFACT_CACHE_DIR'] = str(self.cache_dir)
+            app.config['ARTIFACT_CACHE_MAX_BYTES'] = 100
+            ArtifactCache(cache_dir=self.cache_dir, max_bytes=100).fetch(
+                source=source)
+            assert util.get_artifacts_path(experiment_id='1') == \
+                self.cache_dir / source.name
@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+import pytest
+
+from cell_labeling_app.util.contour_encoding import decode_contours, \
+    encode_contours, simplify_contour
+
+
+def _get_rois(seed: int):
+    """ROIs with random blob masks, including 1 pixel wide lines and single
+    pixels"""
+    rng = np.random.default_rng(seed)
+    rois = []
+    for roi_id in range(10):
+        mask = np.zeros((64, 64), dtype='uint8')
+        for _ in range(3):
+            center = tuple(int(x) for x in rng.integers(8, 56, size=2))
+            axes = tuple(int(x) for x in rng.integers(1, 10, size=2))
+            cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0,
+                        360, 1, -1)
+        cv2.line(mask, (2, 2), (2 + roi_id, 20), 1, 1)
+        mask[60, 60] = 1
+        contours, _ = cv2.findContours(mask, cv2.RETR_TREE,
+                                       cv2.CHAIN_APPROX_NONE)
+        rois.append({
+            'id': roi_id,
+            'contours': [c.reshape(-1, 2).tolist() for c in contours],
+            'mask': mask
+        })
+    return rois
+
+
+def _draw(contours):
+    image = np.zeros((64, 64), dtype='uint8')
+    cv2.polylines(image, [np.array(c, dtype='int32') for c in contours],
+                  isClosed=True, color=1)
+    return image
+
+
+class TestContourEncoding:
+    @pytest.mark.parametrize('seed', range(3))
+    def test_default_tolerance_is_lossless(self, seed):
+        rois = _get_rois(seed=seed)
+        encoded = encode_contours(
+            rois=[{k: v for k, v in roi.items() if k != 'mask'}
+                  for roi in rois])
+        decoded = decode_contours(encoded=encoded)
+
+        n_points = sum([len(c) for roi in rois for c in roi['contours']])
+        assert len(encoded['points']) // 2 < n_points
+
+        for roi, res in zip(rois, decoded):
+            assert res['id'] == roi['id']
+            np.testing.assert_array_equal(_draw(res['contours']),
+                                          _draw(roi['contours']))
+            filled = np.zeros((64, 64), dtype='uint8')
+            cv2.drawContours(filled, [np.array(c, dtype='int32')
+                                      for c in res['contours']],
+                             -1, 1, -1)
+            np.testing.assert_array_equal(filled, _draw(roi['contours']) |
+                                          roi['mask'])
+
+    def test_simplify_contour(self):
+        square = [[x, 0] for x in range(5)] + \
+                 [[4, y] for y in range(1, 5)] + \
+                 [[x, 4] for x in range(3, -1, -1)] + \
+                 [[0, y] for y in range(3, 0, -1)]
+        np.testing.assert_array_equal(
+            simplify_contour(contour=square),
+            [[0, 0], [4, 0], [4, 4], [0, 4]])
+
+        # A line traced out and back keeps its ends
+        line = [[0, 0], [1, 0], [2, 0], [1, 0]]
+        np.testing.assert_array_equal(simplify_contour(contour=line),
+                                      [[0, 0], [2, 0]])
+
+        assert len(simplify_contour(contour=[[3, 3]])) == 1
+
+    def test_tolerance(self):
+        rois = _get_rois(seed=0)
+        lossless = encode_contours(rois=rois)
+        simplified = encode_contours(rois=rois, tolerance=1.0)
+        assert len(simplified['points']) < len(lossless['points'])
+        np.testing.assert_array_equal(simplified['roi_contour_offsets'],
+                                      lossless['roi_contour_offsets'])
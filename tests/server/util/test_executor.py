@@ -0,0 +1,60 @@
+import os
+import tempfile
+import time
+
+import pytest
+from flask import Flask
+
+from cell_labeling_app.util import deadline, util
+from cell_labeling_app.util.executor import run_in_process, \
+    TaskTimeoutError
+
+
+def _sleep(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+class TestRunInProcess:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['ARTIFACT_DIR'] = self.tmp_dir.name
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_runs_in_pool_with_app_config(self):
+        self.app.config['PROCESS_POOL_SIZE'] = 1
+        with self.app.app_context():
+            assert run_in_process(os.getpid) != os.getpid()
+            # The pool process can read the app config
+            path = run_in_process(util.get_artifacts_path, experiment_id='1')
+            assert path == util.get_artifacts_path(experiment_id='1')
+
+    def test_runs_in_this_process_if_disabled(self):
+        self.app.config['PROCESS_POOL_SIZE'] = 0
+        with self.app.app_context():
+            assert run_in_process(os.getpid) == os.getpid()
+        # No app context
+        assert run_in_process(os.getpid) == os.getpid()
+
+    def test_timeout(self):
+        self.app.config['PROCESS_POOL_SIZE'] = 1
+        with self.app.app_context():
+            with pytest.raises(TaskTimeoutError):
+                run_in_process(_sleep, timeout=0.5, seconds=2)
+            # Waits for the running task, then runs
+            assert run_in_process(_sleep, seconds=0) == 0
+
+    def test_request_deadline(self):
+        self.app.config['PROCESS_POOL_SIZE'] = 1
+        self.app.config['REQUEST_TIMEOUT'] = 0.5
+        deadline.init_app(self.app)
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            with pytest.raises(TaskTimeoutError):
+                run_in_process(_sleep, timeout=30, seconds=2)
+            # Out of time
+            with pytest.raises(TaskTimeoutError):
+                run_in_process(_sleep, seconds=0)
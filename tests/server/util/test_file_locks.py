@@ -0,0 +1,66 @@
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from cell_labeling_app.util.deadline import TaskTimeoutError
+from cell_labeling_app.util.file_locks import SlotSemaphore, file_lock
+
+
+class TestSlotSemaphore:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_slots(self):
+        semaphore = SlotSemaphore(lock_dir=self.tmp_dir.name, n_slots=2)
+        assert semaphore.count_held() == 0
+
+        slots = [semaphore.try_acquire(), semaphore.try_acquire()]
+        assert sorted([slot.index for slot in slots]) == [0, 1]
+        assert semaphore.count_held() == 2
+        assert semaphore.try_acquire() is None
+        assert semaphore.acquire(timeout=0.2, poll_interval=0.05) is None
+
+        slots[0].release()
+        assert semaphore.count_held() == 1
+        slot = semaphore.acquire(timeout=0.2)
+        assert slot.index == slots[0].index
+
+    def test_acquire_abort(self):
+        semaphore = SlotSemaphore(lock_dir=self.tmp_dir.name, n_slots=1)
+        slot = semaphore.try_acquire()
+        assert semaphore.acquire(should_abort=lambda: True) is None
+        slot.release()
+
+    def test_count_held_ignores_dead_holders(self):
+        semaphore = SlotSemaphore(lock_dir=self.tmp_dir.name, n_slots=2)
+        # A slot file left by a process that died holding it
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        (Path(self.tmp_dir.name) / '0.lock').write_text(str(process.pid))
+        assert semaphore.count_held() == 0
+
+        slot = semaphore.try_acquire()
+        assert slot.index == 0
+        assert semaphore.count_held() == 1
+        slot.release()
+        assert semaphore.count_held() == 0
+
+
+class TestFileLock:
+    def test_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'a.lock'
+            with file_lock(path=path):
+                # Locks are per open file, so this conflicts with the lock
+                # held above even within the process
+                with pytest.raises(TaskTimeoutError):
+                    with file_lock(path=path, timeout=0.1):
+                        pass
+            with file_lock(path=path, timeout=0.1):
+                pass
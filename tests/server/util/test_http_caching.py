@@ -0,0 +1,50 @@
+from flask import Flask
+
+from cell_labeling_app.util.http_caching import http_cached
+
+
+class TestHttpCached:
+    def setup_method(self, method):
+        self.identity = {'mtime': 1}
+        self.n_calls = 0
+
+        app = Flask(__name__)
+        app.config['HTTP_CACHE_MAX_AGE'] = 60
+
+        @app.route('/data', methods=['GET', 'POST'])
+        @http_cached(identity=lambda: dict(self.identity))
+        def data():
+            self.n_calls += 1
+            return {'value': 1}
+        self.client = app.test_client()
+
+    def test_not_modified(self):
+        response = self.client.get('/data?a=1')
+        assert response.status_code == 200
+        etag, _ = response.get_etag()
+        assert response.cache_control.private
+        assert response.cache_control.max_age == 60
+
+        response = self.client.get('/data?a=1',
+                                   headers={'If-None-Match': f'"{etag}"'})
+        assert response.status_code == 304
+        assert response.get_etag() == (etag, False)
+        assert self.n_calls == 1
+
+        # Different args
+        response = self.client.get('/data?a=2',
+                                   headers={'If-None-Match': f'"{etag}"'})
+        assert response.status_code == 200
+
+    def test_identity_change(self):
+        etag, _ = self.client.get('/data').get_etag()
+        self.identity['mtime'] = 2
+        response = self.client.get('/data',
+                                   headers={'If-None-Match': f'"{etag}"'})
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+
+    def test_post_not_cached(self):
+        response = self.client.post('/data')
+        assert response.status_code == 200
+        assert response.get_etag() == (None, None)
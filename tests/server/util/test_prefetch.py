@@ -0,0 +1,76 @@
+import tempfile
+
+from flask import Flask
+
+from cell_labeling_app.database.database import db
+from cell_labeling_app.database.schemas import User, LabelingJob, \
+    JobRegion, UserLabels, PrefetchedRegion
+from cell_labeling_app.util import prefetch
+
+
+class TestPrefetch:
+    def setup_method(self, method):
+        self.db_fp = tempfile.NamedTemporaryFile('w', suffix='.db')
+
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_fp.name}'
+        app.config['LABELERS_REQUIRED_PER_REGION'] = 2
+        db.init_app(app)
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        for user_id in ('0', '1', '2'):
+            db.session.add(User(id=user_id))
+        db.session.add(LabelingJob(job_id=1))
+        for _ in range(4):
+            db.session.add(JobRegion(job_id=1, experiment_id='0', x=0, y=0,
+                                     width=10, height=10))
+        db.session.commit()
+
+    def teardown_method(self, method):
+        db.session.remove()
+        self.app_context.pop()
+        self.db_fp.close()
+
+    def test_refill_and_pop(self):
+        added = prefetch.refill_prefetch_queue(
+            job_id=1, user_id='0', current_region_id=1, queue_size=2)
+        queued = [x.id for x in added]
+        assert len(set(queued)) == 2
+        assert 1 not in queued
+
+        # Already full
+        assert prefetch.refill_prefetch_queue(
+            job_id=1, user_id='0', current_region_id=1, queue_size=2) == []
+
+        assert prefetch.pop_prefetched_region(
+            job_id=1, user_id='0').id == queued[0]
+        assert prefetch.pop_prefetched_region(
+            job_id=1, user_id='0').id == queued[1]
+        assert prefetch.pop_prefetched_region(job_id=1, user_id='0') is None
+
+    def test_completed_region_is_invalidated(self):
+        added = prefetch.refill_prefetch_queue(
+            job_id=1, user_id='0', current_region_id=None, queue_size=1)
+        region_id = added[0].id
+
+        # Other labelers complete the region
+        for user_id in ('1', '2'):
+            db.session.add(UserLabels(user_id=user_id, region_id=region_id,
+                                      labels='[]'))
+            db.session.commit()
+            prefetch.invalidate_region(region_id=region_id)
+        assert db.session.query(PrefetchedRegion).count() == 0
+        assert prefetch.pop_prefetched_region(job_id=1, user_id='0') is None
+
+    def test_region_labeled_by_user_is_dropped(self):
+        added = prefetch.refill_prefetch_queue(
+            job_id=1, user_id='0', current_region_id=None, queue_size=2)
+        db.session.add(UserLabels(user_id='0', region_id=added[0].id,
+                                  labels='[]'))
+        db.session.commit()
+
+        assert prefetch.pop_prefetched_region(
+            job_id=1, user_id='0').id == added[1].id
+        assert db.session.query(PrefetchedRegion).count() == 0
@@ -0,0 +1,75 @@
+import tempfile
+from pathlib import Path
+
+import cv2
+import h5py
+import numpy as np
+from flask import Flask
+
+from cell_labeling_app.util import projections
+
+
+class TestProjections:
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_dir = Path(cls.tmp_dir.name)
+        cls.projection = np.arange(64 * 64, dtype='uint16').reshape(64, 64)
+        with h5py.File(tmp_dir / '0_artifacts.h5', 'w') as f:
+            f.create_dataset('max_projection', data=cls.projection)
+
+        cls.app = Flask(__name__)
+        cls.app.config['ARTIFACT_DIR'] = str(tmp_dir)
+        cls.app.config['ARRAY_CACHE_DIR'] = str(tmp_dir / 'arrays')
+        cls.app.config['ARRAY_CACHE_MAX_BYTES'] = 10 ** 8
+
+    @classmethod
+    def teardown_class(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_get_crop_box(self):
+        # y is reversed, and bounds outside the projection are clipped
+        box = projections.get_crop_box(
+            fov_bounds={'x': [-3.5, 20.2], 'y': [70, 10.7]},
+            shape=(64, 64))
+        assert box == {'x': 0, 'y': 10, 'width': 21, 'height': 54}
+
+    def test_contrast_stretch(self):
+        res = projections.contrast_stretch(
+            projection=np.array([0, 10, 15, 20, 30]), low=10, high=20)
+        np.testing.assert_array_equal(res, [0, 0, 127, 255, 255])
+        assert res.dtype == np.uint8
+
+        res = projections.contrast_stretch(
+            projection=np.array([0, 10]), low=10, high=10)
+        np.testing.assert_array_equal(res, [0, 0])
+
+    def test_get_projection_stats(self):
+        with self.app.app_context():
+            stats = projections.get_projection_stats(
+                experiment_id='0', projection_type='max')
+        assert stats.histogram.sum() == self.projection.size
+        assert stats.bin_edges[0] == 0
+        assert stats.bin_edges[-1] == self.projection.max()
+        for quantile in (0, 0.25, 0.5, 0.9995, 1):
+            assert np.isclose(stats.get_quantile(quantile=quantile),
+                              np.quantile(self.projection, quantile))
+
+    def test_get_projection_png(self):
+        box = {'x': 8, 'y': 4, 'width': 16, 'height': 32}
+        with self.app.app_context():
+            png = projections.get_projection_png(
+                experiment_id='0', projection_type='max', box=box,
+                quantiles=(0, 1))
+            assert projections.get_projection_png(
+                experiment_id='0', projection_type='max', box=box,
+                quantiles=(0, 1)) == png
+            expected = projections.get_projection_image(
+                experiment_id='0', projection_type='max', box=box,
+                quantiles=(0, 1))
+        assert expected.shape == (32, 16)
+        assert expected.dtype == np.uint8
+
+        image = cv2.imdecode(np.frombuffer(png, dtype='uint8'),
+                             cv2.IMREAD_UNCHANGED)
+        np.testing.assert_array_equal(image, expected)
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import h5py
+import pandas as pd
+from flask import Flask
+
+from cell_labeling_app.database.schemas import JobRegion
+from cell_labeling_app.util import util
+from cell_labeling_app.util.region_bundles import RegionBundleStore, \
+    build_region_bundle
+
+
+class TestRegionBundleStore:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_dir = Path(self.tmp_dir.name)
+
+        rois = [
+            {'id': 0, 'x': 2, 'y': 3, 'width': 3, 'height': 2,
+             'mask': [[True, True, False], [False, True, True]]},
+            {'id': 1, 'x': 40, 'y': 40, 'width': 2, 'height': 2,
+             'mask': [[True, True], [True, True]]}
+        ]
+        self.artifact_path = tmp_dir / '1_artifacts.h5'
+        with h5py.File(self.artifact_path, 'w') as f:
+            f.create_dataset('rois', data=json.dumps(rois))
+            f.create_dataset('motion_border', data=json.dumps(
+                {'left_side': 1, 'right_side': 2, 'top': 3, 'bottom': 4}))
+
+        predictions_path = tmp_dir / '1' / 'predictions' / \
+            '1_inference.csv'
+        predictions_path.parent.mkdir(parents=True)
+        pd.DataFrame({'experiment_id': ['1', '1'], 'roi-id': [0, 1],
+                      'y_score': [0.2, 0.9]}).to_csv(predictions_path,
+                                                     index=False)
+
+        self.app = Flask(__name__)
+        self.app.config['ARTIFACT_DIR'] = str(tmp_dir)
+        self.app.config['PREDICTIONS_DIR'] = str(tmp_dir)
+        self.region = JobRegion(id=5, experiment_id='1', x=0, y=0, width=10,
+                                height=10)
+        self.store = RegionBundleStore(bundle_dir=tmp_dir / 'bundles')
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_bundle_matches_live_computation(self):
+        with self.app.app_context():
+            assert self.store.get(region=self.region) is None
+
+            bundle = build_region_bundle(region=self.region)
+            self.store.put(region_id=self.region.id, bundle=bundle)
+            bundle = self.store.get(region=self.region)
+
+            contours = util.get_roi_contours_in_region(
+                experiment_id='1', region=self.region)
+            assert bundle['contours'] == json.loads(json.dumps(contours))
+            assert bundle['fov_bounds'] == util.get_fov_bounds(
+                region=self.region, contours=contours)
+            assert bundle['motion_border'] == {
+                'left_side': 1, 'right_side': 2, 'top': 3, 'bottom': 4}
+            assert [roi['id'] for roi in bundle['rois']] == [0]
+
+    def test_out_of_date_bundle_is_ignored(self):
+        with self.app.app_context():
+            bundle = build_region_bundle(region=self.region)
+            self.store.put(region_id=self.region.id, bundle=bundle)
+            assert self.store.get(region=self.region) is not None
+
+            stat = os.stat(self.artifact_path)
+            os.utime(self.artifact_path,
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            assert self.store.get(region=self.region) is None
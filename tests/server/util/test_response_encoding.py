@@ -0,0 +1,66 @@
+import datetime
+import gzip
+import json
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from cell_labeling_app.util import response_encoding
+from cell_labeling_app.util.response_encoding import encode_json, \
+    MSGPACK_MIMETYPE
+
+
+class TestResponseEncoding:
+    def setup_method(self, method):
+        app = Flask(__name__)
+        app.config['RESPONSE_COMPRESSION_MIN_BYTES'] = 1000
+        response_encoding.init_app(app)
+
+        @app.route('/small')
+        def small():
+            return {'b': np.arange(3, dtype='int32'), 'a': np.float32(0.5),
+                    'submitted': datetime.datetime(2021, 1, 2, 3, 4, 5)}
+
+        @app.route('/large')
+        def large():
+            return {'trace': np.zeros(1000, dtype='float32')}
+        self.client = app.test_client()
+
+    def test_json(self):
+        response = self.client.get('/small')
+        assert response.mimetype == 'application/json'
+        assert 'Content-Encoding' not in response.headers
+        assert response.get_json() == {
+            'a': 0.5,
+            'b': [0, 1, 2],
+            'submitted': 'Sat, 02 Jan 2021 03:04:05 GMT'
+        }
+
+    def test_compression(self):
+        response = self.client.get('/large',
+                                   headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.vary
+        assert json.loads(gzip.decompress(response.get_data())) == \
+            {'trace': [0.0] * 1000}
+
+        response = self.client.get('/large')
+        assert 'Content-Encoding' not in response.headers
+        assert len(response.get_json()['trace']) == 1000
+
+    def test_msgpack(self):
+        msgpack = pytest.importorskip('msgpack')
+        response = self.client.get('/small',
+                                   headers={'Accept': MSGPACK_MIMETYPE})
+        assert response.mimetype == MSGPACK_MIMETYPE
+        assert msgpack.unpackb(response.get_data())['b'] == [0, 1, 2]
+
+    @pytest.mark.parametrize('use_orjson', (True, False))
+    def test_encode_json(self, use_orjson, monkeypatch):
+        if not use_orjson:
+            monkeypatch.setattr(response_encoding, 'orjson', None)
+        obj = {'y': np.arange(6, dtype='int64').reshape(2, 3)[:, 1],
+               'x': [np.int64(1), np.float64(1.5), None]}
+        assert json.loads(encode_json(obj)) == \
+            {'y': [1, 4], 'x': [1, 1.5, None]}
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from cell_labeling_app.util import deadline
+from cell_labeling_app.util.deadline import TaskTimeoutError
+from cell_labeling_app.util.file_locks import file_lock
+from cell_labeling_app.util.single_flight import SingleFlight, \
+    FileSingleFlight
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_computation(self):
+        single_flight = SingleFlight()
+        n_calls = []
+        results = []
+
+        def compute():
+            n_calls.append(1)
+            time.sleep(0.2)
+            return 'result'
+
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    single_flight.do(key='a', fn=compute)))
+            for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(n_calls) == 1
+        assert results == ['result'] * 5
+
+        # Not cached once finished
+        single_flight.do(key='a', fn=compute)
+        assert len(n_calls) == 2
+
+    def test_exception_is_raised(self):
+        single_flight = SingleFlight()
+
+        def compute():
+            raise ValueError('bad')
+
+        with pytest.raises(ValueError, match='bad'):
+            single_flight.do(key='a', fn=compute)
+
+    def test_wait_bounded_by_deadline(self):
+        single_flight = SingleFlight()
+        leader = threading.Thread(
+            target=lambda: single_flight.do(key='a',
+                                            fn=lambda: time.sleep(1)))
+        leader.start()
+        time.sleep(0.1)
+
+        app = Flask(__name__)
+        app.config['REQUEST_TIMEOUT'] = 0.2
+        deadline.init_app(app)
+        with app.test_request_context():
+            app.preprocess_request()
+            start = time.monotonic()
+            with pytest.raises(TaskTimeoutError):
+                single_flight.do(key='a', fn=lambda: None)
+            assert time.monotonic() - start < 0.5
+        leader.join()
+
+
+class TestFileSingleFlight:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_result_shared_within_ttl(self):
+        n_calls = []
+
+        def compute():
+            n_calls.append(1)
+            return {'contours': [[0, 1]]}
+
+        # Separate instances stand in for separate workers
+        for _ in range(2):
+            single_flight = FileSingleFlight(directory=self.tmp_dir.name,
+                                             ttl=60)
+            assert single_flight.do(key='a', fn=compute) == \
+                {'contours': [[0, 1]]}
+        assert len(n_calls) == 1
+
+        single_flight = FileSingleFlight(directory=self.tmp_dir.name, ttl=0)
+        single_flight.do(key='a', fn=compute)
+        assert len(n_calls) == 2
+
+    def test_cleanup_keeps_lock_files(self):
+        single_flight = FileSingleFlight(directory=self.tmp_dir.name, ttl=1)
+        single_flight.do(key='a', fn=lambda: 'result')
+        lock_path = Path(self.tmp_dir.name) / 'a.lock'
+        result_path = Path(self.tmp_dir.name) / 'a.json'
+        expired = time.time() - 10
+        for path in (lock_path, result_path):
+            os.utime(path, (expired, expired))
+
+        with file_lock(path=lock_path):
+            # `do` has just cleaned up
+            single_flight._last_cleanup = 0
+            single_flight._cleanup()
+        assert lock_path.exists()
+        assert not result_path.exists()
+
+    def test_results_are_not_pickled(self):
+        single_flight = FileSingleFlight(directory=self.tmp_dir.name, ttl=60)
+        single_flight.do(key='a', fn=lambda: np.arange(3, dtype='float32'))
+        single_flight.do(key='b', fn=lambda: [{'id': np.int64(1)}])
+        assert sorted([x for x in os.listdir(self.tmp_dir.name)
+                       if not x.endswith('.lock')]) == ['a.npy', 'b.json']
+
+        # Read back by another process
+        other = FileSingleFlight(directory=self.tmp_dir.name, ttl=60)
+        np.testing.assert_array_equal(
+            other.do(key='a', fn=lambda: None), [0, 1, 2])
+        assert other.do(key='b', fn=lambda: None) == [{'id': 1}]
+
+    def test_directory_is_private(self):
+        directory = Path(self.tmp_dir.name) / 'single_flight'
+        directory.mkdir(mode=0o777)
+        os.chmod(directory, 0o777)
+        FileSingleFlight(directory=directory, ttl=60)
+        assert directory.stat().st_mode & 0o777 == 0o700
@@ -0,0 +1,71 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from cell_labeling_app.util.video_cache import VideoCache, \
+    make_video_cache_key
+
+
+class TestVideoCache:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmp_dir.name) / 'videos'
+        self.artifact_path = Path(self.tmp_dir.name) / '1_artifacts.h5'
+        self.artifact_path.write_bytes(b'artifact')
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def _write_video(self, name: str, size: int) -> Path:
+        path = Path(self.tmp_dir.name) / name
+        path.write_bytes(b'0' * size)
+        return path
+
+    def test_put_get(self):
+        cache = VideoCache(cache_dir=self.cache_dir, max_bytes=100)
+        assert cache.get(key='a') is None
+
+        video_path = self._write_video(name='a.mp4', size=10)
+        video = video_path.read_bytes()
+        path = cache.put(key='a', video_path=video_path)
+        assert cache.get(key='a') == path
+        assert path.read_bytes() == video
+
+        # Moved, not copied
+        assert not video_path.exists()
+
+        # No temporary files left behind
+        assert os.listdir(self.cache_dir) == ['a.mp4']
+
+    def test_lru_eviction(self):
+        cache = VideoCache(cache_dir=self.cache_dir, max_bytes=25)
+        for i, key in enumerate(('a', 'b')):
+            cache.put(key=key,
+                      video_path=self._write_video(name=key, size=10))
+            os.utime(cache.get_path(key=key), (i, i))
+
+        # Use "a" so that "b" is the least recently used
+        cache.get(key='a')
+        cache.put(key='c', video_path=self._write_video(name='c', size=10))
+
+        assert cache.get(key='a') is not None
+        assert cache.get(key='b') is None
+        assert cache.get(key='c') is not None
+
+    def test_cache_key(self):
+        roi = {'id': 1, 'x': 0, 'y': 0, 'width': 2, 'height': 2,
+               'mask': np.ones((2, 2), dtype=bool)}
+        kwargs = dict(artifact_path=self.artifact_path, roi=roi,
+                      padding=32, timesteps=np.arange(10),
+                      roi_color={1: (255, 0, 0)})
+        key = make_video_cache_key(**kwargs)
+        assert key == make_video_cache_key(**kwargs)
+        assert key != make_video_cache_key(
+            **{**kwargs, 'timesteps': np.arange(11)})
+        assert key != make_video_cache_key(**{**kwargs, 'roi_color': None})
+
+        # Invalidated when the artifact changes
+        self.artifact_path.write_bytes(b'new artifact')
+        assert key != make_video_cache_key(**kwargs)
@@ -0,0 +1,65 @@
+import tempfile
+from concurrent.futures import Future
+from pathlib import Path
+
+import pytest
+
+from cell_labeling_app.util.video_cache import VideoCache
+from cell_labeling_app.util.video_rendering import VideoRenderQueue, \
+    RenderQueueFullError
+
+
+class _IdleExecutor:
+    """Accepts jobs but never runs them"""
+    def submit(self, fn, **kwargs):
+        return Future()
+
+
+class TestVideoRenderQueue:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.video_cache = VideoCache(cache_dir=Path(self.tmp_dir.name),
+                                      max_bytes=1000)
+        self.queue = VideoRenderQueue(video_cache=self.video_cache,
+                                      max_concurrent=1,
+                                      max_pending=4)
+        self.queue._get_executor = lambda: _IdleExecutor()
+        self.artifact_path = Path(self.tmp_dir.name) / 'artifact.h5'
+        self.artifact_path.write_bytes(b'0')
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_cancel_when_last_waiter_cancels(self):
+        job_id = self.queue.submit(waiter_id='0',
+                                   artifact_path=self.artifact_path, roi_id=1)
+        assert self.queue.submit(waiter_id='1',
+                                 artifact_path=self.artifact_path,
+                                 roi_id=1) == job_id
+
+        self.queue.cancel(job_id=job_id, waiter_id='0')
+        assert self.queue.get_status(job_id=job_id) == 'pending'
+
+        # Cancelling twice doesn't drop the other waiter
+        self.queue.cancel(job_id=job_id, waiter_id='0')
+        assert self.queue.get_status(job_id=job_id) == 'pending'
+
+        self.queue.cancel(job_id=job_id, waiter_id='1')
+        assert self.queue.get_status(job_id=job_id) == 'cancelled'
+        assert not list(self.queue.jobs_dir.glob('*.waiter-*'))
+
+    def test_low_priority_queue_has_own_limits(self):
+        low_priority = VideoRenderQueue(video_cache=self.video_cache,
+                                        max_concurrent=1,
+                                        max_pending=1,
+                                        low_priority=True)
+        low_priority._get_executor = lambda: _IdleExecutor()
+        low_priority.submit(artifact_path=self.artifact_path, roi_id=1)
+        with pytest.raises(RenderQueueFullError):
+            low_priority.submit(artifact_path=self.artifact_path, roi_id=2)
+
+        # Not counted against the interactive queue
+        job_id = self.queue.submit(artifact_path=self.artifact_path,
+                                   roi_id=2)
+        assert self.queue.get_status(job_id=job_id) == 'pending'
+        assert self.queue._count_pending() == 1
@@ -0,0 +1,75 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import h5py
+import pandas as pd
+from flask import Flask
+
+from cell_labeling_app.database.database import db
+from cell_labeling_app.database.schemas import LabelingJob, JobRegion, \
+    User, UserLabels
+from cell_labeling_app.util import util, warmup
+
+
+class TestWarmUp:
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_dir = Path(self.tmp_dir.name)
+
+        rois = [{'id': 0, 'x': 2, 'y': 3, 'width': 2, 'height': 2,
+                 'mask': [[True, True], [True, True]]}]
+        with h5py.File(tmp_dir / '1_artifacts.h5', 'w') as f:
+            f.create_dataset('rois', data=json.dumps(rois))
+        predictions_path = tmp_dir / '1' / 'predictions' / \
+            '1_inference.csv'
+        predictions_path.parent.mkdir(parents=True)
+        pd.DataFrame({'experiment_id': ['1'], 'roi-id': [0],
+                      'y_score': [0.2]}).to_csv(predictions_path,
+                                                index=False)
+
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = \
+            f'sqlite:///{tmp_dir / "app.db"}'
+        self.app.config['ARTIFACT_DIR'] = str(tmp_dir)
+        self.app.config['PREDICTIONS_DIR'] = str(tmp_dir)
+        self.app.config['LABELERS_REQUIRED_PER_REGION'] = 1
+        db.init_app(self.app)
+        with self.app.app_context():
+            db.create_all()
+            db.session.add(User(id='0'))
+            for job_id in (1, 2):
+                db.session.add(LabelingJob(job_id=job_id,
+                                           name=f'job {job_id}'))
+                db.session.add(JobRegion(job_id=job_id, experiment_id='1',
+                                         x=0, y=0, width=10, height=10))
+            db.session.commit()
+
+            # Job 1 is complete
+            db.session.add(UserLabels(user_id='0', region_id=1, labels='[]'))
+            db.session.commit()
+
+    def teardown_method(self, method):
+        self.tmp_dir.cleanup()
+
+    def test_warm_up_caches(self):
+        with self.app.app_context():
+            assert warmup.get_active_job_ids() == [2]
+            warmup.warm_up_caches()
+
+        status = warmup.get_warmup_status()
+        assert status['state'] == 'done'
+        assert status['n_regions'] == status['n_regions_done'] == 1
+        assert len(util._roi_contours_cache) > 0
+
+    def test_start_warm_up(self):
+        warmup.start_warm_up(app=self.app)
+        # Progress is reported while warming up in the background
+        assert warmup.get_warmup_status()['state'] in ('running', 'done')
+
+        start = time.monotonic()
+        while warmup.get_warmup_status()['state'] == 'running' and \
+                time.monotonic() - start < 10:
+            time.sleep(0.05)
+        assert warmup.get_warmup_status()['state'] == 'done'